@@ -2,13 +2,12 @@ import argparse
 import collections.abc as collections
 import glob
 import pprint
+import time
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Dict, List, Optional, Union
-from torch.profiler import profile, record_function, ProfilerActivity
+from typing import Dict, List, Optional, Tuple, Union
 
 import cv2
-import h5py
 import numpy as np
 import PIL.Image
 import torch
@@ -16,7 +15,7 @@ from tqdm import tqdm
 
 from . import extractors, logger
 from .utils.base_model import dynamic_load
-from .utils.io import list_h5_names, read_image
+from .utils.io import BatchedH5Writer, list_h5_names, read_image
 from .utils.parsers import parse_image_lists
 
 """
@@ -25,6 +24,8 @@ line using their name. Each is a dictionary with the following entries:
     - output: the name of the feature file that will be generated.
     - model: the model configuration, as passed to a feature extractor.
     - preprocessing: how to preprocess the images read from disk.
+    - loader (optional): number of loader workers and prefetched images.
+    - writer (optional): keyword arguments of the FeatureWriter.
 """
 confs = {
     "superpoint_aachen": {
@@ -174,6 +175,8 @@ class ImageDataset(torch.utils.data.Dataset):
         "resize_max": None,
         "resize_force": False,
         "interpolation": "cv2_area",  # pil_linear is more accurate but slower
+        # decode JPEGs at 1/2, 1/4 or 1/8 of their size if still >= resize_max
+        "reduced_decode": True,
     }
 
     def __init__(self, root, conf, paths=None):
@@ -201,31 +204,48 @@ class ImageDataset(torch.utils.data.Dataset):
                 if not (root / name).exists():
                     raise ValueError(f"Image {name} does not exists in root: {root}.")
 
+    def read_reduced(self, path):
+        """Decode a JPEG at a reduced size if it is still larger than resize_max."""
+        with PIL.Image.open(path) as im:
+            size = im.size  # only the header is read
+        for factor in (8, 4, 2):
+            # libjpeg rounds the reduced size up
+            if -(-max(size) // factor) >= self.conf.resize_max:
+                return read_image(path, self.conf.grayscale, factor), size
+        return read_image(path, self.conf.grayscale), size
+
     def __getitem__(self, idx):
         name = self.names[idx]
-        image = read_image(self.root / name, self.conf.grayscale)
-        image = image.astype(np.float32)
-        size = image.shape[:2][::-1]
+        path = self.root / name
+        # Decoding and resizing are done in uint8, the conversion to float is
+        # done once on the final image, see main().
+        if (
+            self.conf.reduced_decode
+            and self.conf.resize_max
+            and path.suffix.lower() in (".jpg", ".jpeg")
+        ):
+            image, size = self.read_reduced(path)
+        else:
+            image = read_image(path, self.conf.grayscale)
+            size = image.shape[:2][::-1]
+        size_current = image.shape[:2][::-1]
 
         if self.conf.resize_max and (
             self.conf.resize_force or max(size) > self.conf.resize_max
         ):
             scale = self.conf.resize_max / max(size)
             size_new = tuple(int(round(x * scale)) for x in size)
-            image = resize_image(image, size_new, self.conf.interpolation)
+            if size_new != size_current:
+                image = resize_image(image, size_new, self.conf.interpolation)
 
         if self.conf.grayscale:
             image = image[None]
         else:
             image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = image / 255.0
-
-        # image = torch.from_numpy(image)  # 变成 tensor
 
         data = {
-            "image": image,
+            "image": np.ascontiguousarray(image),
             "original_size": np.array(size),
-            # "original_size": torch.from_numpy(np.array(size)), #转tensor
         }
         return data
 
@@ -233,6 +253,27 @@ class ImageDataset(torch.utils.data.Dataset):
         return len(self.names)
 
 
+class FeatureWriter(BatchedH5Writer):
+    """Single batched writer of the feature file, see BatchedH5Writer."""
+
+    def write(self, name: str, data: Tuple[Dict[str, np.ndarray], float]):
+        pred, uncertainty = data
+        try:
+            grp = self.fd.create_group(name)
+            for k, v in pred.items():
+                grp.create_dataset(k, data=v)
+            if "keypoints" in pred:
+                grp["keypoints"].attrs["uncertainty"] = uncertainty
+        except OSError as error:
+            if "No space left on device" in error.args[0]:
+                logger.error(
+                    "Out of disk space: storing features on disk can take "
+                    "significant space, did you enable the as_half flag?"
+                )
+                del grp, self.fd[name]
+            raise error
+
+
 @torch.no_grad()
 def main(
     conf: Dict,
@@ -253,121 +294,79 @@ def main(
         feature_path = Path(export_dir, conf["output"] + ".h5")
     feature_path.parent.mkdir(exist_ok=True, parents=True)
 
-    # 跳过已经存在于features h5文件里的特征
-    # skip_names = set(
-    #     list_h5_names(feature_path) if feature_path.exists() and not overwrite else ()
-    # )
-    # dataset.names = [n for n in dataset.names if n not in skip_names]
-    # if len(dataset.names) == 0:
-    #     logger.info("Skipping the extraction.")
-    #     return feature_path
+    skip_names = set(
+        list_h5_names(feature_path) if feature_path.exists() and not overwrite else ()
+    )
+    num_images = len(dataset.names)
+    dataset.names = [n for n in dataset.names if n not in skip_names]
+    if len(dataset.names) == 0:
+        logger.info("Skipping the extraction.")
+        return feature_path
+    if len(dataset.names) < num_images:
+        logger.info(
+            f"Skipping {num_images - len(dataset.names)} images with existing features."
+        )
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     Model = dynamic_load(extractors, conf["model"]["name"])
     model = Model(conf["model"]).eval().to(device)
 
-    # with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-    #         record_shapes=True,
-    #         profile_memory=True,
-    #         with_stack=True) as prof:
-    #     with record_function("init_dataset"):
+    # Images are decoded and resized by the loader workers ahead of the model,
+    # and features are written by a background thread while the next image runs.
+    loader_conf = {"num_workers": 8, "prefetch_factor": 2, **conf.get("loader", {})}
+    num_workers = loader_conf["num_workers"]
     loader = torch.utils.data.DataLoader(
-        dataset, num_workers=8, shuffle=False, pin_memory=True
-    ) # 构建loader配置
-    # print(prof.key_averages().table(sort_by="cpu_time_total", row_limit=50))
-
-    # for idx, data in enumerate(tqdm(loader)):
-    #     name = dataset.names[idx] #当前图片相对路径名字
-    #     pred = model({"image": data["image"].to(device, non_blocking=True)}) # 提取局部特征 disk，把图片移到gpu
-    #     pred = {k: v[0].cpu().numpy() for k, v in pred.items()} # 'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000)}
-
-    #     pred["image_size"] = original_size = data["original_size"][0].numpy() # pred['image_size']: value=[1920 1440], shape=(2,), dtype=int64
-    #     #'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000), 'image_size': (2,)dtype=int64}
-        
-    #     if "keypoints" in pred:
-    #         size = np.array(data["image"].shape[-2:][::-1])
-    #         scales = (original_size / size).astype(np.float32)
-    #         pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
-    #         if "scales" in pred:
-    #             pred["scales"] *= scales.mean()
-    #         # add keypoint uncertainties scaled to the original resolution
-    #         uncertainty = getattr(model, "detection_noise", 1) * scales.mean()
-
-    #     if as_half:
-    #         for k in pred:
-    #             dt = pred[k].dtype
-    #             if (dt == np.float32) and (dt != np.float16):
-    #                 pred[k] = pred[k].astype(np.float16)
-
-    #     with h5py.File(str(feature_path), "a", libver="latest") as fd:
-    #         try:
-    #             if name in fd:
-    #                 del fd[name] # 如果文件已经存在某帧特征，删除旧的，rewrite新的计算结果
-    #             grp = fd.create_group(name)
-    #             for k, v in pred.items():
-    #                 grp.create_dataset(k, data=v)
-    #             if "keypoints" in pred:
-    #                 grp["keypoints"].attrs["uncertainty"] = uncertainty
-    #         except OSError as error:
-    #             if "No space left on device" in error.args[0]:
-    #                 logger.error(
-    #                     "Out of disk space: storing features on disk can take "
-    #                     "significant space, did you enable the as_half flag?"
-    #                 )
-    #                 del grp, fd[name]
-    #             raise error
-
-    #     del pred
-
-    # 假设只处理一张 query 图：image_list = [query_rel]
-    assert len(dataset) == 1, "Single-image mode: dataset should contain exactly 1 image."
-
-    # 直接取这张图片
-    data = dataset[0]     # 不用 DataLoader，直接读取 'image': numpy.ndarray', (3, 1200, 1600), dtype('float32')), 'original_size': 'numpy.ndarray', (2,), dtype('int64'))
-
-    name = dataset.names[0]
-
-    # 转 tensor
-    image_tensor = torch.from_numpy(data["image"]).to(device, non_blocking=True)
-
-    # 前向推理
-    # pred = model({"image": data["image"].to(device, non_blocking=True)})
-    image_tensor = image_tensor.unsqueeze(0) # 加 batch dim
-    pred = model({"image": image_tensor})   
-    pred = {k: v[0].cpu().numpy() for k, v in pred.items()} #{'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000)}
-
-
-    # 保存原图大小
-    original_size = data["original_size"].astype(np.int64)
-    pred["image_size"] = original_size
-    # {'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000), 'image_size': (2,)}
-
-    # 关键点缩放
-    if "keypoints" in pred:
-        size = np.array(data["image"].shape[-2:][::-1])
-        scales = (original_size / size).astype(np.float32)
-        pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
-        if "scales" in pred:
-            pred["scales"] *= scales.mean()
-        uncertainty = getattr(model, "detection_noise", 1) * scales.mean()
-
-    # float32 → float16
-    if as_half:
-        for k in pred:
-            if pred[k].dtype == np.float32:
-                pred[k] = pred[k].astype(np.float16)
-
-    # 写入 h5
-    with h5py.File(str(feature_path), "a", libver="latest") as fd:
-        if name in fd:
-            del fd[name]
-        grp = fd.create_group(name)
-        for k, v in pred.items():
-            grp.create_dataset(k, data=v)
-        if "keypoints" in pred:
-            grp["keypoints"].attrs["uncertainty"] = uncertainty
-    
-
+        dataset,
+        num_workers=num_workers,
+        prefetch_factor=loader_conf["prefetch_factor"] if num_workers > 0 else None,
+        shuffle=False,
+        pin_memory=True,
+    )
+    writer = FeatureWriter(feature_path, **conf.get("writer", {}))
+
+    time_load = time_model = 0.0
+    tic = time.time()
+    try:
+        pbar = tqdm(loader)
+        for idx, data in enumerate(pbar):
+            toc = time.time()
+            time_load += toc - tic
+            name = dataset.names[idx]
+            image = data["image"].to(device, non_blocking=True)
+            pred = model({"image": image.float().div_(255.0)})
+            pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
+
+            pred["image_size"] = original_size = data["original_size"][0].numpy()
+            uncertainty = None
+            if "keypoints" in pred:
+                size = np.array(data["image"].shape[-2:][::-1])
+                scales = (original_size / size).astype(np.float32)
+                pred["keypoints"] = (pred["keypoints"] + 0.5) * scales[None] - 0.5
+                if "scales" in pred:
+                    pred["scales"] *= scales.mean()
+                # add keypoint uncertainties scaled to the original resolution
+                uncertainty = getattr(model, "detection_noise", 1) * scales.mean()
+
+            if as_half:
+                for k in pred:
+                    dt = pred[k].dtype
+                    if (dt == np.float32) and (dt != np.float16):
+                        pred[k] = pred[k].astype(np.float16)
+
+            writer.put((name, (pred, uncertainty)))
+            tic = time.time()
+            time_model += tic - toc
+            pbar.set_postfix(load=f"{time_load:.1f}s", model=f"{time_model:.1f}s")
+    finally:
+        writer.join()
+
+    num_images = len(dataset)
+    total = time_load + time_model
+    logger.info(
+        f"Extracted {num_images} images in {total:.1f}s "
+        f"({num_images / max(total, 1e-9):.2f} images/s, "
+        f"{time_load:.1f}s waiting for images, {time_model:.1f}s in the model)."
+    )
     logger.info("Finished exporting features.")
     return feature_path
 
@@ -18,6 +18,7 @@ from . import extractors, logger
 from .utils.base_model import dynamic_load
 from .utils.io import list_h5_names, read_image
 from .utils.parsers import parse_image_lists
+from .utils.tracing import stage
 
 _MODEL_CACHE = {}        # global model cache
 _DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -160,16 +161,19 @@ def load_model_cached(model_conf):
     global _MODEL_CACHE
 
     model_name = model_conf["name"]
+    # key on the full conf: the same extractor can be used with different
+    # settings (e.g. max_keypoints) for coarse and fine passes
+    cache_key = (model_name, repr(sorted(model_conf.items())))
 
     # if the model is already loaded, return directly
-    if model_name in _MODEL_CACHE:
-        return _MODEL_CACHE[model_name]
+    if cache_key in _MODEL_CACHE:
+        return _MODEL_CACHE[cache_key]
 
     print(f"[extract_features] Loading model '{model_name}' to cache for the FIRST time...")
 
     ModelClass = dynamic_load(extractors, model_name)
     model = ModelClass(model_conf).eval().to(_DEVICE)
-    _MODEL_CACHE[model_name] = model
+    _MODEL_CACHE[cache_key] = model
 
     print(f"[extract_features] Model '{model_name}' loaded and cached.")
     return model
@@ -292,7 +296,8 @@ def main(
     # only deal with one image：image_list = [query_rel]
     assert len(dataset) == 1, "Single-image mode: dataset should contain exactly 1 image."
 
-    data = dataset[0]     # no DataLoader，load image directly 
+    with stage("extract_decode"):
+        data = dataset[0]     # no DataLoader，load image directly 
 
     name = dataset.names[0]
 
@@ -301,8 +306,9 @@ def main(
 
     # forward predictation
     image_tensor = image_tensor.unsqueeze(0) # add batch dim
-    pred = model({"image": image_tensor})   
-    pred = {k: v[0].cpu().numpy() for k, v in pred.items()} #{'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000)}
+    with stage("extract_model"):
+        pred = model({"image": image_tensor})   
+        pred = {k: v[0].cpu().numpy() for k, v in pred.items()} #{'keypoints': (5000, 2), 'keypoint_scores': (5000,), 'descriptors': (128, 5000)}
 
     # save origianl image size
     original_size = data["original_size"].astype(np.int64)
@@ -325,7 +331,7 @@ def main(
                 pred[k] = pred[k].astype(np.float16)
 
     # write in h5 file
-    with h5py.File(str(feature_path), "a", libver="latest") as fd:
+    with stage("extract_write"), h5py.File(str(feature_path), "a", libver="latest") as fd:
         if name in fd:
             del fd[name]
         grp = fd.create_group(name)
@@ -1,9 +1,7 @@
 import argparse
 import pprint
-from functools import partial
+import time
 from pathlib import Path
-from queue import Queue
-from threading import Thread
 from typing import Dict, List, Optional, Tuple, Union
 
 import h5py
@@ -12,13 +10,21 @@ from tqdm import tqdm
 
 from . import logger, matchers
 from .utils.base_model import dynamic_load
+from .utils.io import BatchedH5Writer
+from .utils.packed import is_packed, open_packed
 from .utils.parsers import names_to_pair, names_to_pair_old, parse_retrieval
+from .utils.tracing import record, stage
+
+_MATCHER_CACHE = {}
 
 """
 A set of standard configurations that can be directly selected from the command
 line using their name. Each is a dictionary with the following entries:
     - output: the name of the match file that will be generated.
     - model: the model configuration, as passed to a feature matcher.
+    - loader (optional): keyword arguments of the DataLoader, e.g. num_workers.
+    - writer (optional): keyword arguments of the MatchWriter, e.g. the number
+      of pairs per flush or the compression of the match datasets.
 """
 confs = {
     "superpoint+lightglue": {
@@ -88,29 +94,11 @@ confs = {
 }
 
 
-class WorkQueue:
-    def __init__(self, work_fn, num_threads=1):
-        self.queue = Queue(num_threads)
-        self.threads = [
-            Thread(target=self.thread_fn, args=(work_fn,)) for _ in range(num_threads)
-        ]
-        for thread in self.threads:
-            thread.start()
-
-    def join(self):
-        for thread in self.threads:
-            self.queue.put(None)
-        for thread in self.threads:
-            thread.join()
-
-    def thread_fn(self, work_fn):
-        item = self.queue.get()
-        while item is not None:
-            work_fn(item)
-            item = self.queue.get()
-
-    def put(self, data):
-        self.queue.put(data)
+def read_features(path: Path, name: str) -> Dict:
+    if is_packed(path):
+        return open_packed(path).group(name)
+    with h5py.File(path, "r") as fd:
+        return {k: v.__array__() for k, v in fd[name].items()}
 
 
 class FeaturePairsDataset(torch.utils.data.Dataset):
@@ -122,36 +110,46 @@ class FeaturePairsDataset(torch.utils.data.Dataset):
     def __getitem__(self, idx):
         name0, name1 = self.pairs[idx]
         data = {}
-        with h5py.File(self.feature_path_q, "r") as fd:
-            grp = fd[name0]
-            
-            for k, v in grp.items():
-                data[k + "0"] = torch.from_numpy(v.__array__()).float()
+        for i, (path, name) in enumerate(
+            [(self.feature_path_q, name0), (self.feature_path_r, name1)]
+        ):
+            feats = read_features(path, name)
+            for k, v in feats.items():
+                data[k + str(i)] = torch.from_numpy(v).float()
             # some matchers might expect an image but only use its size
-            data["image0"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
-        with h5py.File(self.feature_path_r, "r") as fd:
-            grp = fd[name1]
-            
-            for k, v in grp.items():
-                data[k + "1"] = torch.from_numpy(v.__array__()).float()
-            data["image1"] = torch.empty((1,) + tuple(grp["image_size"])[::-1])
+            data[f"image{i}"] = torch.empty((1,) + tuple(feats["image_size"])[::-1])
         return data
 
     def __len__(self):
         return len(self.pairs)
 
 
-def writer_fn(inp, match_path):
-    pair, pred = inp
-    with h5py.File(str(match_path), "a", libver="latest") as fd:
-        if pair in fd:
-            del fd[pair]
-        grp = fd.create_group(pair)
+class MatchWriter(BatchedH5Writer):
+    """Single batched writer of the match file, see BatchedH5Writer."""
+
+    def __init__(
+        self,
+        match_path: Path,
+        flush_every: int = 64,
+        compression: Optional[str] = None,
+        compression_opts: Optional[int] = None,
+        chunked: bool = False,
+    ):
+        self.dataset_kwargs = {}
+        if chunked or compression is not None:
+            self.dataset_kwargs["chunks"] = True
+        if compression is not None:
+            self.dataset_kwargs["compression"] = compression
+            self.dataset_kwargs["compression_opts"] = compression_opts
+        super().__init__(match_path, flush_every)
+
+    def write(self, pair: str, pred: Dict):
+        grp = self.fd.create_group(pair)
         matches = pred["matches0"][0].cpu().short().numpy()
-        grp.create_dataset("matches0", data=matches)
+        grp.create_dataset("matches0", data=matches, **self.dataset_kwargs)
         if "matching_scores0" in pred:
             scores = pred["matching_scores0"][0].cpu().half().numpy()
-            grp.create_dataset("matching_scores0", data=scores)
+            grp.create_dataset("matching_scores0", data=scores, **self.dataset_kwargs)
 
 
 def main(
@@ -208,6 +206,15 @@ def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
     return pairs
 
 
+def load_matcher(model_conf: Dict, device: str):
+    """Load a matcher once per process and configuration."""
+    key = (pprint.pformat(model_conf), device)
+    if key not in _MATCHER_CACHE:
+        Model = dynamic_load(matchers, model_conf["name"])
+        _MATCHER_CACHE[key] = Model(model_conf).eval().to(device)
+    return _MATCHER_CACHE[key]
+
+
 @torch.no_grad()
 def match_from_paths(
     conf: Dict,
@@ -236,26 +243,36 @@ def match_from_paths(
         return
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    Model = dynamic_load(matchers, conf["model"]["name"])
-    model = Model(conf["model"]).eval().to(device)
+    model = load_matcher(conf["model"], device)
 
     dataset = FeaturePairsDataset(pairs, feature_path_q, feature_path_ref)
     loader = torch.utils.data.DataLoader(
-        dataset, num_workers=5, batch_size=1, shuffle=False, pin_memory=True
+        dataset,
+        num_workers=conf.get("loader", {}).get("num_workers", 5),
+        batch_size=1,
+        shuffle=False,
+        pin_memory=True,
     )
-    writer_queue = WorkQueue(partial(writer_fn, match_path=match_path), 5)
-
-    for idx, data in enumerate(tqdm(loader, smoothing=0.1)):
-        data = {
-            k: v if k.startswith("image") else v.to(device, non_blocking=True)
-            for k, v in data.items()
-        }
-  
-        pred = model(data)  
-
-        pair = names_to_pair(*pairs[idx])
-        writer_queue.put((pair, pred)) 
-    writer_queue.join()
+    writer = MatchWriter(match_path, **conf.get("writer", {}))
+
+    try:
+        tic = time.perf_counter()
+        for idx, data in enumerate(tqdm(loader, smoothing=0.1)):
+            record("match_load", time.perf_counter() - tic)
+            data = {
+                k: v if k.startswith("image") else v.to(device, non_blocking=True)
+                for k, v in data.items()
+            }
+
+            with stage("match_model"):
+                pred = model(data)
+
+            pair = names_to_pair(*pairs[idx])
+            writer.put((pair, pred))
+            tic = time.perf_counter()
+    finally:
+        with stage("match_write"):
+            writer.join()
     logger.info("Finished exporting matches.")
 
 
@@ -1,51 +1,88 @@
 import argparse
-from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
-from tqdm import tqdm
+import scipy.sparse
 
 from . import logger
-from .utils.read_write_model import read_model
+from .utils.read_write_model import (
+    detect_model_format,
+    read_images_binary_columnar,
+    read_model,
+    read_points3D_binary_columnar,
+)
+
+
+def read_observations(model: Path):
+    """Image ids and names, and the image id and 3D point index of each observation."""
+    if detect_model_format(model, ".bin"):
+        images = read_images_binary_columnar(model / "images.bin")
+        points3D = read_points3D_binary_columnar(model / "points3D.bin")
+        image_ids, names = images["ids"], images["names"]
+        obs_image_ids = points3D["image_ids"]
+        track_lengths = np.diff(points3D["track_offsets"])
+    else:
+        _, images, points3D = read_model(model)
+        image_ids = np.array(list(images.keys()), dtype=np.int64)
+        names = [images[i].name for i in image_ids]
+        obs_image_ids = np.concatenate(
+            [p.image_ids for p in points3D.values()] + [np.empty(0, np.int64)]
+        )
+        track_lengths = [len(p.image_ids) for p in points3D.values()]
+    obs_point_idxs = np.repeat(np.arange(len(track_lengths)), track_lengths)
+    return image_ids, names, obs_image_ids, obs_point_idxs
+
+
+def covisibility_matrix(
+    image_ids, obs_image_ids, obs_point_idxs
+) -> scipy.sparse.coo_matrix:
+    """Number of 3D points shared by each pair of images, without the diagonal."""
+    image_idx = np.full(max(image_ids.max(), obs_image_ids.max()) + 1, -1)
+    image_idx[image_ids] = np.arange(len(image_ids))
+    rows = image_idx[obs_image_ids]
+    valid = rows != -1
+    num_points = obs_point_idxs.max() + 1 if len(obs_point_idxs) else 0
+    # image x point incidence matrix, duplicate observations are summed
+    incidence = scipy.sparse.csr_matrix(
+        (np.ones(valid.sum(), np.int32), (rows[valid], obs_point_idxs[valid])),
+        shape=(len(image_ids), num_points),
+    )
+    covis = (incidence @ incidence.T).tocoo()
+    off_diagonal = covis.row != covis.col
+    return scipy.sparse.coo_matrix(
+        (covis.data[off_diagonal], (covis.row[off_diagonal], covis.col[off_diagonal])),
+        shape=covis.shape,
+    )
+
+
+def topk_per_row(matrix: scipy.sparse.coo_matrix, k: int):
+    """Row and column indices of the k largest entries of each row, by row."""
+    # Sort by row, then decreasing value, then column for deterministic ties.
+    order = np.lexsort((matrix.col, -matrix.data, matrix.row))
+    rows, cols = matrix.row[order], matrix.col[order]
+    row_start = np.searchsorted(rows, rows, side="left")
+    rank = np.arange(len(rows)) - row_start
+    keep = rank < k
+    return rows[keep], cols[keep]
 
 
 def main(model, output, num_matched):
     logger.info("Reading the COLMAP model...")
-    cameras, images, points3D = read_model(model)
+    image_ids, names, obs_image_ids, obs_point_idxs = read_observations(Path(model))
 
     logger.info("Extracting image pairs from covisibility info...")
-    pairs = []
-    for image_id, image in tqdm(images.items()):
-        matched = image.point3D_ids != -1
-        points3D_covis = image.point3D_ids[matched]
-
-        covis = defaultdict(int)
-        for point_id in points3D_covis:
-            for image_covis_id in points3D[point_id].image_ids:
-                if image_covis_id != image_id:
-                    covis[image_covis_id] += 1
-
-        if len(covis) == 0:
-            logger.info(f"Image {image_id} does not have any covisibility.")
-            continue
-
-        covis_ids = np.array(list(covis.keys()))
-        covis_num = np.array([covis[i] for i in covis_ids])
-
-        if len(covis_ids) <= num_matched:
-            top_covis_ids = covis_ids[np.argsort(-covis_num)]
-        else:
-            # get covisible image ids with top k number of common matches
-            ind_top = np.argpartition(covis_num, -num_matched)
-            ind_top = ind_top[-num_matched:]  # unsorted top k
-            ind_top = ind_top[np.argsort(-covis_num[ind_top])]
-            top_covis_ids = [covis_ids[i] for i in ind_top]
-            assert covis_num[ind_top[0]] == np.max(covis_num)
-
-        for i in top_covis_ids:
-            pair = (image.name, images[i].name)
-            pairs.append(pair)
+    if len(image_ids) == 0 or len(obs_image_ids) == 0:
+        rows = cols = np.empty(0, np.int64)
+    else:
+        covis = covisibility_matrix(image_ids, obs_image_ids, obs_point_idxs)
+        rows, cols = topk_per_row(covis, num_matched)
+
+    has_covis = np.zeros(len(image_ids), bool)
+    has_covis[rows] = True
+    for i in np.flatnonzero(~has_covis):
+        logger.info(f"Image {image_ids[i]} does not have any covisibility.")
 
+    pairs = [(names[i], names[j]) for i, j in zip(rows.tolist(), cols.tolist())]
     logger.info(f"Found {len(pairs)} pairs.")
     with open(output, "w") as f:
         f.write("\n".join(" ".join([i, j]) for i, j in pairs))
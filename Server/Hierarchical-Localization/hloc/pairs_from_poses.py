@@ -1,61 +1,99 @@
 import argparse
+from collections import deque
 from pathlib import Path
 
 import numpy as np
 import scipy.spatial
 
 from . import logger
-from .pairs_from_retrieval import pairs_from_score_matrix
-from .utils.read_write_model import read_images_binary
+from .utils.read_write_model import qvec2rotmat, read_images_binary_columnar
 
 DEFAULT_ROT_THRESH = 30  # in degrees
+CHUNK_SIZE = 4096  # images whose neighbors are searched at once
+MAX_CANDIDATES = 2**22  # bound on the (images x neighbors) candidates in memory
 
 
-def get_pairwise_distances(images):
-    ids = np.array(list(images.keys()))
-    Rs = []
-    ts = []
-    for id_ in ids:
-        image = images[id_]
-        R = image.qvec2rotmat()
-        t = image.tvec
-        Rs.append(R)
-        ts.append(t)
-    Rs = np.stack(Rs, 0)
-    ts = np.stack(ts, 0)
+def get_centers_and_axes(qvecs, tvecs):
+    """Camera centers and principal axes in world frame from world-to-camera poses."""
+    Rs = qvec2rotmat(qvecs.T).transpose(2, 0, 1)
+    centers = -np.einsum("nji,nj->ni", Rs, tvecs)
+    return centers, Rs[:, 2, :]
 
-    # Invert the poses from world-to-camera to camera-to-world.
-    Rs = Rs.transpose(0, 2, 1)
-    ts = -(Rs @ ts[:, :, None])[:, :, 0]
-
-    dist = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(ts))
 
+def axis_angles(dots):
     # Instead of computing the angle between two camera orientations,
     # we compute the angle between the principal axes, as two images rotated
     # around their principal axis still observe the same scene.
-    axes = Rs[:, :, -1]
-    dots = np.einsum("mi,ni->mn", axes, axes, optimize=True)
-    dR = np.rad2deg(np.arccos(np.clip(dots, -1.0, 1.0)))
-
-    return ids, dist, dR
+    return np.rad2deg(np.arccos(np.clip(dots, -1.0, 1.0)))
+
+
+def spatial_neighbors(centers, axes, num_matched, rotation_threshold):
+    """Nearest cameras with a similar viewing direction, by chunks of images.
+
+    Yields for each image index the indices of its num_matched nearest cameras,
+    by increasing distance, whose principal axis differs by less than
+    rotation_threshold degrees. Candidates are queried from a KD-tree over the
+    camera centers; the number of candidates is quadrupled for the images that do
+    not have enough valid ones. Once a sizable fraction of all cameras would be
+    queried, the distances to all cameras are computed directly instead.
+    """
+    num_images = len(centers)
+    tree = scipy.spatial.cKDTree(centers)
+    for start in range(0, num_images, CHUNK_SIZE):
+        neighbors = {}
+        queue = deque([(np.arange(start, min(start + CHUNK_SIZE, num_images)), 1)])
+        while queue:
+            idxs, k = queue.popleft()
+            k = max(k, 2 * (num_matched + 1))
+            if 4 * k >= num_images:
+                k = num_images
+            batch = max(1, MAX_CANDIDATES // k)
+            if len(idxs) > batch:
+                queue.extend(
+                    (idxs[i : i + batch], k) for i in range(0, len(idxs), batch)
+                )
+                continue
+
+            if k == num_images:
+                dist = scipy.spatial.distance.cdist(centers[idxs], centers)
+                dist[axis_angles(axes[idxs] @ axes.T) >= rotation_threshold] = np.inf
+                dist[np.arange(len(idxs)), idxs] = np.inf
+                top = min(num_matched, num_images)
+                order = np.argpartition(dist, top - 1, axis=1)[:, :top]
+                dist = np.take_along_axis(dist, order, 1)
+                order = np.take_along_axis(order, np.argsort(dist, 1), 1)
+                dist = np.sort(dist, 1)
+                for i, cands, d in zip(idxs, order, dist):
+                    neighbors[i] = cands[np.isfinite(d)]
+                continue
+
+            _, candidates = tree.query(centers[idxs], k=k)
+            dots = np.einsum("mi,mki->mk", axes[idxs], axes[candidates])
+            valid = axis_angles(dots) < rotation_threshold
+            valid &= candidates != idxs[:, None]
+            done = valid.sum(1) >= num_matched
+            for i, cands, v in zip(idxs[done], candidates[done], valid[done]):
+                neighbors[i] = cands[v][:num_matched]
+            if not done.all():
+                queue.append((idxs[~done], 4 * k))
+        for i in sorted(neighbors):
+            yield i, neighbors[i]
 
 
 def main(model, output, num_matched, rotation_threshold=DEFAULT_ROT_THRESH):
     logger.info("Reading the COLMAP model...")
-    images = read_images_binary(model / "images.bin")
-
-    logger.info(f"Obtaining pairwise distances between {len(images)} images...")
-    ids, dist, dR = get_pairwise_distances(images)
-    scores = -dist
-
-    invalid = dR >= rotation_threshold
-    np.fill_diagonal(invalid, True)
-    pairs = pairs_from_score_matrix(scores, invalid, num_matched)
-    pairs = [(images[ids[i]].name, images[ids[j]].name) for i, j in pairs]
+    images = read_images_binary_columnar(model / "images.bin")
+    names = images["names"]
 
-    logger.info(f"Found {len(pairs)} pairs.")
+    logger.info(f"Searching the nearest cameras of {len(names)} images...")
+    centers, axes = get_centers_and_axes(images["qvecs"], images["tvecs"])
+    num_pairs = 0
     with open(output, "w") as f:
-        f.write("\n".join(" ".join(p) for p in pairs))
+        for i, js in spatial_neighbors(centers, axes, num_matched, rotation_threshold):
+            for j in js:
+                f.write(("\n" if num_pairs else "") + f"{names[i]} {names[j]}")
+                num_pairs += 1
+    logger.info(f"Found {num_pairs} pairs.")
 
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ import torch
 
 from . import logger
 from .utils.io import list_h5_names
+from .utils.packed import is_packed, open_packed
 from .utils.parsers import parse_image_lists
 from .utils.read_write_model import read_images_binary
 
@@ -35,16 +36,41 @@ def parse_names(prefix, names, names_all):
     return names
 
 
+def read_descriptors(path, names, key, out, out_idxs):
+    """Read the descriptors of names from one file into out[out_idxs]."""
+    # Reading in name order follows the layout of the file.
+    order = sorted(range(len(names)), key=names.__getitem__)
+    if is_packed(path):
+        store = open_packed(path)
+        for i in order:
+            out[out_idxs[i]] = store.get(names[i], key)
+        return
+    with h5py.File(str(path), "r", libver="latest") as fd:
+        for i in order:
+            out[out_idxs[i]] = fd[f"{names[i]}/{key}"][()]
+
+
 def get_descriptors(names, path, name2idx=None, key="global_descriptor"):
+    """Stack the descriptors of names, opening each descriptor file once."""
     if name2idx is None:
-        with h5py.File(str(path), "r", libver="latest") as fd:
-            desc = [fd[n][key].__array__() for n in names]
+        paths, file_idxs = [path], np.zeros(len(names), dtype=int)
+    else:
+        paths, file_idxs = path, np.array([name2idx[n] for n in names], dtype=int)
+    if len(names) == 0:
+        return torch.empty((0, 0))
+
+    first = names[0]
+    if is_packed(paths[file_idxs[0]]):
+        shape = open_packed(paths[file_idxs[0]]).get(first, key).shape
     else:
-        desc = []
-        for n in names:
-            with h5py.File(str(path[name2idx[n]]), "r", libver="latest") as fd:
-                desc.append(fd[n][key].__array__())
-    return torch.from_numpy(np.stack(desc, 0)).float()
+        with h5py.File(str(paths[file_idxs[0]]), "r", libver="latest") as fd:
+            shape = fd[first][key].shape
+    desc = np.empty((len(names),) + shape, dtype=np.float32)
+    for i, p in enumerate(paths):
+        idxs = np.flatnonzero(file_idxs == i)
+        if len(idxs) > 0:
+            read_descriptors(p, [names[j] for j in idxs], key, desc, idxs)
+    return torch.from_numpy(desc)
 
 
 def pairs_from_score_matrix(
@@ -61,14 +87,49 @@ def pairs_from_score_matrix(
         invalid |= scores < min_score
     scores.masked_fill_(invalid, float("-inf"))
 
-    topk = torch.topk(scores, num_select, dim=1)
+    topk = torch.topk(scores, min(num_select, scores.shape[1]), dim=1)
     indices = topk.indices.cpu().numpy()
     valid = topk.values.isfinite().cpu().numpy()
 
-    pairs = []
-    for i, j in zip(*np.where(valid)):
-        pairs.append((i, indices[i, j]))
-    return pairs
+    rows, ranks = np.nonzero(valid)
+    return list(zip(rows.tolist(), indices[rows, ranks].tolist()))
+
+
+def topk_similarity(
+    query_desc: torch.Tensor,
+    db_desc: torch.Tensor,
+    num_select: int,
+    exclude: Optional[torch.Tensor] = None,
+    min_score: Optional[float] = None,
+    db_chunk_size: int = 16384,
+):
+    """Scores and indices of the most similar database descriptors of each query.
+
+    The database is scored in chunks, so that only a (num_query, db_chunk_size)
+    block of similarities is in memory at a time, and merged into a running
+    top-k. exclude gives for each query a database index to ignore, or -1.
+    Entries that were excluded or are below min_score have a score of -inf.
+    """
+    device = query_desc.device
+    num_query = len(query_desc)
+    best_scores = query_desc.new_empty((num_query, 0))
+    best_indices = torch.empty((num_query, 0), dtype=torch.long, device=device)
+    for start in range(0, len(db_desc), db_chunk_size):
+        block = db_desc[start : start + db_chunk_size].to(device)
+        scores = query_desc @ block.T
+        if exclude is not None:
+            rows = torch.nonzero((exclude >= start) & (exclude < start + len(block)))
+            rows = rows[:, 0]
+            scores[rows, exclude[rows] - start] = float("-inf")
+        if min_score is not None:
+            scores.masked_fill_(scores < min_score, float("-inf"))
+        indices = torch.arange(start, start + len(block), device=device)
+        scores = torch.cat([best_scores, scores], 1)
+        indices = torch.cat([best_indices, indices.expand(num_query, -1)], 1)
+        topk = torch.topk(scores, min(num_select, scores.shape[1]), dim=1)
+        best_scores = topk.values
+        best_indices = torch.gather(indices, 1, topk.indices)
+    return best_scores, best_indices
 
 
 def main(
@@ -81,6 +142,8 @@ def main(
     db_list=None,
     db_model=None,
     db_descriptors=None,
+    query_chunk_size=1024,
+    db_chunk_size=16384,
 ):
     logger.info("Extracting image pairs from a retrieval database.")
 
@@ -105,13 +168,32 @@ def main(
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     db_desc = get_descriptors(db_names, db_descriptors, name2db)
-    query_desc = get_descriptors(query_names, descriptors)
-    sim = torch.einsum("id,jd->ij", query_desc.to(device), db_desc.to(device))
 
     # Avoid self-matching
-    self = np.array(query_names)[:, None] == np.array(db_names)[None]
-    pairs = pairs_from_score_matrix(sim, self, num_matched, min_score=0)
-    pairs = [(query_names[i], db_names[j]) for i, j in pairs]
+    db_index = {n: i for i, n in enumerate(db_names)}
+    self_index = torch.tensor(
+        [db_index.get(n, -1) for n in query_names], dtype=torch.long
+    )
+
+    pairs = []
+    for start in range(0, len(query_names), query_chunk_size):
+        names = query_names[start : start + query_chunk_size]
+        query_desc = get_descriptors(names, descriptors).to(device)
+        scores, indices = topk_similarity(
+            query_desc,
+            db_desc,
+            num_matched,
+            exclude=self_index[start : start + len(names)].to(device),
+            min_score=0,
+            db_chunk_size=db_chunk_size,
+        )
+        valid = scores.isfinite().cpu().numpy()
+        indices = indices.cpu().numpy()
+        rows, ranks = np.nonzero(valid)
+        pairs += [
+            (names[i], db_names[j])
+            for i, j in zip(rows.tolist(), indices[rows, ranks].tolist())
+        ]
 
     logger.info(f"Found {len(pairs)} pairs.")
     with open(output, "w") as f:
@@ -0,0 +1,162 @@
+import argparse
+import collections.abc as collections
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from . import logger
+from .pairs_from_retrieval import get_descriptors, topk_similarity
+from .utils.io import list_h5_names
+from .utils.parsers import parse_image_lists
+
+
+def split_sequences(names: List[str]) -> List[List[str]]:
+    """Group images into sequences by parent directory, ordered by name."""
+    sequences = {}
+    for name in sorted(names):
+        sequences.setdefault(str(Path(name).parent), []).append(name)
+    return list(sequences.values())
+
+
+def sequence_offsets(num_images: int, window_size: int, quadratic_overlap: bool):
+    """Offsets to the next frames matched to each frame of a sequence.
+
+    All the frames of the window are matched. With quadratic overlap, frames
+    further away are added at exponentially increasing offsets, which links
+    distant parts of the sequence with only O(log N) more pairs per frame.
+    """
+    offsets = list(range(1, window_size + 1))
+    if quadratic_overlap:
+        p = 1
+        while window_size + 2**p - 1 < num_images:
+            offsets.append(window_size + 2**p - 1)
+            p += 1
+    return offsets
+
+
+def loop_closure_pairs(
+    names: List[str],
+    index: Dict[str, Tuple[int, int]],
+    descriptors: Path,
+    window_size: int,
+    retrieval_interval: int,
+    num_loc: int,
+    min_score: Optional[float],
+):
+    """Pairs of every retrieval_interval-th frame with its most similar frames.
+
+    Frames of the same sequence that are already in the sequential window are
+    skipped; the top num_loc + 2 * window_size + 1 frames are retrieved so that
+    num_loc candidates remain after this filtering.
+    """
+    query_names = names[::retrieval_interval]
+    desc = get_descriptors(names, descriptors)
+    scores, indices = topk_similarity(
+        desc[::retrieval_interval],
+        desc,
+        num_loc + 2 * window_size + 1,
+        min_score=min_score,
+    )
+    valid = scores.isfinite().cpu().numpy()
+    indices = indices.cpu().numpy()
+    pairs = []
+    for name, is_valid, candidates in zip(query_names, valid, indices):
+        seq, pos = index[name]
+        num_found = 0
+        for j in candidates[is_valid]:
+            seq_j, pos_j = index[names[j]]
+            if seq_j == seq and abs(pos_j - pos) <= window_size:
+                continue
+            pairs.append((name, names[j]))
+            num_found += 1
+            if num_found == num_loc:
+                break
+    return pairs
+
+
+def main(
+    output: Path,
+    image_list: Optional[Union[Path, List[str]]] = None,
+    features: Optional[Path] = None,
+    window_size: int = 10,
+    quadratic_overlap: bool = True,
+    use_loop_closure: bool = False,
+    retrieval_path: Optional[Path] = None,
+    retrieval_interval: int = 2,
+    num_loc: int = 5,
+    min_score: Optional[float] = 0,
+):
+    """Pairs for ordered image sequences, e.g. frames extracted from videos.
+
+    Images are grouped into sequences by directory and ordered by name within
+    each sequence. Each frame is matched to the next window_size frames and,
+    with quadratic_overlap, to frames at exponentially increasing offsets.
+    With use_loop_closure, every retrieval_interval-th frame is also matched to
+    its num_loc most similar frames according to the global descriptors in
+    retrieval_path, in any sequence, to close loops and connect sequences.
+    """
+    if image_list is not None:
+        if isinstance(image_list, (str, Path)):
+            names = parse_image_lists(image_list)
+        elif isinstance(image_list, collections.Iterable):
+            names = list(image_list)
+        else:
+            raise ValueError(f"Unknown type for image list: {image_list}")
+    elif features is not None:
+        names = list_h5_names(features)
+    else:
+        raise ValueError("Provide either a list of images or a feature file.")
+    if use_loop_closure and retrieval_path is None:
+        raise ValueError("Loop closure requires the global descriptors.")
+
+    sequences = split_sequences(names)
+    index = {n: (s, i) for s, seq in enumerate(sequences) for i, n in enumerate(seq)}
+    pairs = []
+    for seq in sequences:
+        offsets = sequence_offsets(len(seq), window_size, quadratic_overlap)
+        for i, name in enumerate(seq):
+            pairs += [(name, seq[i + o]) for o in offsets if i + o < len(seq)]
+    num_sequential = len(pairs)
+
+    if use_loop_closure:
+        names = [n for seq in sequences for n in seq]
+        pairs += loop_closure_pairs(
+            names,
+            index,
+            retrieval_path,
+            window_size,
+            retrieval_interval,
+            num_loc,
+            min_score,
+        )
+
+    # Remove duplicates, including pairs retrieved in both directions.
+    unique = {}
+    for i, j in pairs:
+        if (j, i) not in unique:
+            unique[i, j] = None
+    pairs = list(unique)
+
+    num_exhaustive = len(names) * (len(names) - 1) // 2
+    logger.info(
+        f"Found {len(pairs)} pairs ({num_sequential} sequential) "
+        f"in {len(sequences)} sequences, vs {num_exhaustive} exhaustive pairs."
+    )
+    with open(output, "w") as f:
+        f.write("\n".join(" ".join([i, j]) for i, j in pairs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", required=True, type=Path)
+    parser.add_argument("--image_list", type=Path)
+    parser.add_argument("--features", type=Path)
+    parser.add_argument("--window_size", type=int, default=10)
+    parser.add_argument(
+        "--no_quadratic_overlap", dest="quadratic_overlap", action="store_false"
+    )
+    parser.add_argument("--use_loop_closure", action="store_true")
+    parser.add_argument("--retrieval_path", type=Path)
+    parser.add_argument("--retrieval_interval", type=int, default=2)
+    parser.add_argument("--num_loc", type=int, default=5)
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -62,11 +62,13 @@ def incremental_mapping(
     image_dir: Path,
     sfm_path: Path,
     options: Optional[Dict[str, Any]] = None,
+    input_path: Optional[Path] = None,
 ) -> dict[int, pycolmap.Reconstruction]:
-    num_images = pycolmap.Database(database_path).num_images
+    with open_colmap_database(database_path) as db:
+        num_images = db.num_images()
     pbars = []
 
-    def restart_progress_bar():
+    def restart_progress_bar(num_registered: int = 2):
         if len(pbars) > 0:
             pbars[-1].close()
         pbars.append(
@@ -77,13 +79,18 @@ def incremental_mapping(
                 postfix="registered",
             )
         )
-        pbars[-1].update(2)
+        pbars[-1].update(num_registered)
+
+    if input_path is not None:
+        # The mapper continues the given reconstruction without an initial pair.
+        restart_progress_bar(pycolmap.Reconstruction(input_path).num_reg_images())
 
     reconstructions = pycolmap.incremental_mapping(
         database_path,
         image_dir,
         sfm_path,
         options=options or {},
+        input_path=input_path or "",
         initial_image_pair_callback=restart_progress_bar,
         next_image_callback=lambda: pbars[-1].update(1),
     )
@@ -97,6 +104,7 @@ def run_reconstruction(
     image_dir: Path,
     verbose: bool = False,
     options: Optional[Dict[str, Any]] = None,
+    input_path: Optional[Path] = None,
 ) -> pycolmap.Reconstruction:
     models_path = sfm_dir / "models"
     models_path.mkdir(exist_ok=True, parents=True)
@@ -107,7 +115,7 @@ def run_reconstruction(
 
     with OutputCapture(verbose):
         reconstructions = incremental_mapping(
-            database_path, image_dir, models_path, options=options
+            database_path, image_dir, models_path, options, input_path
         )
 
     if len(reconstructions) == 0:
@@ -127,6 +135,10 @@ def run_reconstruction(
         f"Largest model is #{largest_index} " f"with {largest_num_images} images."
     )
 
+    model_path = models_path / str(largest_index)
+    if input_path is not None:
+        # A continued reconstruction is written directly to the output path.
+        model_path = models_path
     for filename in [
         "images.bin",
         "cameras.bin",
@@ -136,7 +148,7 @@ def run_reconstruction(
     ]:
         if (sfm_dir / filename).exists():
             (sfm_dir / filename).unlink()
-        shutil.move(str(models_path / str(largest_index) / filename), str(sfm_dir))
+        shutil.move(str(model_path / filename), str(sfm_dir))
     return reconstructions[largest_index]
 
 
@@ -190,6 +202,71 @@ def main(
     return reconstruction
 
 
+def extend(
+    sfm_dir: Path,
+    image_dir: Path,
+    pairs: Path,
+    features: Path,
+    matches: Path,
+    image_list: List[str],
+    camera_mode: pycolmap.CameraMode = pycolmap.CameraMode.AUTO,
+    verbose: bool = False,
+    skip_geometric_verification: bool = False,
+    min_match_score: Optional[float] = None,
+    image_options: Optional[Dict[str, Any]] = None,
+    mapper_options: Optional[Dict[str, Any]] = None,
+) -> pycolmap.Reconstruction:
+    """Register new images into an existing reconstruction and triangulate them.
+
+    The database and the model written to sfm_dir by main or triangulation.main
+    are reused: only the images of image_list that are not in the database yet
+    are imported, with their features and the matches of the given pairs. The
+    pairs should connect the new images to each other and to their neighbors in
+    the model, and must not contain pairs already in the database. The mapper
+    then continues from the existing model, whose frames are kept fixed unless
+    mapper_options sets fix_existing_frames=False.
+    """
+    assert features.exists(), features
+    assert pairs.exists(), pairs
+    assert matches.exists(), matches
+    database = sfm_dir / "database.db"
+    assert database.exists(), database
+
+    known_ids = get_image_ids(database)
+    new_images = [n for n in image_list if n not in known_ids]
+    if len(new_images) == 0:
+        logger.info("All the images are already in the database.")
+        return pycolmap.Reconstruction(sfm_dir)
+    logger.info(f"Extending the reconstruction with {len(new_images)} images.")
+
+    import_images(image_dir, database, camera_mode, new_images, image_options)
+    image_ids = get_image_ids(database)
+    with open_colmap_database(database) as db:
+        import_features({n: image_ids[n] for n in new_images}, db, features)
+        import_matches(
+            image_ids,
+            db,
+            pairs,
+            matches,
+            min_match_score,
+            skip_geometric_verification,
+        )
+    if not skip_geometric_verification:
+        estimation_and_geometric_verification(database, pairs, verbose)
+    mapper_options = {"fix_existing_frames": True, **(mapper_options or {})}
+    reconstruction = run_reconstruction(
+        sfm_dir, database, image_dir, verbose, mapper_options, input_path=sfm_dir
+    )
+    if reconstruction is not None:
+        registered = {image.name for image in reconstruction.images.values()}
+        logger.info(
+            f"Reconstruction statistics:\n{reconstruction.summary()}"
+            + f"\n\tnum_new_images = {len(new_images)}"
+            + f"\n\tnum_new_registered = {len(registered & set(new_images))}"
+        )
+    return reconstruction
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--sfm_dir", type=Path, required=True)
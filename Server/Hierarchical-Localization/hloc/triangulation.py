@@ -1,14 +1,22 @@
 import argparse
+import contextlib
+import multiprocessing
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pycolmap
 from tqdm import tqdm
 
 from . import logger
-from .utils.geometry import compute_epipolar_errors
-from .utils.io import get_keypoints, get_matches, open_colmap_database
+from .utils.geometry import epipolar_errors
+from .utils.io import (
+    open_colmap_database,
+    open_h5_or_packed,
+    read_keypoints,
+    read_matches,
+)
 from .utils.parsers import parse_retrieval
 
 
@@ -44,14 +52,67 @@ def create_db_from_model(
     return {image.name: image_id for image_id, image in reconstruction.images.items()}
 
 
+_reader = None
+_reader_files = contextlib.ExitStack()
+
+
+def _init_reader(read_fn, path: Path):
+    global _reader
+    # The file stays open for the lifetime of the worker process.
+    fd = _reader_files.enter_context(open_h5_or_packed(path))
+    _reader = partial(read_fn, fd)
+
+
+def _read(item):
+    return _reader(item)
+
+
+@contextlib.contextmanager
+def map_file_entries(
+    read_fn, path: Path, items: list, num_workers: Optional[int], chunksize: int = 64
+):
+    """Iterate read_fn(fd, item) over items in order, with fd an open file.
+
+    With several workers, each process opens the file once and the entries are
+    read and decoded in parallel while the caller consumes them.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if min(num_workers, len(items)) > 1:
+        with multiprocessing.Pool(num_workers, _init_reader, (read_fn, path)) as pool:
+            yield pool.imap(_read, items, chunksize)
+    else:
+        with open_h5_or_packed(path) as fd:
+            yield (read_fn(fd, item) for item in items)
+
+
+def _read_colmap_keypoints(fd, name: str) -> np.ndarray:
+    keypoints = read_keypoints(fd, name)
+    keypoints += 0.5  # COLMAP origin
+    return keypoints
+
+
+def _read_filtered_matches(fd, task: Tuple[str, str, Optional[float]]):
+    name0, name1, min_match_score = task
+    matches, scores = read_matches(fd, name0, name1)
+    if min_match_score:
+        matches = matches[scores > min_match_score]
+    return matches
+
+
 def import_features(
-    image_ids: Dict[str, int], db: pycolmap.Database, features_path: Path
+    image_ids: Dict[str, int],
+    db: pycolmap.Database,
+    features_path: Path,
+    num_workers: Optional[int] = None,
 ):
     logger.info("Importing features into the database...")
-    for image_name, image_id in tqdm(image_ids.items()):
-        keypoints = get_keypoints(features_path, image_name)
-        keypoints += 0.5  # COLMAP origin
-        db.write_keypoints(image_id, keypoints)
+    names = list(image_ids)
+    with map_file_entries(
+        _read_colmap_keypoints, features_path, names, num_workers
+    ) as keypoints, pycolmap.DatabaseTransaction(db):
+        for name, kps in zip(names, tqdm(keypoints, total=len(names))):
+            db.write_keypoints(image_ids[name], kps)
 
 
 def import_matches(
@@ -61,27 +122,33 @@ def import_matches(
     matches_path: Path,
     min_match_score: Optional[float] = None,
     skip_geometric_verification: bool = False,
+    num_workers: Optional[int] = None,
 ):
     logger.info("Importing matches into the database...")
 
     with open(str(pairs_path), "r") as f:
         pairs = [p.split() for p in f.readlines()]
 
-    matched = set()
-    for name0, name1 in tqdm(pairs):
-        id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
-            continue
-        matches, scores = get_matches(matches_path, name0, name1)
-        if min_match_score:
-            matches = matches[scores > min_match_score]
-        db.write_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
-
-        if skip_geometric_verification:
-            db.write_two_view_geometry(
-                id0, id1, pycolmap.TwoViewGeometry(inlier_matches=matches)
-            )
+    # Keep the first occurrence of each pair, in any direction.
+    ids = np.array([[image_ids[i], image_ids[j]] for i, j in pairs], np.int64)
+    ids = ids.reshape(-1, 2)
+    _, first = np.unique(np.sort(ids, axis=1), axis=0, return_index=True)
+    first = np.sort(first)
+    tasks = [(*pairs[i], min_match_score) for i in first]
+
+    with map_file_entries(
+        _read_filtered_matches, matches_path, tasks, num_workers
+    ) as all_matches, pycolmap.DatabaseTransaction(db):
+        for (id0, id1), matches in zip(
+            ids[first].tolist(), tqdm(all_matches, total=len(tasks))
+        ):
+            db.write_matches(id0, id1, matches)
+            if skip_geometric_verification:
+                geometry = pycolmap.TwoViewGeometry(
+                    inlier_matches=matches,
+                    config=pycolmap.TwoViewGeometryConfiguration.UNCALIBRATED,
+                )
+                db.write_two_view_geometry(id0, id1, geometry)
 
 
 def estimation_and_geometric_verification(
@@ -96,6 +163,92 @@ def estimation_and_geometric_verification(
         )
 
 
+class PairVerifier:
+    """Checks the matches of an image against the epipolar geometry of the model.
+
+    The matches of all the pairs of an image are verified in one batch, the
+    normalized keypoints of the most recently used images are cached, and the
+    feature and match files stay open, so that each process of a pool only
+    reads every file entry once in the common case.
+    """
+
+    def __init__(
+        self,
+        features_path: Path,
+        matches_path: Path,
+        cameras: Dict[str, pycolmap.Camera],
+        poses: Dict[str, pycolmap.Rigid3d],
+        max_error: float,
+        cache_size: int = 1024,
+    ):
+        self.cameras = cameras
+        self.poses = poses
+        self.max_error = max_error
+        self.files = contextlib.ExitStack()
+        self.features = self.files.enter_context(open_h5_or_packed(features_path))
+        self.matches = self.files.enter_context(open_h5_or_packed(matches_path))
+        self.keypoints = lru_cache(maxsize=cache_size)(self.read_keypoints)
+
+    def close(self):
+        self.files.close()
+
+    def read_keypoints(self, name: str) -> Tuple[np.ndarray, float]:
+        """Keypoints in normalized camera coordinates and the error threshold."""
+        kps, noise = read_keypoints(self.features, name, return_uncertainty=True)
+        noise = 1.0 if noise is None else noise
+        cam = self.cameras[name]
+        if len(kps) > 0:
+            kps = np.stack(cam.cam_from_img(kps))
+        else:
+            kps = np.zeros((0, 2))
+        return kps, cam.cam_from_img_threshold(noise * self.max_error)
+
+    def __call__(self, task: Tuple[str, List[str]]):
+        """Inlier matches of each pair (name0, name1) and its number of matches."""
+        name0, names1 = task
+        kps0, threshold0 = self.keypoints(name0)
+        world_from_cam0 = self.poses[name0].inverse()
+        matches = [read_matches(self.matches, name0, n)[0] for n in names1]
+        sizes = np.array([len(m) for m in matches])
+
+        essentials, p2d0, p2d1, thresholds1 = [], [], [], []
+        for name1, m in zip(names1, matches):
+            if len(m) == 0:
+                continue
+            kps1, threshold1 = self.keypoints(name1)
+            cam1_from_cam0 = self.poses[name1] * world_from_cam0
+            essentials.append(pycolmap.essential_matrix_from_pose(cam1_from_cam0))
+            p2d0.append(kps0[m[:, 0]])
+            p2d1.append(kps1[m[:, 1]])
+            thresholds1.append(threshold1)
+        if len(essentials) == 0:
+            return [(n, m, 0) for n, m in zip(names1, matches)]
+
+        nonempty = sizes[sizes > 0]
+        errors0, errors1 = epipolar_errors(
+            np.repeat(np.stack(essentials), nonempty, axis=0),
+            np.concatenate(p2d0),
+            np.concatenate(p2d1),
+        )
+        valid = np.logical_and(
+            errors0 <= threshold0, errors1 <= np.repeat(thresholds1, nonempty)
+        )
+        valid = np.split(valid, np.cumsum(sizes)[:-1])
+        return [(n, m[v], len(m)) for n, m, v in zip(names1, matches, valid)]
+
+
+_verifier = None
+
+
+def _init_verifier(*args):
+    global _verifier
+    _verifier = PairVerifier(*args)
+
+
+def _verify(task):
+    return _verifier(task)
+
+
 def geometric_verification(
     image_ids: Dict[str, int],
     reference: pycolmap.Reconstruction,
@@ -104,61 +257,69 @@ def geometric_verification(
     pairs_path: Path,
     matches_path: Path,
     max_error: float = 4.0,
+    num_workers: Optional[int] = None,
 ):
+    """Keep the matches that agree with the known poses of the reference model.
+
+    Pairs are grouped by their first image and the groups are verified by a
+    pool of num_workers processes (all cores by default), while the results are
+    written to the database by the calling process in the order of the pairs.
+    """
     logger.info("Performing geometric verification of the matches...")
 
     pairs = parse_retrieval(pairs_path)
 
-    inlier_ratios = []
+    tasks = {}
     matched = set()
-    for name0 in tqdm(pairs):
-        id0 = image_ids[name0]
-        image0 = reference.images[id0]
-        cam0 = reference.cameras[image0.camera_id]
-        kps0, noise0 = get_keypoints(features_path, name0, return_uncertainty=True)
-        noise0 = 1.0 if noise0 is None else noise0
-        if len(kps0) > 0:
-            kps0 = np.stack(cam0.cam_from_img(kps0))
-        else:
-            kps0 = np.zeros((0, 2))
-
-        for name1 in pairs[name0]:
-            id1 = image_ids[name1]
-            image1 = reference.images[id1]
-            cam1 = reference.cameras[image1.camera_id]
-            kps1, noise1 = get_keypoints(features_path, name1, return_uncertainty=True)
-            noise1 = 1.0 if noise1 is None else noise1
-            if len(kps1) > 0:
-                kps1 = np.stack(cam1.cam_from_img(kps1))
-            else:
-                kps1 = np.zeros((0, 2))
-
-            matches = get_matches(matches_path, name0, name1)[0]
-
+    for name0, names1 in pairs.items():
+        for name1 in names1:
+            id0, id1 = image_ids[name0], image_ids[name1]
             if len({(id0, id1), (id1, id0)} & matched) > 0:
                 continue
             matched |= {(id0, id1), (id1, id0)}
+            tasks.setdefault(name0, []).append(name1)
+    tasks = list(tasks.items())
+
+    names = {n for name0, names1 in tasks for n in [name0, *names1]}
+    images = {n: reference.images[image_ids[n]] for n in names}
+    cameras = {n: reference.cameras[image.camera_id] for n, image in images.items()}
+    poses = {n: image.cam_from_world() for n, image in images.items()}
+    args = (features_path, matches_path, cameras, poses, max_error)
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(tasks))
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, _init_verifier, args)
+        results = pool.imap(_verify, tasks, chunksize=4)
+    else:
+        pool = None
+        verifier = PairVerifier(*args)
+        results = map(verifier, tasks)
 
-            if matches.shape[0] == 0:
-                db.write_two_view_geometry(id0, id1, pycolmap.TwoViewGeometry())
-                continue
-
-            cam1_from_cam0 = image1.cam_from_world() * image0.cam_from_world().inverse()
-            errors0, errors1 = compute_epipolar_errors(
-                cam1_from_cam0, kps0[matches[:, 0]], kps1[matches[:, 1]]
-            )
-            valid_matches = np.logical_and(
-                errors0 <= cam0.cam_from_img_threshold(noise0 * max_error),
-                errors1 <= cam1.cam_from_img_threshold(noise1 * max_error),
-            )
-            # TODO: We could also add E to the database, but we need
-            # to reverse the transformations if id0 > id1 in utils/database.py.
-            db.write_two_view_geometry(
-                id0,
-                id1,
-                pycolmap.TwoViewGeometry(inlier_matches=matches[valid_matches, :]),
-            )
-            inlier_ratios.append(np.mean(valid_matches))
+    inlier_ratios = []
+    try:
+        for (name0, _), task_results in zip(tasks, tqdm(results, total=len(tasks))):
+            id0 = image_ids[name0]
+            for name1, inlier_matches, num_matches in task_results:
+                id1 = image_ids[name1]
+                if num_matches == 0:
+                    db.write_two_view_geometry(id0, id1, pycolmap.TwoViewGeometry())
+                    continue
+                # TODO: We could also add E to the database, but we need
+                # to reverse the transformations if id0 > id1 in utils/database.py.
+                # COLMAP ignores the inliers of geometries with an undefined config.
+                geometry = pycolmap.TwoViewGeometry(
+                    inlier_matches=inlier_matches,
+                    config=pycolmap.TwoViewGeometryConfiguration.CALIBRATED,
+                )
+                db.write_two_view_geometry(id0, id1, geometry)
+                inlier_ratios.append(len(inlier_matches) / num_matches)
+    finally:
+        if pool is None:
+            verifier.close()
+        else:
+            pool.terminate()
     logger.info(
         "mean/med/min/max valid matches %.2f/%.2f/%.2f/%.2f%%.",
         np.mean(inlier_ratios) * 100,
@@ -8,9 +8,23 @@ def to_homogeneous(p):
 
 def compute_epipolar_errors(j_from_i: pycolmap.Rigid3d, p2d_i, p2d_j):
     j_E_i = pycolmap.essential_matrix_from_pose(j_from_i)
-    l2d_j = to_homogeneous(p2d_i) @ j_E_i.T
-    l2d_i = to_homogeneous(p2d_j) @ j_E_i
-    dist = np.abs(np.sum(to_homogeneous(p2d_i) * l2d_i, axis=1))
+    return epipolar_errors(j_E_i, p2d_i, p2d_j)
+
+
+def epipolar_errors(j_E_i: np.ndarray, p2d_i, p2d_j):
+    """Point-to-line distances of N correspondences in normalized coordinates.
+
+    j_E_i is a (3, 3) essential matrix or a (N, 3, 3) stack with one matrix per
+    correspondence, so that the matches of several pairs are processed at once.
+    """
+    p2d_i, p2d_j = to_homogeneous(p2d_i), to_homogeneous(p2d_j)
+    if j_E_i.ndim == 2:
+        l2d_j = p2d_i @ j_E_i.T
+        l2d_i = p2d_j @ j_E_i
+    else:
+        l2d_j = np.einsum("nkl,nl->nk", j_E_i, p2d_i)
+        l2d_i = np.einsum("nlk,nl->nk", j_E_i, p2d_j)
+    dist = np.abs(np.sum(p2d_i * l2d_i, axis=1))
     errors_i = dist / np.linalg.norm(l2d_i[:, :2], axis=1)
     errors_j = dist / np.linalg.norm(l2d_j[:, :2], axis=1)
     return errors_i, errors_j
@@ -1,17 +1,43 @@
 import contextlib
+import json
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
 from pathlib import Path
-from typing import ContextManager, Mapping, Tuple
+from queue import Queue
+from threading import Thread
+from typing import Any, ContextManager, Mapping, Tuple
 
 import cv2
 import h5py
 import numpy as np
 import pycolmap
 
+from .packed import PackedStore, is_packed, open_packed
 from .parsers import names_to_pair, names_to_pair_old
 
+logger = logging.getLogger(__name__)
 
-def read_image(path, grayscale=False):
-    if grayscale:
+
+REDUCED_MODES = {
+    (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+    (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def read_image(path, grayscale=False, reduce=1):
+    """Read an image as uint8, optionally decoded at 1/reduce of its size.
+
+    For JPEG images the reduced decoding is done in the DCT domain by libjpeg,
+    which is much cheaper than decoding at full resolution and resizing.
+    """
+    if reduce > 1:
+        mode = REDUCED_MODES[grayscale, reduce]
+    elif grayscale:
         mode = cv2.IMREAD_GRAYSCALE
     else:
         mode = cv2.IMREAD_COLOR
@@ -23,23 +49,45 @@ def read_image(path, grayscale=False):
     return image
 
 
-def list_h5_names(path):
+@lru_cache(maxsize=16)
+def _list_h5_names(path: str, mtime_ns: int, size: int) -> Tuple[str]:
     names = []
-    with h5py.File(str(path), "r", libver="latest") as fd:
+    with h5py.File(path, "r", libver="latest") as fd:
+        # Low-level visit: no Python object is created for each HDF5 object.
+        def visit_fn(name, info):
+            if info.type == h5py.h5o.TYPE_DATASET:
+                names.append(name.decode("utf-8").rpartition("/")[0])
 
-        def visit_fn(_, obj):
-            if isinstance(obj, h5py.Dataset):
-                names.append(obj.parent.name.strip("/"))
+        h5py.h5o.visit(fd.id, visit_fn, info=True)
+    return tuple(set(names))
 
-        fd.visititems(visit_fn)
-    return list(set(names))
 
+def list_h5_names(path):
+    """Names of the groups that hold datasets, cached until the file changes."""
+    if is_packed(path):
+        return list(open_packed(path).names)
+    path = Path(path)
+    stat = path.stat()
+    return list(_list_h5_names(str(path.resolve()), stat.st_mtime_ns, stat.st_size))
 
-def get_keypoints(
-    path: Path, name: str, return_uncertainty: bool = False
-) -> np.ndarray:
-    with h5py.File(str(path), "r", libver="latest") as hfile:
-        dset = hfile[name]["keypoints"]
+
+@contextlib.contextmanager
+def open_h5_or_packed(path: Path):
+    """Open an HDF5 file or a packed store for reading many entries."""
+    if is_packed(path):
+        yield open_packed(path)
+    else:
+        with h5py.File(str(path), "r", libver="latest") as hfile:
+            yield hfile
+
+
+def read_keypoints(fd, name: str, return_uncertainty: bool = False):
+    """Keypoints of an image from an open HDF5 file or packed store."""
+    if isinstance(fd, PackedStore):
+        p = fd.get(name, "keypoints")
+        uncertainty = fd.get_attr(name, "keypoints", "uncertainty")
+    else:
+        dset = fd[name]["keypoints"]
         p = dset.__array__()
         uncertainty = dset.attrs.get("uncertainty")
     if return_uncertainty:
@@ -47,6 +95,13 @@ def get_keypoints(
     return p
 
 
+def get_keypoints(
+    path: Path, name: str, return_uncertainty: bool = False
+) -> np.ndarray:
+    with open_h5_or_packed(path) as fd:
+        return read_keypoints(fd, name, return_uncertainty)
+
+
 def find_pair(hfile: h5py.File, name0: str, name1: str):
     pair = names_to_pair(name0, name1)
     if pair in hfile:
@@ -67,11 +122,15 @@ def find_pair(hfile: h5py.File, name0: str, name1: str):
     )
 
 
-def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
-    with h5py.File(str(path), "r", libver="latest") as hfile:
-        pair, reverse = find_pair(hfile, name0, name1)
-        matches = hfile[pair]["matches0"].__array__()
-        scores = hfile[pair]["matching_scores0"].__array__()
+def read_matches(fd, name0: str, name1: str) -> Tuple[np.ndarray]:
+    """Matches of a pair from an open HDF5 file or packed store."""
+    pair, reverse = find_pair(fd, name0, name1)
+    if isinstance(fd, PackedStore):
+        matches = fd.get(pair, "matches0")
+        scores = fd.get(pair, "matching_scores0")
+    else:
+        matches = fd[pair]["matches0"].__array__()
+        scores = fd[pair]["matching_scores0"].__array__()
     idx = np.where(matches != -1)[0]
     matches = np.stack([idx, matches[idx]], -1)
     if reverse:
@@ -80,6 +139,96 @@ def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
     return matches, scores
 
 
+def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
+    with open_h5_or_packed(path) as fd:
+        return read_matches(fd, name0, name1)
+
+
+class BatchedH5Writer(ABC):
+    """Single writer that owns an HDF5 file and commits groups in batches.
+
+    Items (name, data) are queued by the producer and written by one background
+    thread through a single open handle, instead of reopening the file for
+    every group. The names of the batch being written are journaled in the file
+    attributes until the batch is flushed, so that groups left over by an
+    interrupted run are discarded when the file is opened again.
+    Subclasses implement write(name, data).
+    """
+
+    pending_key = "pending_groups"
+
+    def __init__(self, path: Path, flush_every: int = 64):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self.fd = h5py.File(str(path), "a", libver="latest")
+        self.recover()
+        self.buffer = []
+        self.error = None
+        self.queue = Queue(2 * self.flush_every)
+        self.thread = Thread(target=self.thread_fn)
+        self.thread.start()
+
+    def recover(self):
+        pending = self.fd.attrs.get(self.pending_key)
+        if pending is None:
+            return
+        pending = json.loads(pending)
+        logger.warning(
+            f"Discarding {len(pending)} uncommitted groups from an interrupted run."
+        )
+        for name in pending:
+            if name in self.fd:
+                del self.fd[name]
+        del self.fd.attrs[self.pending_key]
+        self.fd.flush()
+
+    def thread_fn(self):
+        item = self.queue.get()
+        while item is not None:
+            if self.error is None:
+                try:
+                    self.buffer.append(item)
+                    if len(self.buffer) >= self.flush_every:
+                        self.flush()
+                except Exception as error:
+                    self.error = error
+            item = self.queue.get()
+        if self.error is None:
+            try:
+                self.flush()
+            except Exception as error:
+                self.error = error
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        self.fd.attrs[self.pending_key] = json.dumps([n for n, _ in self.buffer])
+        self.fd.flush()
+        for name, data in self.buffer:
+            if name in self.fd:
+                del self.fd[name]
+            self.write(name, data)
+        del self.fd.attrs[self.pending_key]
+        self.fd.flush()
+        self.buffer = []
+
+    @abstractmethod
+    def write(self, name: str, data: Any):
+        """Write the group name to self.fd."""
+
+    def put(self, item: Tuple[str, Any]):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def join(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fd.close()
+        if self.error is not None:
+            raise self.error
+
+
 def write_poses(
     poses: Mapping[str, pycolmap.Rigid3d], path: str, prepend_camera_name: bool
 ):
@@ -0,0 +1,266 @@
+"""Consolidated storage of features and matches.
+
+The HDF5 layout used by hloc stores one group per image or pair, so the file
+metadata dominates for large databases. A packed store is a directory with one
+contiguous array per key (keypoints, descriptors, matches0, ...) and an offset
+table that maps each image or pair name to its slice of the arrays:
+
+    features.packed/
+        index.json              names, dtypes and per-entry attributes
+        keypoints.npy           all keypoints, concatenated along the first axis
+        keypoints.offsets.npy   (num_entries + 1,) offsets into keypoints.npy
+        ...
+
+Arrays are memory-mapped, so opening a store only parses the index and reads
+hit the OS page cache. Descriptors are stored as (N, D) so that the descriptors
+of one image are contiguous, and are transposed back to (D, N) when read.
+
+A store is written under a temporary name and moved in place, so that a store
+that is already open keeps its memory maps when it is rewritten.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import h5py
+import numpy as np
+
+SUFFIX = ".packed"
+INDEX_NAME = "index.json"
+TRANSPOSED_KEYS = {"descriptors"}
+
+
+def is_packed(path) -> bool:
+    path = Path(path)
+    return path.suffix == SUFFIX or (path / INDEX_NAME).exists()
+
+
+class PackedStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / INDEX_NAME, "r") as f:
+            index = json.load(f)
+        self.names = index["names"]
+        self.keys = index["keys"]
+        for info in self.keys.values():
+            info["missing"] = set(info["missing"])
+        self.attrs = index["attrs"]
+        self.name2idx = {n: i for i, n in enumerate(self.names)}
+        self.data = {}
+        self.offsets = {}
+        for key in self.keys:
+            self.data[key] = np.load(self.path / f"{key}.npy", mmap_mode="r")
+            self.offsets[key] = np.load(self.path / f"{key}.offsets.npy")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name2idx
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def has(self, name: str, key: str) -> bool:
+        return key in self.keys and self.name2idx[name] not in self.keys[key]["missing"]
+
+    def get(self, name: str, key: str) -> np.ndarray:
+        idx = self.name2idx[name]
+        info = self.keys[key]
+        if idx in info["missing"]:
+            raise KeyError(f"No {key} for {name} in {self.path}.")
+        start, end = self.offsets[key][idx : idx + 2]
+        array = np.array(self.data[key][start:end])
+        if info["scalar"]:
+            return array[0]
+        if info["transposed"]:
+            array = array.T
+        return array
+
+    def get_attr(self, name: str, key: str, attr: str, default=None):
+        values = self.attrs.get(key, {}).get(attr)
+        if values is None:
+            return default
+        value = values[self.name2idx[name]]
+        return default if value is None else value
+
+    def group(self, name: str) -> Dict[str, np.ndarray]:
+        return {k: self.get(name, k) for k in self.keys if self.has(name, k)}
+
+
+@lru_cache(maxsize=8)
+def _open_packed(path: str, version: Tuple[int, int]) -> PackedStore:
+    return PackedStore(path)
+
+
+def open_packed(path: Path) -> PackedStore:
+    """Open a packed store, reusing the handle until its index changes."""
+    path = Path(path)
+    stat = (path / INDEX_NAME).stat()
+    return _open_packed(str(path.resolve()), (stat.st_mtime_ns, stat.st_size))
+
+
+def _replace_dir(src: Path, dst: Path):
+    """Move the directory src to dst, replacing any existing dst.
+
+    The files of the old dst are unlinked, not truncated, so that they remain
+    valid for the processes that still map them.
+    """
+    if not dst.exists():
+        os.rename(src, dst)
+        return
+    old = dst.with_name(f"{dst.name}.{os.getpid()}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    os.rename(dst, old)
+    os.rename(src, dst)
+    shutil.rmtree(old)
+
+
+def write_packed(
+    path: Path,
+    entries: List[Tuple[str, Dict[str, Tuple[tuple, np.dtype]]]],
+    read_fn,
+):
+    """Write a packed store in two passes.
+
+    entries lists the name of each image or pair and the shape and dtype of
+    each of its arrays, so that all output arrays can be preallocated.
+    read_fn(name) then yields (key, array, attrs) for every array of an entry.
+    The store is built next to path and replaces any existing store once done.
+    """
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    names = [name for name, _ in entries]
+    keys = {}
+    for _, shapes in entries:
+        for key, (shape, dtype) in shapes.items():
+            if key not in keys:
+                keys[key] = {
+                    "dtype": np.dtype(dtype),
+                    "shape": tuple(shape[::-1] if key in TRANSPOSED_KEYS else shape),
+                    "scalar": len(shape) == 0,
+                    "transposed": key in TRANSPOSED_KEYS,
+                }
+
+    offsets = {k: np.zeros(len(entries) + 1, dtype=np.int64) for k in keys}
+    missing = {k: [] for k in keys}
+    for idx, (_, shapes) in enumerate(entries):
+        for key, info in keys.items():
+            if key not in shapes:
+                size = 0
+                missing[key].append(idx)
+            elif info["scalar"]:
+                size = 1
+            else:
+                size = shapes[key][0][-1 if info["transposed"] else 0]
+            offsets[key][idx + 1] = offsets[key][idx] + size
+
+    arrays = {}
+    for key, info in keys.items():
+        tail = () if info["scalar"] else info["shape"][1:]
+        arrays[key] = np.lib.format.open_memmap(
+            tmp / f"{key}.npy",
+            mode="w+",
+            dtype=info["dtype"],
+            shape=(int(offsets[key][-1]),) + tail,
+        )
+        np.save(tmp / f"{key}.offsets.npy", offsets[key])
+
+    attrs = {}
+    for idx, name in enumerate(names):
+        for key, array, array_attrs in read_fn(name):
+            array = np.asarray(array)
+            if keys[key]["scalar"]:
+                array = array.reshape(1)
+            elif keys[key]["transposed"]:
+                array = array.T
+            arrays[key][offsets[key][idx] : offsets[key][idx + 1]] = array
+            for attr, value in array_attrs.items():
+                values = attrs.setdefault(key, {}).setdefault(attr, [None] * len(names))
+                values[idx] = value.item() if isinstance(value, np.generic) else value
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    index = {
+        "names": names,
+        "keys": {
+            k: {
+                "dtype": v["dtype"].str,
+                "scalar": v["scalar"],
+                "transposed": v["transposed"],
+                "missing": missing[k],
+            }
+            for k, v in keys.items()
+        },
+        "attrs": attrs,
+    }
+    with open(tmp / INDEX_NAME, "w") as f:
+        json.dump(index, f)
+    _replace_dir(tmp, path)
+    return path
+
+
+def _list_h5_groups(fd: h5py.File) -> Dict[str, h5py.Group]:
+    groups = {}
+
+    def visit_fn(_, obj):
+        if isinstance(obj, h5py.Dataset):
+            groups.setdefault(obj.parent.name.strip("/"), obj.parent)
+
+    fd.visititems(visit_fn)
+    return groups
+
+
+def h5_to_packed(h5_path: Path, packed_path: Path) -> Path:
+    """Convert an hloc feature or match file into a packed store."""
+    with h5py.File(str(h5_path), "r", libver="latest") as fd:
+        groups = _list_h5_groups(fd)
+        entries = [
+            (
+                name,
+                {
+                    k: (v.shape, v.dtype)
+                    for k, v in grp.items()
+                    if isinstance(v, h5py.Dataset)
+                },
+            )
+            for name, grp in sorted(groups.items())
+        ]
+
+        def read_fn(name):
+            for k, v in groups[name].items():
+                if isinstance(v, h5py.Dataset):
+                    yield k, v[()], dict(v.attrs)
+
+        return write_packed(packed_path, entries, read_fn)
+
+
+def packed_to_h5(packed_path: Path, h5_path: Path) -> Path:
+    """Convert a packed store back into the one-group-per-entry HDF5 layout."""
+    store = PackedStore(packed_path)
+    with h5py.File(str(h5_path), "w", libver="latest") as fd:
+        for name in store.names:
+            grp = fd.create_group(name)
+            for key, array in store.group(name).items():
+                dset = grp.create_dataset(key, data=array)
+                for attr in store.attrs.get(key, {}):
+                    value = store.get_attr(name, key, attr)
+                    if value is not None:
+                        dset.attrs[attr] = value
+    return h5_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=Path, required=True)
+    parser.add_argument("--output", type=Path, required=True)
+    args = parser.parse_args()
+    if is_packed(args.input):
+        packed_to_h5(args.input, args.output)
+    else:
+        h5_to_packed(args.input, args.output)
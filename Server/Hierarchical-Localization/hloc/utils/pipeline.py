@@ -0,0 +1,160 @@
+"""Content-addressed cache for the artifacts of a multi-stage pipeline.
+
+Each stage writes one artifact (a file or a directory) whose name includes a
+fingerprint of everything the stage depends on: its configuration, the content
+of its input images and the names of the upstream artifacts, which themselves
+include the fingerprints of their inputs. A stage is skipped when its artifact
+already exists, so that changing the matcher configuration reruns the matching
+and the reconstruction but reuses the features. Artifacts are written under a
+temporary name and moved in place once the stage succeeds, so that an
+interrupted stage is never mistaken for a finished one. With prune=True, the
+artifacts of a stage that were superseded by the current one are removed.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from .. import __version__, logger
+
+
+def fingerprint(*inputs: Any) -> str:
+    """Hash of JSON-serializable inputs, independent of the order of dict keys."""
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class FileHashCache:
+    """Content hashes of files, reused while their size and mtime are unchanged."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def __call__(self, path: Path) -> str:
+        path = Path(path)
+        stat = path.stat()
+        key = str(path.resolve())
+        entry = self.entries.get(key)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        digest = hashlib.blake2b()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.entries[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self.entries[key][2]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f)
+
+
+class Pipeline:
+    """Runs the stages of one build in output_dir and records their timings."""
+
+    timings_name = "timings.json"
+
+    def __init__(self, output_dir: Path, key_length: int = 16, prune: bool = False):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.key_length = key_length
+        self.prune = prune
+        self.timings = []
+
+    def run(
+        self,
+        stage: str,
+        fn: Callable[[Path], Any],
+        inputs: Any,
+        suffix: str = "",
+    ) -> Path:
+        """Artifact of a stage, created by fn(path) unless it is already cached.
+
+        inputs must identify everything that the artifact depends on. Upstream
+        artifacts should be given by name, which already includes their key.
+        """
+        key = fingerprint(stage, __version__, inputs)[: self.key_length]
+        path = self.output_dir / f"{stage}-{key}{suffix}"
+        if path.exists():
+            logger.info(f"Stage {stage}: reusing {path.name}.")
+            self.timings.append({"stage": stage, "cached": True, "seconds": 0.0})
+            self.save_timings()
+            if self.prune:
+                self.prune_stage(stage, path, suffix)
+            return path
+
+        tmp = path.with_name(f"{path.name}.tmp")
+        if tmp.is_dir():
+            shutil.rmtree(tmp)
+        elif tmp.exists():
+            tmp.unlink()
+        logger.info(f"Stage {stage}: building {path.name}.")
+        tic = time.perf_counter()
+        fn(tmp)
+        os.replace(tmp, path)
+        duration = time.perf_counter() - tic
+        logger.info(f"Stage {stage}: finished in {duration:.1f}s.")
+        self.timings.append({"stage": stage, "cached": False, "seconds": duration})
+        self.save_timings()
+        if self.prune:
+            self.prune_stage(stage, path, suffix)
+        return path
+
+    def prune_stage(self, stage: str, current: Path, suffix: str = ""):
+        """Remove the artifacts of a stage other than the current one."""
+        pattern = re.compile(
+            rf"{re.escape(stage)}-[0-9a-f]{{{self.key_length}}}{re.escape(suffix)}"
+        )
+        for path in self.output_dir.iterdir():
+            if path != current and pattern.fullmatch(path.name):
+                logger.info(f"Stage {stage}: removing superseded {path.name}.")
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+
+    def save_timings(self):
+        with open(self.output_dir / self.timings_name, "w") as f:
+            json.dump(self.timings, f, indent=2)
+
+
+def run_parallel(
+    fn: Callable[..., Any], jobs: Dict[str, tuple], num_workers: Optional[int] = 1
+) -> Dict[str, Any]:
+    """Run fn(*args) for independent jobs {name: args} in worker processes.
+
+    A failed job is logged and reported as None, without stopping the others.
+    """
+    results = {}
+    if num_workers is not None and num_workers <= 1:
+        for name, args in jobs.items():
+            try:
+                results[name] = fn(*args)
+            except Exception:
+                logger.exception(f"Job {name} failed.")
+                results[name] = None
+        return results
+
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = {executor.submit(fn, *args): name for name, args in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception:
+                logger.exception(f"Job {name} failed.")
+                results[name] = None
+            else:
+                logger.info(f"Job {name} finished.")
+    return {name: results[name] for name in jobs}
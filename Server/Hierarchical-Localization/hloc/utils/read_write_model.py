@@ -238,49 +238,68 @@ def read_images_text(path):
     return images
 
 
+IMAGE_DTYPE = np.dtype(
+    [("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")]
+)
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+
+
+def read_images_binary_columnar(path_to_model_file):
+    """Read images.bin into arrays rather than one namedtuple per image.
+
+    The points2D of all images are concatenated: those of the i-th image are
+    xys[offsets[i]:offsets[i+1]] and point3D_ids[offsets[i]:offsets[i+1]].
+    """
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+    num_reg_images = struct.unpack_from("<Q", data, 0)[0]
+    headers = np.empty(num_reg_images, IMAGE_DTYPE)
+    names = []
+    points2D = []
+    offset = 8
+    for i in range(num_reg_images):
+        headers[i] = np.frombuffer(data, IMAGE_DTYPE, 1, offset)[0]
+        name_end = data.index(b"\x00", offset + IMAGE_DTYPE.itemsize)
+        names.append(data[offset + IMAGE_DTYPE.itemsize : name_end].decode("utf-8"))
+        num_points2D = struct.unpack_from("<Q", data, name_end + 1)[0]
+        offset = name_end + 9
+        points2D.append(np.frombuffer(data, POINT2D_DTYPE, num_points2D, offset))
+        offset += POINT2D_DTYPE.itemsize * num_points2D
+    offsets = np.zeros(num_reg_images + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in points2D], out=offsets[1:])
+    points2D = np.concatenate(points2D) if points2D else np.empty(0, POINT2D_DTYPE)
+    return {
+        "ids": headers["id"].astype(np.int64),
+        "qvecs": np.ascontiguousarray(headers["qvec"]),
+        "tvecs": np.ascontiguousarray(headers["tvec"]),
+        "camera_ids": headers["camera_id"].astype(np.int64),
+        "names": names,
+        "offsets": offsets,
+        "xys": np.ascontiguousarray(points2D["xy"]),
+        "point3D_ids": np.ascontiguousarray(points2D["point3D_id"]),
+    }
+
+
 def read_images_binary(path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
+    columns = read_images_binary_columnar(path_to_model_file)
+    offsets = columns["offsets"].tolist()
     images = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_reg_images):
-            binary_image_properties = read_next_bytes(
-                fid, num_bytes=64, format_char_sequence="idddddddi"
-            )
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":  # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8, format_char_sequence="Q")[
-                0
-            ]
-            x_y_id_s = read_next_bytes(
-                fid,
-                num_bytes=24 * num_points2D,
-                format_char_sequence="ddq" * num_points2D,
-            )
-            xys = np.column_stack(
-                [tuple(map(float, x_y_id_s[0::3])), tuple(map(float, x_y_id_s[1::3]))]
-            )
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id,
-                qvec=qvec,
-                tvec=tvec,
-                camera_id=camera_id,
-                name=image_name,
-                xys=xys,
-                point3D_ids=point3D_ids,
-            )
+    for i, image_id in enumerate(columns["ids"].tolist()):
+        start, end = offsets[i], offsets[i + 1]
+        images[image_id] = Image(
+            id=image_id,
+            qvec=columns["qvecs"][i],
+            tvec=columns["tvecs"][i],
+            camera_id=int(columns["camera_ids"][i]),
+            name=columns["names"][i],
+            xys=columns["xys"][start:end],
+            point3D_ids=columns["point3D_ids"][start:end],
+        )
     return images
 
 
@@ -318,25 +337,54 @@ def write_images_text(images, path):
             fid.write(" ".join(points_strings) + "\n")
 
 
+def write_images_binary_columnar(columns, path_to_model_file):
+    """Write images.bin from arrays as returned by read_images_binary_columnar."""
+    offsets = np.asarray(columns["offsets"], dtype=np.int64)
+    headers = np.empty(len(columns["names"]), IMAGE_DTYPE)
+    headers["id"] = columns["ids"]
+    headers["qvec"] = columns["qvecs"]
+    headers["tvec"] = columns["tvecs"]
+    headers["camera_id"] = columns["camera_ids"]
+    points2D = np.empty(offsets[-1], POINT2D_DTYPE)
+    points2D["xy"] = columns["xys"]
+    points2D["point3D_id"] = columns["point3D_ids"]
+
+    chunks = [struct.pack("<Q", len(headers))]
+    for i, name in enumerate(columns["names"]):
+        start, end = offsets[i], offsets[i + 1]
+        chunks.append(headers[i].tobytes())
+        chunks.append(name.encode("utf-8") + b"\x00")
+        chunks.append(struct.pack("<Q", end - start))
+        chunks.append(points2D[start:end].tobytes())
+    with open(path_to_model_file, "wb") as fid:
+        fid.write(b"".join(chunks))
+
+
 def write_images_binary(images, path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
-    with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(images), "Q")
-        for _, img in images.items():
-            write_next_bytes(fid, img.id, "i")
-            write_next_bytes(fid, img.qvec.tolist(), "dddd")
-            write_next_bytes(fid, img.tvec.tolist(), "ddd")
-            write_next_bytes(fid, img.camera_id, "i")
-            for char in img.name:
-                write_next_bytes(fid, char.encode("utf-8"), "c")
-            write_next_bytes(fid, b"\x00", "c")
-            write_next_bytes(fid, len(img.point3D_ids), "Q")
-            for xy, p3d_id in zip(img.xys, img.point3D_ids):
-                write_next_bytes(fid, [*xy, p3d_id], "ddq")
+    images = list(images.values())
+    offsets = np.zeros(len(images) + 1, dtype=np.int64)
+    np.cumsum([len(img.point3D_ids) for img in images], out=offsets[1:])
+    columns = {
+        "ids": [img.id for img in images],
+        "qvecs": np.array([img.qvec for img in images], np.float64).reshape(-1, 4),
+        "tvecs": np.array([img.tvec for img in images], np.float64).reshape(-1, 3),
+        "camera_ids": [img.camera_id for img in images],
+        "names": [img.name for img in images],
+        "offsets": offsets,
+        "xys": np.concatenate(
+            [np.reshape(img.xys, (-1, 2)) for img in images] + [np.empty((0, 2))]
+        ),
+        "point3D_ids": np.concatenate(
+            [np.asarray(img.point3D_ids, dtype=np.int64) for img in images]
+            + [np.empty(0, dtype=np.int64)]
+        ),
+    }
+    write_images_binary_columnar(columns, path_to_model_file)
 
 
 def read_points3D_text(path):
@@ -371,41 +419,105 @@ def read_points3D_text(path):
     return points3D
 
 
+POINT3D_DTYPE = np.dtype(
+    [
+        ("id", "<u8"),
+        ("xyz", "<f8", 3),
+        ("rgb", "u1", 3),
+        ("error", "<f8"),
+        ("track_length", "<u8"),
+    ]
+)
+
+
+def record_header_mask(size, starts, header_size):
+    """Mask of the bytes of the fixed-size headers of variable-length records."""
+    boundaries = np.zeros(size + 1, dtype=np.int8)
+    boundaries[starts] += 1
+    boundaries[starts + header_size] -= 1
+    return np.cumsum(boundaries[:-1], dtype=np.int8).astype(bool)
+
+
+def gather_bytes(raw, positions, size):
+    """Bytes raw[p : p + size] for each of the positions, as a (N, size) array."""
+    out = np.empty((len(positions), size), dtype=np.uint8)
+    for k in range(size):
+        out[:, k] = raw[positions + k]
+    return out
+
+
+def read_points3D_binary_columnar(path_to_model_file):
+    """Read points3D.bin into arrays rather than one namedtuple per point.
+
+    The tracks of all points are concatenated: the track of the i-th point is
+    image_ids[track_offsets[i]:track_offsets[i+1]] and the same for
+    point2D_idxs.
+
+    Records have a variable length, so their start offsets are still found by
+    a scalar scan with one Python iteration per point. Only the decoding of the
+    fields is vectorized.
+    """
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+    num_points = struct.unpack_from("<Q", data, 0)[0]
+
+    starts = np.empty(num_points, dtype=np.int64)
+    length_offset = POINT3D_DTYPE.fields["track_length"][1]
+    offset = 8
+    for i in range(num_points):
+        starts[i] = offset
+        track_length = struct.unpack_from("<Q", data, offset + length_offset)[0]
+        offset += POINT3D_DTYPE.itemsize + 8 * track_length
+
+    # Headers and track elements are gathered one byte column at a time, so
+    # that the temporary index arrays are as large as the points, not the file.
+    raw = np.frombuffer(data, dtype=np.uint8)
+    headers = gather_bytes(raw, starts, POINT3D_DTYPE.itemsize)
+    headers = headers.view(POINT3D_DTYPE).reshape(-1)
+    track_offsets = np.zeros(num_points + 1, dtype=np.int64)
+    np.cumsum(headers["track_length"], out=track_offsets[1:])
+    track_starts = starts + POINT3D_DTYPE.itemsize - 8 * track_offsets[:-1]
+    positions = np.repeat(track_starts, np.diff(track_offsets))
+    positions += 8 * np.arange(track_offsets[-1], dtype=np.int64)
+    tracks = gather_bytes(raw, positions, 8).view("<i4")
+    return {
+        "ids": headers["id"].astype(np.int64),
+        "xyz": np.ascontiguousarray(headers["xyz"]),
+        "rgb": np.ascontiguousarray(headers["rgb"]),
+        "errors": np.ascontiguousarray(headers["error"]),
+        "track_offsets": track_offsets,
+        "image_ids": np.ascontiguousarray(tracks[:, 0]),
+        "point2D_idxs": np.ascontiguousarray(tracks[:, 1]),
+    }
+
+
 def read_points3D_binary(path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
+    columns = read_points3D_binary_columnar(path_to_model_file)
+    image_ids = columns["image_ids"].astype(np.int64)
+    point2D_idxs = columns["point2D_idxs"].astype(np.int64)
+    offsets = columns["track_offsets"].tolist()
     points3D = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_points = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_points):
-            binary_point_line_properties = read_next_bytes(
-                fid, num_bytes=43, format_char_sequence="QdddBBBd"
-            )
-            point3D_id = binary_point_line_properties[0]
-            xyz = np.array(binary_point_line_properties[1:4])
-            rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
-            track_length = read_next_bytes(fid, num_bytes=8, format_char_sequence="Q")[
-                0
-            ]
-            track_elems = read_next_bytes(
-                fid,
-                num_bytes=8 * track_length,
-                format_char_sequence="ii" * track_length,
-            )
-            image_ids = np.array(tuple(map(int, track_elems[0::2])))
-            point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-            points3D[point3D_id] = Point3D(
-                id=point3D_id,
-                xyz=xyz,
-                rgb=rgb,
-                error=error,
-                image_ids=image_ids,
-                point2D_idxs=point2D_idxs,
-            )
+    for point3D_id, xyz, rgb, error, start, end in zip(
+        columns["ids"].tolist(),
+        columns["xyz"],
+        columns["rgb"].astype(np.int64),
+        columns["errors"],
+        offsets[:-1],
+        offsets[1:],
+    ):
+        points3D[point3D_id] = Point3D(
+            point3D_id,
+            xyz,
+            rgb,
+            error,
+            image_ids[start:end],
+            point2D_idxs[start:end],
+        )
     return points3D
 
 
@@ -440,23 +552,57 @@ def write_points3D_text(points3D, path):
             fid.write(" ".join(track_strings) + "\n")
 
 
+def write_points3D_binary_columnar(columns, path_to_model_file):
+    """Write points3D.bin from arrays as returned by read_points3D_binary_columnar."""
+    offsets = np.asarray(columns["track_offsets"], dtype=np.int64)
+    num_points = len(offsets) - 1
+    headers = np.empty(num_points, POINT3D_DTYPE)
+    headers["id"] = columns["ids"]
+    headers["xyz"] = columns["xyz"]
+    headers["rgb"] = columns["rgb"]
+    headers["error"] = columns["errors"]
+    headers["track_length"] = np.diff(offsets)
+    tracks = np.empty((offsets[-1], 2), dtype="<i4")
+    tracks[:, 0] = columns["image_ids"]
+    tracks[:, 1] = columns["point2D_idxs"]
+
+    # Interleave the headers and the tracks in a single buffer.
+    starts = 8 + np.arange(num_points) * POINT3D_DTYPE.itemsize + 8 * offsets[:-1]
+    data = np.empty(8 + num_points * POINT3D_DTYPE.itemsize + 8 * offsets[-1], np.uint8)
+    data[:8] = np.frombuffer(struct.pack("<Q", num_points), dtype=np.uint8)
+    is_header = record_header_mask(len(data), starts, POINT3D_DTYPE.itemsize)
+    data[is_header] = headers.view(np.uint8)
+    is_header[:8] = True
+    data[~is_header] = tracks.view(np.uint8).reshape(-1)
+    with open(path_to_model_file, "wb") as fid:
+        fid.write(data.tobytes())
+
+
 def write_points3D_binary(points3D, path_to_model_file):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
-    with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(points3D), "Q")
-        for _, pt in points3D.items():
-            write_next_bytes(fid, pt.id, "Q")
-            write_next_bytes(fid, pt.xyz.tolist(), "ddd")
-            write_next_bytes(fid, pt.rgb.tolist(), "BBB")
-            write_next_bytes(fid, pt.error, "d")
-            track_length = pt.image_ids.shape[0]
-            write_next_bytes(fid, track_length, "Q")
-            for image_id, point2D_id in zip(pt.image_ids, pt.point2D_idxs):
-                write_next_bytes(fid, [image_id, point2D_id], "ii")
+    points3D = list(points3D.values())
+    offsets = np.zeros(len(points3D) + 1, dtype=np.int64)
+    np.cumsum([len(pt.image_ids) for pt in points3D], out=offsets[1:])
+    columns = {
+        "ids": [pt.id for pt in points3D],
+        "xyz": np.array([pt.xyz for pt in points3D], np.float64).reshape(-1, 3),
+        "rgb": np.array([pt.rgb for pt in points3D], np.uint8).reshape(-1, 3),
+        "errors": np.array([pt.error for pt in points3D], dtype=np.float64),
+        "track_offsets": offsets,
+        "image_ids": np.concatenate(
+            [np.asarray(pt.image_ids, dtype=np.int64) for pt in points3D]
+            + [np.empty(0, dtype=np.int64)]
+        ),
+        "point2D_idxs": np.concatenate(
+            [np.asarray(pt.point2D_idxs, dtype=np.int64) for pt in points3D]
+            + [np.empty(0, dtype=np.int64)]
+        ),
+    }
+    write_points3D_binary_columnar(columns, path_to_model_file)
 
 
 def detect_model_format(path, ext):
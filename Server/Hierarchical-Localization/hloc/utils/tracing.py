@@ -0,0 +1,132 @@
+"""Lightweight per-stage latency tracing.
+
+Stages are timed with `with stage("name"): ...`. Inside a trace opened with
+start_trace, the durations are accumulated per stage and returned by end_trace,
+so that a worker process can send the breakdown of one request back to the
+process that aggregates them with record_trace. Outside a trace, durations go
+directly to process-wide histograms, exported in the Prometheus text format by
+render_prometheus.
+
+Tracing is disabled with the environment variable HLOC_TRACING=0 (read at
+import, so that it also applies to worker processes) or set_enabled(False).
+stage() then returns a shared no-op context manager.
+"""
+
+import contextlib
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = os.environ.get("HLOC_TRACING", "1") != "0"
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_NULL = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class _Stage:
+    __slots__ = ("name", "tic")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.tic)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def stage(name: str):
+    """Context manager timing one stage."""
+    return _Stage(name) if _enabled else _NULL
+
+
+def record(name: str, seconds: float):
+    """Record the duration of a stage, e.g. a queue wait measured elsewhere."""
+    if not _enabled:
+        return
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace[name] = trace.get(name, 0.0) + seconds
+        return
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(seconds)
+
+
+def start_trace():
+    """Start collecting the stages of the current thread into one trace."""
+    if _enabled:
+        _local.trace = {}
+
+
+def end_trace() -> Optional[Dict[str, float]]:
+    """Stop the trace of the current thread and return its stage durations."""
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def record_trace(trace: Optional[Dict[str, float]]):
+    """Add a trace returned by end_trace, possibly from another process."""
+    for name, seconds in (trace or {}).items():
+        record(name, seconds)
+
+
+def snapshot() -> Dict[str, Dict[str, float]]:
+    """Count and total duration of each stage recorded so far."""
+    with _lock:
+        return {
+            name: {"count": hist.count, "sum": hist.sum}
+            for name, hist in _histograms.items()
+        }
+
+
+def render_prometheus(metric: str = "hloc_stage_seconds") -> str:
+    lines = [
+        f"# HELP {metric} Latency of the localization pipeline stages.",
+        f"# TYPE {metric} histogram",
+    ]
+    with _lock:
+        for name, hist in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append(
+                    f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{metric}_bucket{{stage="{name}",le="+Inf"}} {hist.count}')
+            lines.append(f'{metric}_sum{{stage="{name}"}} {hist.sum}')
+            lines.append(f'{metric}_count{{stage="{name}"}} {hist.count}')
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,6 @@
+import argparse
 import numpy as np
+import pycolmap
 from pathlib import Path
 from hloc import (
     extract_features,
@@ -6,45 +8,126 @@ from hloc import (
     reconstruction,
     visualization,
     pairs_from_exhaustive,
+    pairs_from_sequence,
 )
 from hloc.visualization import plot_images, read_image
 from hloc.utils import viz_3d
+from hloc.utils.pipeline import FileHashCache, Pipeline, fingerprint, run_parallel
 
 # setup
 images = Path(r"E:\mixed_reality\CABImage_data1024") 
 outputs = Path("outputs/demo_CAB1024_aliked/")
-sfm_pairs = outputs / "pairs-sfm.txt" 
 loc_pairs = outputs / "pairs-loc.txt" 
-sfm_dir = outputs / "sfm"
-features = outputs / "features.h5" 
-matches = outputs / "matches.h5"
+query_features = outputs / "features-query.h5"
+loc_matches = outputs / "matches-loc.h5"
 # feature_conf = extract_features.confs["superpoint_aachen"]
 # matcher_conf = match_features.confs["superglue"] 
 feature_conf = extract_features.confs["aliked-n16"] 
 matcher_conf = match_features.confs["aliked+lightglue"] 
+sequence_window = 10  # mapping frames matched to each frame
 
 def Rename(img_dir):
     for p in img_dir.iterdir():
         if p.suffix == ".JPG":
             p.rename(p.with_suffix(".jpg"))
 
+def reconstruct(sfm_dir, images, pairs, features, matches, references):
+    model = reconstruction.main(
+        sfm_dir, images, pairs, features, matches, image_list=references
+    )
+    if model is None:
+        raise RuntimeError(f"Could not reconstruct {images}")
+
+
+def build_scene(images, outputs, prune=False):
+    """
+    Build the SfM model of a scene from the images in images/mapping/.
+
+    Artifacts are named after a fingerprint of their inputs (image contents,
+    configurations, upstream artifacts), so a stage only runs again when one
+    of them changed, e.g. a matcher tweak reuses the features. Per-stage
+    timings are written to outputs/timings.json. With prune, the artifacts
+    superseded by those of this build are removed.
+    """
+    references = sorted(p.relative_to(images).as_posix() for p in (images / "mapping/").iterdir())
+    print(len(references), "mapping images")
+    pipeline = Pipeline(outputs, prune=prune)
+    image_hashes = FileHashCache(outputs / "image-hashes.json")
+    images_key = fingerprint({r: image_hashes(images / r) for r in references})
+    image_hashes.save()
+
+    features = pipeline.run(
+        "features",
+        lambda out: extract_features.main(
+            feature_conf, images, image_list=references, feature_path=out
+        ),
+        [feature_conf, images_key],
+        suffix=".h5",
+    )
+    # mapping images are video frames: match each one to its temporal neighbors
+    sfm_pairs = pipeline.run(
+        "pairs-sfm",
+        lambda out: pairs_from_sequence.main(
+            out, image_list=references, window_size=sequence_window
+        ),
+        [references, sequence_window],
+        suffix=".txt",
+    )
+    matches = pipeline.run(
+        "matches",
+        lambda out: match_features.main(
+            matcher_conf, sfm_pairs, features=features, matches=out
+        ),
+        [matcher_conf, sfm_pairs.name, features.name],
+        suffix=".h5",
+    )
+    sfm_dir = pipeline.run(
+        "sfm",
+        lambda out: reconstruct(out, images, sfm_pairs, features, matches, references),
+        [sfm_pairs.name, features.name, matches.name, images_key],
+    )
+    return {
+        "references": references,
+        "features": features,
+        "pairs": sfm_pairs,
+        "matches": matches,
+        "sfm": sfm_dir,
+        "timings": pipeline.timings,
+    }
+
+
+def build_catalog(catalog, output_root, num_workers=2, prune=False):
+    """
+    Build every scene <catalog>/<movie>/<scene>/mapping/ into
+    <output_root>/<movie>/<scene>/, num_workers scenes at a time.
+    """
+    scenes = sorted(p.parent for p in catalog.glob("*/*/mapping") if p.is_dir())
+    jobs = {
+        s.relative_to(catalog).as_posix(): (s, output_root / s.relative_to(catalog), prune)
+        for s in scenes
+    }
+    results = run_parallel(build_scene, jobs, num_workers)
+    for name, result in results.items():
+        if result is None:
+            print(f"{name}: failed")
+            continue
+        stages = [
+            f"{t['stage']} {'cached' if t['cached'] else '%.1fs' % t['seconds']}"
+            for t in result["timings"]
+        ]
+        print(f"{name}: " + ", ".join(stages))
+    return results
+
+
 def main():
     # Rename(images/"mapping/")
 
     # # 3D mapping
-    references = [p.relative_to(images).as_posix() for p in (images / "mapping/").iterdir()] 
-    print(len(references), "mapping images")
+    scene = build_scene(images, outputs)
+    references = scene["references"]
+    model = pycolmap.Reconstruction(scene["sfm"])
     plot_images([read_image(images / r) for r in references], dpi=25) 
 
-    extract_features.main(
-        feature_conf, images, image_list=references, feature_path=features
-    )
-    pairs_from_exhaustive.main(sfm_pairs, image_list=references)
-    match_features.main(matcher_conf, sfm_pairs, features=features, matches=matches);
-    model = reconstruction.main(
-        sfm_dir, images, sfm_pairs, features, matches, image_list=references
-    )
-
     # 可视化sfm部分
     fig = viz_3d.init_figure() 
     viz_3d.plot_reconstruction(
@@ -60,14 +143,14 @@ def main():
     # plot_images([read_image(images / query)], dpi=75)
 
     extract_features.main(
-        feature_conf, images, image_list=[query], feature_path=features, overwrite=True
+        feature_conf, images, image_list=[query], feature_path=query_features, overwrite=True
     ) 
     pairs_from_exhaustive.main(loc_pairs, image_list=[query], ref_list=references) 
     match_features.main(
-        matcher_conf, loc_pairs, features=features, matches=matches, overwrite=True
+        matcher_conf, loc_pairs, features=query_features, matches=loc_matches,
+        features_ref=scene["features"], overwrite=True
     ); 
 
-    import pycolmap
     from hloc.localize_sfm import QueryLocalizer, pose_from_cluster 
 
     camera = pycolmap.infer_camera_from_image(images / query)
@@ -84,7 +167,7 @@ def main():
         "refinement": {"refine_focal_length": True, "refine_extra_params": True}, 
     } 
     localizer = QueryLocalizer(model, conf) 
-    ret, log = pose_from_cluster(localizer, query, camera, ref_ids, features, matches) 
+    ret, log = pose_from_cluster(localizer, query, camera, ref_ids, query_features, loc_matches) 
     print(f'found {ret["num_inliers"]}/{len(ret["inlier_mask"])} inlier correspondences.') 
     visualization.visualize_loc_from_log(images, query, log, model)
 
@@ -106,4 +189,13 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--catalog", type=Path, help="build <catalog>/<movie>/<scene>/mapping/ instead of the demo")
+    parser.add_argument("--outputs", type=Path, default=Path("outputs/catalog"))
+    parser.add_argument("--workers", type=int, default=2, help="scenes built in parallel")
+    parser.add_argument("--prune", action="store_true", help="remove superseded artifacts")
+    args = parser.parse_args()
+    if args.catalog is None:
+        main()
+    else:
+        build_catalog(args.catalog, args.outputs, args.workers, args.prune)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from hloc.utils.read_write_model import (
+    Image,
+    Point3D,
+    read_images_binary,
+    read_points3D_binary,
+    write_images_binary,
+    write_next_bytes,
+    write_points3D_binary,
+)
+
+
+def write_images_binary_reference(images, path_to_model_file):
+    """Writer of images.bin before the bulk writer, one value at a time."""
+    with open(path_to_model_file, "wb") as fid:
+        write_next_bytes(fid, len(images), "Q")
+        for _, img in images.items():
+            write_next_bytes(fid, img.id, "i")
+            write_next_bytes(fid, img.qvec.tolist(), "dddd")
+            write_next_bytes(fid, img.tvec.tolist(), "ddd")
+            write_next_bytes(fid, img.camera_id, "i")
+            for char in img.name:
+                write_next_bytes(fid, char.encode("utf-8"), "c")
+            write_next_bytes(fid, b"\x00", "c")
+            write_next_bytes(fid, len(img.point3D_ids), "Q")
+            for xy, p3d_id in zip(img.xys, img.point3D_ids):
+                write_next_bytes(fid, [*xy, p3d_id], "ddq")
+
+
+def write_points3D_binary_reference(points3D, path_to_model_file):
+    """Writer of points3D.bin before the bulk writer, one value at a time."""
+    with open(path_to_model_file, "wb") as fid:
+        write_next_bytes(fid, len(points3D), "Q")
+        for _, pt in points3D.items():
+            write_next_bytes(fid, pt.id, "Q")
+            write_next_bytes(fid, pt.xyz.tolist(), "ddd")
+            write_next_bytes(fid, pt.rgb.tolist(), "BBB")
+            write_next_bytes(fid, pt.error, "d")
+            track_length = pt.image_ids.shape[0]
+            write_next_bytes(fid, track_length, "Q")
+            for image_id, point2D_id in zip(pt.image_ids, pt.point2D_idxs):
+                write_next_bytes(fid, [image_id, point2D_id], "ii")
+
+
+def random_images(num_images, seed=0):
+    rng = np.random.default_rng(seed)
+    images = {}
+    for i in range(1, num_images + 1):
+        # every third image has no keypoints
+        n = 0 if i % 3 == 0 else int(rng.integers(1, 50))
+        images[i] = Image(
+            id=i,
+            qvec=rng.normal(size=4),
+            tvec=rng.normal(size=3),
+            camera_id=int(rng.integers(1, 4)),
+            name=f"db/{i:04d}.jpg",
+            xys=rng.normal(size=(n, 2)) * 100,
+            point3D_ids=rng.integers(-1, 1000, size=n),
+        )
+    return images
+
+
+def random_points3D(num_points, seed=0):
+    rng = np.random.default_rng(seed)
+    points3D = {}
+    for i in range(1, num_points + 1):
+        # every third point has an empty track
+        n = 0 if i % 3 == 0 else int(rng.integers(1, 20))
+        points3D[3 * i] = Point3D(
+            id=3 * i,
+            xyz=rng.normal(size=3),
+            rgb=rng.integers(0, 256, size=3),
+            error=float(rng.random()),
+            image_ids=rng.integers(1, 200, size=n),
+            point2D_idxs=rng.integers(0, 50, size=n),
+        )
+    return points3D
+
+
+@pytest.mark.parametrize("num_images", [0, 1, 100])
+def test_write_images_binary(tmp_path, num_images):
+    images = random_images(num_images)
+    write_images_binary_reference(images, tmp_path / "reference.bin")
+    write_images_binary(images, tmp_path / "images.bin")
+    assert (tmp_path / "images.bin").read_bytes() == (
+        tmp_path / "reference.bin"
+    ).read_bytes()
+
+    read = read_images_binary(tmp_path / "images.bin")
+    assert list(read) == list(images)
+    for image_id, image in images.items():
+        other = read[image_id]
+        assert other.id == image.id
+        assert other.camera_id == image.camera_id
+        assert other.name == image.name
+        np.testing.assert_array_equal(other.qvec, image.qvec)
+        np.testing.assert_array_equal(other.tvec, image.tvec)
+        np.testing.assert_array_equal(other.xys.reshape(-1, 2), image.xys)
+        np.testing.assert_array_equal(other.point3D_ids, image.point3D_ids)
+
+
+@pytest.mark.parametrize("num_points", [0, 1, 100])
+def test_write_points3D_binary(tmp_path, num_points):
+    points3D = random_points3D(num_points)
+    write_points3D_binary_reference(points3D, tmp_path / "reference.bin")
+    write_points3D_binary(points3D, tmp_path / "points3D.bin")
+    assert (tmp_path / "points3D.bin").read_bytes() == (
+        tmp_path / "reference.bin"
+    ).read_bytes()
+
+    read = read_points3D_binary(tmp_path / "points3D.bin")
+    assert list(read) == list(points3D)
+    for point3D_id, point in points3D.items():
+        other = read[point3D_id]
+        assert other.id == point.id
+        assert other.error == point.error
+        np.testing.assert_array_equal(other.xyz, point.xyz)
+        np.testing.assert_array_equal(other.rgb, point.rgb)
+        np.testing.assert_array_equal(other.image_ids, point.image_ids)
+        np.testing.assert_array_equal(other.point2D_idxs, point.point2D_idxs)
@@ -0,0 +1,499 @@
+"""
+End-to-end localization benchmark.
+
+Replays a session (images + meta_json poses) either through the /upload
+endpoint of server_main (in-process Flask test client, with the localization
+workers running) or directly through query_sfm_pose, at a given frame rate and
+concurrency. Reports latency percentiles, throughput, time-to-first-pose and
+the final pose error.
+
+    python benchmark.py synth --data bench_data
+    python benchmark.py upload --data bench_data --rate 10 --concurrency 4
+    python benchmark.py query --data bench_data --rate 2 --concurrency 2 --json out.json
+
+`synth` renders a small textured scene from known cameras, triangulates an SfM
+model from it and records a session with ground truth. It is deterministic for
+a given seed and runs offline on CPU once the DISK and LightGlue weights are
+cached. A recorded phone session can be replayed the same way by putting it in
+the layout below (ground_truth.json is optional):
+
+    <data>/film/<movie>/<scene>/<frameId>.json     film pose (SfM frame)
+    <data>/film/<movie>/<scene>/sfm/               model_file of query_sfm_pose
+    <data>/session/frames/*.jpg                    uploaded frames
+    <data>/session/meta.jsonl                      {"image": ..., "meta": {...}} per frame
+    <data>/session/ground_truth.json               film pose in session, SfM centers
+"""
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+os.environ["OMP_NUM_THREADS"] = "1"
+
+import argparse
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pycolmap
+from scipy.spatial.transform import Rotation as Rotate
+
+from hloc import extract_features, match_features, pairs_from_exhaustive, triangulation
+from hloc.utils import tracing
+
+import server_main
+import query_sfm_pose as qsp
+
+# Synthetic scene
+IMAGE_SIZE = (640, 480)       # (w, h) of rendered images
+FOCAL_PX = 500.0
+TEXTURE_PX = 1024
+NUM_DB = 24                   # database (mapping) images
+NUM_FRAMES = 60               # session frames
+FRAME_INTERVAL_MS = 100       # session frame timestamps
+MOVIE, SCENE, FILM_FRAME = "synthetic", "scene", "film"
+
+# session -> SfM similarity of the synthetic session
+SYNTH_SCALE = 1.7
+SYNTH_ROTATION_DEG = (10.0, -25.0, 40.0)
+SYNTH_TRANSLATION = (0.5, -0.3, 2.0)
+
+PERCENTILES = (50, 95, 99)
+
+
+# ============================================================
+# Synthetic data
+# ============================================================
+
+def make_texture(rng, size=TEXTURE_PX):
+    """
+    Multi-scale color noise with random rectangles, for distinctive keypoints.
+
+    """
+    tex = np.zeros((size, size, 3), np.float32)
+    for cells in (4, 16, 64, 256):
+        noise = rng.random((cells, cells, 3)).astype(np.float32)
+        tex += cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC) / 4
+    tex = (255 * np.clip(tex, 0, 1)).astype(np.uint8)
+    for _ in range(150):
+        x, y = rng.integers(0, size - 40, 2)
+        w, h = rng.integers(8, 40, 2)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(tex, (int(x), int(y)), (int(x + w), int(y + h)), color, -1)
+    return tex
+
+
+def make_planes(rng):
+    """
+    Three textured walls forming a shallow V in front of the cameras (z > 0).
+
+    return: list of (origin, u, v, texture) with u, v spanning the plane (m)
+    """
+    a = np.deg2rad(35.0)
+    left = 3.0 * np.array([np.cos(a), 0.0, np.sin(a)])
+    right = 3.0 * np.array([np.cos(a), 0.0, -np.sin(a)])
+    v = np.array([0.0, 3.0, 0.0])
+    return [
+        (np.array([-1.5, -1.5, 2.0]) - left, left, v, make_texture(rng)),
+        (np.array([-1.5, -1.5, 2.0]), np.array([3.0, 0.0, 0.0]), v, make_texture(rng)),
+        (np.array([1.5, -1.5, 2.0]), right, v, make_texture(rng)),
+    ]
+
+
+def look_at(C, target):
+    """
+    COLMAP camera-to-world rotation (x right, y down, z forward) looking at target.
+
+    """
+    z = np.asarray(target, float) - C
+    z /= np.linalg.norm(z)
+    x = np.cross([0.0, 1.0, 0.0], z)
+    x /= np.linalg.norm(x)
+    y = np.cross(z, x)
+    return np.stack([x, y, z], axis=1)
+
+
+def render(planes, C, R_wc):
+    """
+    Render the textured planes seen by a pinhole camera, farthest plane first.
+
+    """
+    w, h = IMAGE_SIZE
+    K = np.array([[FOCAL_PX, 0, w / 2], [0, FOCAL_PX, h / 2], [0, 0, 1]])
+    R_cw = R_wc.T
+    t_cw = -R_cw @ C
+    image = np.full((h, w, 3), 127, np.uint8)
+    depths = [(R_cw @ (o + (u + v) / 2) + t_cw)[2] for o, u, v, _ in planes]
+    for i in np.argsort(depths)[::-1]:
+        o, u, v, tex = planes[i]
+        A = np.stack([u / TEXTURE_PX, v / TEXTURE_PX, o], axis=1)  # texture px -> world
+        H = K @ np.column_stack([R_cw @ A[:, :2], R_cw @ A[:, 2] + t_cw])
+        warped = cv2.warpPerspective(tex, H, (w, h), flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(np.ones(tex.shape[:2], np.uint8), H, (w, h)) > 0
+        image[mask] = warped[mask]
+    return image
+
+
+def session_from_sfm(C_sfm, R_wc_sfm, s, R, t):
+    """
+    Session pose of a camera given its SfM pose and the session -> SfM Sim3.
+
+    """
+    C_sess = (1.0 / s) * (R.T @ (C_sfm - t))
+    return C_sess, R.T @ R_wc_sfm
+
+
+def phone_meta(C_sess, R_sess, timestamp_ms):
+    """
+    Upload metadata whose conversion in process_frame_into_raw_pool gives
+    back (C_sess, R_sess).
+
+    """
+    D = server_main.D_FLIP
+    R_raw = D @ (R_sess @ server_main.Rfix_x180.T @ server_main.Rfix_z90.T) @ D
+    w, h = IMAGE_SIZE
+    return {
+        "timestamp_ms": int(timestamp_ms),
+        "rotation_xyzw": Rotate.from_matrix(R_raw).as_quat().tolist(),
+        "translation_m": (D @ C_sess).tolist(),
+        "image_size": [w, h],
+        "intrinsics": {"fx": FOCAL_PX, "fy": FOCAL_PX, "cx": w / 2, "cy": h / 2,
+                       "model": "pinhole"},
+        "movieName": MOVIE,
+        "sceneName": SCENE,
+        "frameId": FILM_FRAME,
+        "isFromAlbum": False,
+    }
+
+
+def film_pose_in_session(film_pose, s, R, t):
+    """
+    Ground truth of the film pose returned by /upload (same conversion as algo_loop).
+
+    """
+    D = server_main.D_FLIP
+    C_sfm = np.array(film_pose["translation"])
+    R_sfm = Rotate.from_quat(film_pose["rotation"]).as_matrix()
+    C_sess, R_sess = session_from_sfm(C_sfm, R_sfm, s, R, t)
+    R_sess = R_sess @ server_main.Rfix_x180.T @ server_main.Rfix_z90.T
+    return {
+        "translation": (D @ C_sess).tolist(),
+        "rotation_xyzw": Rotate.from_matrix(D @ R_sess @ D).as_quat().tolist(),
+    }
+
+
+def build_sfm_model(model_dir, images_dir, db_names, db_poses):
+    """
+    Triangulate the database images with their known poses, in the layout
+    expected by query_sfm_pose (sfm/, feats-disk.h5, disk_global.h5).
+
+    """
+    w, h = IMAGE_SIZE
+    reference = pycolmap.Reconstruction()
+    camera = pycolmap.Camera(model="SIMPLE_RADIAL", width=w, height=h,
+                             params=[FOCAL_PX, w / 2, h / 2, 0.0], camera_id=1)
+    reference.add_camera_with_trivial_rig(camera)
+    for i, (name, (C, R_wc)) in enumerate(zip(db_names, db_poses), start=1):
+        image = pycolmap.Image(name=name, camera_id=1, image_id=i)
+        R_cw = R_wc.T
+        cam_from_world = pycolmap.Rigid3d(
+            pycolmap.Rotation3d(R_cw), -R_cw @ C
+        )
+        reference.add_image_with_trivial_frame(image, cam_from_world)
+    ref_dir = model_dir / "reference"
+    ref_dir.mkdir(parents=True, exist_ok=True)
+    reference.write(str(ref_dir))
+
+    feats = model_dir / f"{qsp.feat_conf['output']}.h5"
+    matches = model_dir / "matches-sfm.h5"
+    pairs = model_dir / "pairs-sfm.txt"
+    extract_features.main(qsp.feat_conf, images_dir, image_list=db_names, feature_path=feats)
+    pairs_from_exhaustive.main(pairs, image_list=db_names)
+    match_features.main(qsp.matcher_conf, pairs, features=feats, matches=matches)
+    model = triangulation.main(model_dir / "sfm", ref_dir, images_dir, pairs, feats, matches)
+
+    # global descriptors, as read by load_disk_global_db
+    qsp.update_disk_global_db(
+        model_dir / "disk_global.h5",
+        [name[len("db/"):] for name in db_names],
+        qsp.disk_global_descriptors(feats, db_names),
+    )
+    return model
+
+
+def make_synthetic(data_dir, seed=0):
+    """
+    Generate the synthetic scene, SfM model and session with ground truth.
+
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(data_dir)
+    images_dir = data_dir / "images"
+    (images_dir / "db").mkdir(parents=True, exist_ok=True)
+    frames_dir = data_dir / "session" / "frames"
+    frames_dir.mkdir(parents=True, exist_ok=True)
+    scene_dir = data_dir / "film" / MOVIE / SCENE
+    model_dir = scene_dir / "sfm"
+    model_dir.mkdir(parents=True, exist_ok=True)
+
+    planes = make_planes(rng)
+    target = np.array([0.0, 0.0, 2.5])
+
+    # database images on a grid in front of the walls
+    db_names, db_poses = [], []
+    for i, (x, y) in enumerate((x, y) for y in (-0.6, 0.6) for x in np.linspace(-2.5, 2.5, NUM_DB // 2)):
+        C = np.array([x, y, -3.0]) + rng.normal(0, 0.1, 3)
+        R_wc = look_at(C, target + rng.normal(0, 0.3, 3))
+        name = f"db/{i:03d}.jpg"
+        cv2.imwrite(str(images_dir / name), render(planes, C, R_wc)[..., ::-1])
+        db_names.append(name)
+        db_poses.append((C, R_wc))
+    build_sfm_model(model_dir, images_dir, db_names, db_poses)
+
+    # film camera
+    C_film = np.array([0.4, -0.2, -2.2])
+    R_film = look_at(C_film, target)
+    film_pose = {"translation": C_film.tolist(),
+                 "rotation": Rotate.from_matrix(R_film).as_quat().tolist()}
+    with open(scene_dir / f"{FILM_FRAME}.json", "w", encoding="utf-8") as f:
+        json.dump(film_pose, f)
+
+    # phone session sweeping in front of the walls
+    s = SYNTH_SCALE
+    R = Rotate.from_euler("xyz", SYNTH_ROTATION_DEG, degrees=True).as_matrix()
+    t = np.array(SYNTH_TRANSLATION)
+    sfm_centers = {}
+    with open(data_dir / "session" / "meta.jsonl", "w", encoding="utf-8") as f:
+        for i in range(NUM_FRAMES):
+            a = i / (NUM_FRAMES - 1)
+            C = np.array([-2.0 + 4.0 * a, 0.4 * np.sin(6 * a), -3.5 + 0.3 * np.cos(4 * a)])
+            R_wc = look_at(C, target + [0.5 * np.sin(3 * a), 0.0, 0.0])
+            name = f"frame_{i:04d}.jpg"
+            cv2.imwrite(str(frames_dir / name), render(planes, C, R_wc)[..., ::-1])
+            C_sess, R_sess = session_from_sfm(C, R_wc, s, R, t)
+            meta = phone_meta(C_sess, R_sess, i * FRAME_INTERVAL_MS)
+            f.write(json.dumps({"image": name, "meta": meta}) + "\n")
+            sfm_centers[name] = C.tolist()
+
+    with open(data_dir / "session" / "ground_truth.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "film_pose_session": film_pose_in_session(film_pose, s, R, t),
+            "sfm_centers": sfm_centers,
+            "sfm_scale": s,
+        }, f)
+    print(f"[synth] wrote {len(db_names)} DB images and {NUM_FRAMES} frames to {data_dir}")
+
+
+# ============================================================
+# Replay
+# ============================================================
+
+def load_session(data_dir):
+    data_dir = Path(data_dir)
+    with open(data_dir / "session" / "meta.jsonl", "r", encoding="utf-8") as f:
+        frames = [json.loads(line) for line in f if line.strip()]
+    gt_path = data_dir / "session" / "ground_truth.json"
+    gt = None
+    if gt_path.exists():
+        with open(gt_path, "r", encoding="utf-8") as f:
+            gt = json.load(f)
+    return frames, gt
+
+
+def run_at_rate(fn, items, rate, concurrency):
+    """
+    Call fn(item) for each item, starting item i at i / rate seconds
+    (all at once if rate <= 0), with at most `concurrency` calls in flight.
+
+    return: list of (item, start, end, result or exception), start/end relative to t0
+    """
+    t0 = time.perf_counter()
+    results = []
+
+    def timed(i, item):
+        if rate > 0:
+            delay = t0 + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.perf_counter() - t0
+        try:
+            out = fn(item)
+        except Exception as e:
+            out = e
+        return item, start, time.perf_counter() - t0, out
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for fut in as_completed([ex.submit(timed, i, x) for i, x in enumerate(items)]):
+            results.append(fut.result())
+    return results
+
+
+def latency_stats(latencies):
+    latencies = np.asarray(latencies, float)
+    if len(latencies) == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": float(np.percentile(latencies, p)) for p in PERCENTILES}
+
+
+def pose_errors(pose, gt_pose):
+    """
+    Position (m, session) and rotation (°) error of a session pose.
+
+    """
+    dC = np.linalg.norm(np.array(pose["translation"]) - gt_pose["translation"])
+    dR = (Rotate.from_quat(pose["rotation_xyzw"]).inv()
+          * Rotate.from_quat(gt_pose["rotation_xyzw"])).magnitude()
+    return float(dC), float(np.rad2deg(dR))
+
+
+def bench_upload(data_dir, rate, concurrency, workers, drain_s):
+    """
+    Replay through /upload with the server's worker threads and localization pool.
+
+    """
+    data_dir = Path(data_dir)
+    frames, gt = load_session(data_dir)
+    upload_dir = Path(tempfile.mkdtemp(prefix="bench_upload_"))
+    server_main.UPLOAD_FOLDER = str(upload_dir)
+    server_main.FILM_SCENE_FRAME_ROOT = str(data_dir / "film")
+    server_main.LOCALIZATION_WORKERS = workers
+    server_main.localizer_pool = server_main.create_localizer_pool()
+    threading.Thread(target=server_main.worker_loop, daemon=True).start()
+    threading.Thread(target=server_main.algo_loop, daemon=True).start()
+
+    local = threading.local()
+
+    def upload(frame):
+        if not hasattr(local, "client"):
+            local.client = server_main.app.test_client()
+        with open(data_dir / "session" / "frames" / frame["image"], "rb") as f:
+            image = io.BytesIO(f.read())
+        resp = local.client.post("/upload", data={
+            "image": (image, frame["image"]),
+            "meta_json": json.dumps(frame["meta"]),
+        }, content_type="multipart/form-data")
+        return resp.status_code, resp.get_json()
+
+    try:
+        results = run_at_rate(upload, frames, rate, concurrency)
+        time.sleep(drain_s)  # let the localizations of the last frames finish
+    finally:
+        server_main.localizer_pool.shutdown(cancel_futures=True)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+    with server_main.state_lock:
+        # the algo thread may still be updating both
+        best_rmse = server_main.GLOBAL_STATE["best_rmse"]
+        pose = server_main.GLOBAL_STATE["film_pose_session"]
+
+    ok = [r for r in results if not isinstance(r[3], Exception)]
+    ends = [end for _, _, end, _ in results]
+    first_pose = [end for _, _, end, out in ok if out[0] == 200]
+    report = {
+        "mode": "upload",
+        "frames": len(frames),
+        "rejected": sum(1 for r in ok if r[3][0] == 429),
+        "errors": len(results) - len(ok),
+        "ack_latency_s": latency_stats([end - start for _, start, end, _ in ok]),
+        "throughput_fps": len(results) / max(ends) if ends else 0.0,
+        "time_to_first_pose_s": min(first_pose) if first_pose else None,
+        "sim3_rmse": best_rmse,
+        "stages_mean_s": {
+            k: v["sum"] / v["count"] for k, v in sorted(tracing.snapshot().items()) if v["count"]
+        },
+    }
+    if gt is not None and pose is not None:
+        report["film_pose_error_m"], report["film_pose_error_deg"] = pose_errors(
+            pose, gt["film_pose_session"]
+        )
+    return report
+
+
+def stage_means(timings):
+    """
+    Mean duration of each stage over a list of query_sfm_pose timings.
+
+    """
+    totals = {}
+    for t in timings:
+        for k, v in (t or {}).items():
+            totals.setdefault(k, []).append(v)
+    return {k: float(np.mean(v)) for k, v in sorted(totals.items())}
+
+
+def bench_query(data_dir, rate, concurrency):
+    """
+    Replay the frames through query_sfm_pose, `concurrency` processes at a time.
+
+    """
+    data_dir = Path(data_dir)
+    frames, gt = load_session(data_dir)
+    meta = frames[0]["meta"]  # the server finds the model the same way
+    model_file = data_dir / "film" / meta["movieName"] / meta["sceneName"] / "sfm"
+
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        def localize(frame):
+            return pool.submit(qsp.query_sfm_pose, images=data_dir / "session" / "frames",
+                               query=frame["image"], model_file=model_file).result()
+        results = run_at_rate(localize, frames, rate, concurrency)
+
+    ok = [r for r in results if not isinstance(r[3], Exception)]
+    ends = [end for _, _, end, _ in results]
+    report = {
+        "mode": "query",
+        "frames": len(frames),
+        "localized": len(ok),
+        "latency_s": latency_stats([end - start for _, start, end, _ in ok]),
+        "service_time_s": latency_stats(
+            [out["timings"]["localize"] for *_, out in ok if out.get("timings")]
+        ),
+        "throughput_fps": len(results) / max(ends) if ends else 0.0,
+        "time_to_first_pose_s": min((end for _, _, end, _ in ok), default=None),
+        "stages_mean_s": stage_means(out.get("timings") for *_, out in ok),
+    }
+    if gt is not None and ok:
+        # camera center error, converted from SfM units to meters
+        errs = [np.linalg.norm(np.array(out["translation"]) - gt["sfm_centers"][frame["image"]])
+                for frame, _, _, out in ok]
+        report["position_rmse_m"] = float(np.sqrt(np.mean(np.square(errs)))) / gt["sfm_scale"]
+    return report
+
+
+def print_report(report):
+    for k, v in report.items():
+        if isinstance(v, dict):
+            v = ", ".join(f"{kk}={vv:.3f}" if isinstance(vv, float) else f"{kk}={vv}"
+                          for kk, vv in v.items())
+        elif isinstance(v, float):
+            v = f"{v:.3f}"
+        print(f"[bench] {k:>22}: {v}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["synth", "upload", "query"])
+    parser.add_argument("--data", type=Path, required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=10.0, help="frames per second, <= 0 for no pacing")
+    parser.add_argument("--concurrency", type=int, default=1, help="requests in flight")
+    parser.add_argument("--workers", type=int, default=2, help="localization processes (upload mode)")
+    parser.add_argument("--drain", type=float, default=30.0, help="seconds to wait after the last upload")
+    parser.add_argument("--json", type=Path, help="also write the report to this file")
+    args = parser.parse_args()
+
+    if args.mode == "synth":
+        make_synthetic(args.data, args.seed)
+    else:
+        if args.mode == "upload":
+            report = bench_upload(args.data, args.rate, args.concurrency, args.workers, args.drain)
+        else:
+            report = bench_query(args.data, args.rate, args.concurrency)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,215 @@
+"""
+Extend the SfM map of a scene with new database images, without rebuilding it.
+
+Only the new images are processed: their DISK features are added to the
+reference features, they are matched to the most similar images of the map
+(retrieved with the same mean-pooled global descriptors as the queries),
+registered into the existing reconstruction with the poses of the map fixed and
+triangulated, and finally appended to disk_global.h5. Localization workers that
+are already running pick up the extended map on their next query.
+
+The features, matches and model are extended in a staging directory and only
+moved in place once the extension succeeded, so that workers never pack a
+partially written file. The lock file query_sfm_pose.EXTEND_LOCK, which contains
+the pid of the extension, is held in the model directory meanwhile. It keeps
+workers on their current map, makes workers without a map wait for the swap of
+sfm/, and prevents concurrent extensions of the same map. The lock of an
+extension that died is ignored by the workers and taken over by the next one.
+
+    python extend_map.py --model film/<movie>/<scene>/sfm --images <image_dir> db/0100.jpg db/0101.jpg
+    python extend_map.py --model film/<movie>/<scene>/sfm --images <image_dir> --list new_images.txt
+
+The model directory is the model_file of query_sfm_pose:
+
+    <model>/sfm/                COLMAP model and its database.db
+    <model>/feats-disk.h5       reference features
+    <model>/disk_global.h5      global descriptors
+    <model>/matches-sfm.h5      matches of the map
+    <model>/extend.tmp/         staging directory of a running extension
+
+Image names are relative to the image directory and under db/, like those of
+the database images retrieved by query_sfm_pose.
+"""
+
+import argparse
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from hloc import extract_features, match_features, reconstruction
+
+import query_sfm_pose as qsp
+
+NUM_NEIGHBORS = 20            # map images each new image is matched to
+SFM_MATCHES = "matches-sfm.h5"
+EXTEND_PAIRS = "pairs-extend.txt"
+STAGING_DIR = "extend.tmp"
+
+
+def retrieve_neighbors(db_names, db_feats, new_names, new_feats, k=NUM_NEIGHBORS):
+    """
+    Pairs of each new image with its k most similar images, among the map and
+    the other new images.
+
+    """
+    names = list(db_names) + list(new_names)
+    feats = np.concatenate([db_feats.reshape(-1, new_feats.shape[1]), new_feats])
+    sims = new_feats @ feats.T
+    sims[np.arange(len(new_names)), len(db_names) + np.arange(len(new_names))] = -np.inf
+    k = max(min(k, len(names) - 1), 1)
+    topk = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    pairs = {}
+    for i, js in enumerate(topk):
+        for j in js:
+            if np.isfinite(sims[i, j]) and (names[j], new_names[i]) not in pairs:
+                pairs[new_names[i], names[j]] = None
+    return list(pairs)
+
+
+@contextmanager
+def extension_lock(model_dir):
+    """
+    Hold the extension lock file of model_dir, which contains our pid, failing
+    if a running extension holds it. The lock of a dead extension is taken over.
+
+    """
+    lock = Path(model_dir) / qsp.EXTEND_LOCK
+    tmp = lock.with_name(f"{lock.name}.{os.getpid()}.tmp")
+    tmp.write_text(str(os.getpid()))
+    try:
+        try:
+            os.link(tmp, lock)   # creates the lock with its content, or fails
+        except FileExistsError:
+            if qsp.extension_running(model_dir):
+                raise RuntimeError(f"{model_dir} is already being extended") from None
+            print(f"[extend] removing the stale lock {lock}")
+            lock.unlink()
+            os.link(tmp, lock)
+    finally:
+        tmp.unlink()
+    try:
+        yield
+    finally:
+        lock.unlink()
+
+
+def stage_map(model_dir, staging):
+    """
+    Copy the files of the map that an extension modifies into staging.
+
+    """
+    if not (model_dir / "sfm").exists() and (model_dir / "sfm.old").exists():
+        # an extension died between the two renames of swap_map
+        os.rename(model_dir / "sfm.old", model_dir / "sfm")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    shutil.copytree(model_dir / "sfm", staging / "sfm")
+    for name in (f"{qsp.feat_conf['output']}.h5", SFM_MATCHES):
+        if (model_dir / name).exists():
+            shutil.copy2(model_dir / name, staging / name)
+
+
+def swap_map(model_dir, staging):
+    """
+    Move the extended files of staging in place of those of the map.
+    The features go first: the current model only refers to features they keep.
+
+    """
+    for name in (f"{qsp.feat_conf['output']}.h5", SFM_MATCHES):
+        os.replace(staging / name, model_dir / name)
+    old = model_dir / "sfm.old"
+    shutil.rmtree(old, ignore_errors=True)
+    os.rename(model_dir / "sfm", old)
+    os.rename(staging / "sfm", model_dir / "sfm")
+    shutil.rmtree(old)
+
+
+def extend_staged(staging, images_dir, new_names, global_h5):
+    """
+    Extend the staged copy of a map with new images.
+
+    return:
+        the extended reconstruction or None, and the global descriptors of new_names
+    """
+    feats = staging / f"{qsp.feat_conf['output']}.h5"
+    matches = staging / SFM_MATCHES
+    pairs = staging / EXTEND_PAIRS
+
+    # local features of the new images only, added to the reference features
+    extract_features.main(qsp.feat_conf, images_dir, image_list=new_names, feature_path=feats)
+    new_feats = qsp.disk_global_descriptors(feats, new_names)
+
+    db_names, db_feats = [], np.zeros((0, new_feats.shape[1]), np.float32)
+    if global_h5.exists():
+        db_names, db_feats = qsp.load_disk_global_db(global_h5)
+    new_set = set(new_names)
+    known = [(f"db/{n}", f) for n, f in zip(db_names, db_feats) if f"db/{n}" not in new_set]
+    pairs_list = retrieve_neighbors(
+        [n for n, _ in known], np.array([f for _, f in known]), new_names, new_feats
+    )
+    with open(pairs, "w", encoding="utf-8") as f:
+        f.write("\n".join(f"{a} {b}" for a, b in pairs_list))
+    print(f"[extend] {len(new_names)} new images, {len(pairs_list)} pairs to match")
+
+    match_features.main(qsp.matcher_conf, pairs, features=feats, matches=matches)
+    model = reconstruction.extend(
+        staging / "sfm", images_dir, pairs, feats, matches, image_list=new_names
+    )
+    return model, new_feats
+
+
+def extend_map(model_dir, images_dir, new_names):
+    """
+    Register new database images into the map of model_dir.
+
+    return:
+        the extended reconstruction, or None if the mapper failed
+    """
+    model_dir, images_dir = Path(model_dir), Path(images_dir)
+    for name in new_names:
+        if not name.startswith("db/"):
+            raise ValueError(f"Database images must be under db/: {name}")
+    with extension_lock(model_dir):
+        staging = model_dir / STAGING_DIR
+        stage_map(model_dir, staging)
+        try:
+            model, new_feats = extend_staged(staging, images_dir, new_names,
+                                             model_dir / "disk_global.h5")
+            if model is not None:
+                swap_map(model_dir, staging)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        if model is None:
+            return None
+
+        # only registered images are retrievable, the others would waste a slot
+        registered = {image.name for image in model.images.values() if image.has_pose}
+        keep = [i for i, n in enumerate(new_names) if n in registered]
+        if keep:
+            qsp.update_disk_global_db(
+                model_dir / "disk_global.h5",
+                [new_names[i][len("db/"):] for i in keep],
+                new_feats[keep],
+            )
+    print(f"[extend] registered {len(keep)}/{len(new_names)} new images, "
+          f"{model.num_reg_images()} images and {model.num_points3D()} points in the map")
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=Path, required=True, help="model_file of query_sfm_pose")
+    parser.add_argument("--images", type=Path, required=True, help="image directory of the map")
+    parser.add_argument("--list", type=Path, help="file with one new image name per line")
+    parser.add_argument("names", nargs="*", help="new image names, relative to --images")
+    args = parser.parse_args()
+
+    names = list(args.names)
+    if args.list is not None:
+        names += [n.strip() for n in args.list.read_text().splitlines() if n.strip()]
+    if not names:
+        parser.error("no new images given")
+    extend_map(args.model, args.images, list(dict.fromkeys(names)))
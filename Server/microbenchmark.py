@@ -0,0 +1,450 @@
+"""
+Microbenchmarks of the hot functions of the localization pipeline.
+
+Each case builds deterministic synthetic inputs of realistic size once, then
+times a single function call over several rounds, pytest-benchmark style:
+the number of calls per round is calibrated so that a round lasts at least
+MIN_ROUND_S, garbage collection is disabled while timing, and the report gives
+min / median / mean / stddev / IQR per call. Cases whose function consumes its
+input (in-place updates, files written next to the input) rebuild it before
+every round, outside the timed region.
+
+    python microbenchmark.py                       # all cases
+    python microbenchmark.py -k pairs --save base.json
+    python microbenchmark.py -k pairs --compare base.json
+
+Numbers are only comparable on the same machine with the same --threads; the
+comparison marks a change as significant when it exceeds the IQR of both runs.
+"""
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+os.environ.setdefault("OMP_NUM_THREADS", "1")   # BLAS threads, before numpy is imported
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import platform
+import shutil
+import tempfile
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pycolmap
+import torch
+
+from hloc import localize_sfm, logger, match_dense, match_features, pairs_from_retrieval
+from hloc.utils.parsers import names_to_pair
+from hloc.utils.read_write_model import read_images_binary, read_points3D_binary
+
+import utils
+
+# Timing
+MIN_ROUND_S = 0.02            # calls per round are calibrated to last at least this
+MIN_ROUNDS = 5
+MAX_ROUNDS = 100
+MIN_TIME_S = 1.0              # keep adding rounds until this much time was spent
+
+# Synthetic scene: cameras on a circle looking out at points on a cylinder
+IMAGE_SIZE = (1024, 768)
+FOCAL_PX = 800.0
+SCENE_IMAGES = 300
+SCENE_POINTS = 200000
+MAX_KEYPOINTS = 4000          # observations per database image
+QUERY_KEYPOINTS = 4000
+QUERY_DISTRACTORS = 1000      # query keypoints without a 3D point
+RETRIEVED = 20                # database images matched to the query
+MATCH_RECALL = 0.8
+MATCH_OUTLIERS = 0.05
+
+CASES = {}
+
+
+def case(name):
+    def register(fn):
+        CASES[name] = fn
+        return fn
+    return register
+
+
+# ---------------------------------------------------------------- timing
+
+def measure(fn, setup=None, min_time=MIN_TIME_S):
+    """Time fn() (or fn(*setup()) when the input must be rebuilt each round)."""
+    if setup is None:
+        tic = time.perf_counter()
+        fn()
+        single = time.perf_counter() - tic
+        iterations = max(1, int(np.ceil(MIN_ROUND_S / max(single, 1e-9))))
+    else:
+        fn(*setup())
+        iterations = 1
+
+    times = []
+    total = 0.0
+    gc_enabled = gc.isenabled()
+    try:
+        while len(times) < MAX_ROUNDS and (len(times) < MIN_ROUNDS or total < min_time):
+            args = setup() if setup is not None else ()
+            gc.collect()
+            gc.disable()
+            tic = time.perf_counter()
+            for _ in range(iterations):
+                fn(*args)
+            elapsed = time.perf_counter() - tic
+            if gc_enabled:
+                gc.enable()
+            times.append(elapsed / iterations)
+            total += elapsed
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    times = np.array(times)
+    q1, q3 = np.percentile(times, [25, 75])
+    return {
+        "min": float(times.min()),
+        "median": float(np.median(times)),
+        "mean": float(times.mean()),
+        "stddev": float(times.std(ddof=1)) if len(times) > 1 else 0.0,
+        "iqr": float(q3 - q1),
+        "rounds": len(times),
+        "iterations": iterations,
+    }
+
+
+# ---------------------------------------------------------------- scene
+
+def camera_pose(theta, radius=3.0):
+    C = np.array([radius * np.cos(theta), radius * np.sin(theta), 0.0])
+    z = np.array([np.cos(theta), np.sin(theta), 0.0])
+    x = np.cross(z, [0.0, 0.0, 1.0])
+    y = np.cross(z, x)
+    R = np.stack([x, y, z])
+    return R, -R @ C
+
+
+def project(R, t, X):
+    w, h = IMAGE_SIZE
+    Xc = X @ R.T + t
+    uv = FOCAL_PX * Xc[:, :2] / Xc[:, 2:] + [w / 2, h / 2]
+    visible = ((Xc[:, 2] > 0.1) & (uv[:, 0] >= 0) & (uv[:, 0] < w)
+               & (uv[:, 1] >= 0) & (uv[:, 1] < h))
+    return uv, visible
+
+
+@lru_cache(maxsize=1)
+def make_scene(seed):
+    """SfM model with SCENE_IMAGES images observing up to MAX_KEYPOINTS points each."""
+    rng = np.random.default_rng(seed)
+    phi = rng.uniform(0, 2 * np.pi, SCENE_POINTS)
+    r = rng.uniform(9, 11, SCENE_POINTS)
+    X = np.stack([r * np.cos(phi), r * np.sin(phi), rng.uniform(-4, 4, SCENE_POINTS)], 1)
+
+    rec = pycolmap.Reconstruction()
+    rec.add_camera_with_trivial_rig(pycolmap.Camera.create_from_model_name(
+        1, "SIMPLE_PINHOLE", FOCAL_PX, *IMAGE_SIZE))
+    observed = []               # per image: index in X of each keypoint
+    tracks = []
+    for i in range(SCENE_IMAGES):
+        R, t = camera_pose(2 * np.pi * i / SCENE_IMAGES)
+        uv, visible = project(R, t, X)
+        ids = rng.permutation(np.flatnonzero(visible))[:MAX_KEYPOINTS]
+        kps = uv[ids] + rng.normal(0, 0.5, (len(ids), 2))
+        image = pycolmap.Image(name=f"db/{i:04d}.jpg", keypoints=kps, camera_id=1, image_id=i + 1)
+        rec.add_image_with_trivial_frame(image, pycolmap.Rigid3d(pycolmap.Rotation3d(R), t))
+        observed.append(ids)
+        tracks.append(np.stack([ids, np.full(len(ids), i + 1), np.arange(len(ids))], 1))
+
+    tracks = np.concatenate(tracks)
+    tracks = tracks[np.argsort(tracks[:, 0], kind="stable")]
+    starts = np.flatnonzero(np.diff(tracks[:, 0], prepend=-1))
+    point3D_ids = np.full(SCENE_POINTS, -1)
+    for elements in np.split(tracks, starts[1:]):
+        if len(elements) < 2:
+            continue
+        track = pycolmap.Track()
+        for _, image_id, point2D_idx in elements:
+            track.add_element(int(image_id), int(point2D_idx))
+        point3D_ids[elements[0, 0]] = rec.add_point3D(X[elements[0, 0]], track)
+    return {"rec": rec, "X": X, "observed": observed, "point3D_ids": point3D_ids}
+
+
+def make_query(scene, rng, tmp):
+    """Query features and matches to its RETRIEVED nearest database images."""
+    X, rec = scene["X"], scene["rec"]
+    theta = 2 * np.pi * 10.5 / SCENE_IMAGES
+    R, t = camera_pose(theta)
+    uv, visible = project(R, t, X)
+    ids = rng.permutation(np.flatnonzero(visible & (scene["point3D_ids"] != -1)))
+    ids = ids[:QUERY_KEYPOINTS]
+    kps = np.concatenate([
+        uv[ids] + rng.normal(0, 0.5, (len(ids), 2)),
+        rng.uniform(0, 1, (QUERY_DISTRACTORS, 2)) * IMAGE_SIZE,
+    ]).astype(np.float32)
+    query_index = np.full(len(X), -1)
+    query_index[ids] = np.arange(len(ids))
+
+    qname = "query/0000.jpg"
+    features, matches = tmp / "features.h5", tmp / "matches.h5"
+    with h5py.File(str(features), "w") as fd:
+        fd.create_group(qname).create_dataset("keypoints", data=kps)
+    db_ids = list(range(11 - RETRIEVED // 2, 11 + RETRIEVED - RETRIEVED // 2))
+    with h5py.File(str(matches), "w") as fd:
+        for image_id in db_ids:
+            observed = scene["observed"][image_id - 1]
+            matches0 = np.full(len(kps), -1, dtype=np.int32)
+            db_idx = np.flatnonzero(query_index[observed] != -1)
+            db_idx = db_idx[rng.random(len(db_idx)) < MATCH_RECALL]
+            matches0[query_index[observed[db_idx]]] = db_idx
+            outliers = rng.random(len(kps)) < MATCH_OUTLIERS
+            matches0[outliers] = rng.integers(0, len(observed), outliers.sum())
+            grp = fd.create_group(names_to_pair(qname, rec.images[image_id].name))
+            grp.create_dataset("matches0", data=matches0)
+            grp.create_dataset("matching_scores0", data=rng.random(len(kps)).astype(np.float16))
+    camera = pycolmap.Camera.create_from_model_name(0, "SIMPLE_PINHOLE", FOCAL_PX, *IMAGE_SIZE)
+    return qname, camera, db_ids, features, matches
+
+
+def make_dense_matches(rng, path, num_images=30, pairs_per_image=4,
+                       keypoints=3000, matches=1500):
+    """Dense (keypoints0, keypoints1, scores) pairs as written by match_dense."""
+    w, h = IMAGE_SIZE
+    grid = {f"db/{i:04d}.jpg": rng.uniform(0, 1, (keypoints, 2)) * [w, h] for i in range(num_images)}
+    names = sorted(grid)
+    pairs = set()
+    for i, name0 in enumerate(names):
+        for j in rng.choice(num_images - 1, pairs_per_image, replace=False):
+            name1 = names[j + (j >= i)]
+            if (name1, name0) not in pairs:
+                pairs.add((name0, name1))
+    pairs = sorted(pairs)
+    with h5py.File(str(path), "w") as fd:
+        for name0, name1 in pairs:
+            idx0 = rng.choice(keypoints, matches, replace=False)
+            idx1 = rng.choice(keypoints, matches, replace=False)
+            grp = fd.create_group(names_to_pair(name0, name1))
+            grp.create_dataset("keypoints0", data=grid[name0][idx0] + rng.normal(0, 0.5, (matches, 2)))
+            grp.create_dataset("keypoints1", data=grid[name1][idx1] + rng.normal(0, 0.5, (matches, 2)))
+            grp.create_dataset("scores", data=rng.random(matches).astype(np.float32))
+    return pairs, set(names)
+
+
+# ---------------------------------------------------------------- cases
+
+@case("localize_sfm.pose_from_cluster")
+def case_pose_from_cluster(rng, tmp, seed):
+    scene = make_scene(seed)
+    qname, camera, db_ids, features, matches = make_query(scene, rng, tmp)
+    localizer = localize_sfm.QueryLocalizer(
+        scene["rec"], {"estimation": {"ransac": {"max_error": 12}}})
+    pycolmap.set_random_seed(seed)
+
+    def fn():
+        localize_sfm.pose_from_cluster(localizer, qname, camera, db_ids, features, matches)
+    return fn, None
+
+
+@case("localize_sfm.do_covisibility_clustering")
+def case_covisibility_clustering(rng, tmp, seed):
+    rec = make_scene(seed)["rec"]
+    # retrieval hits in two places of the scene
+    half = SCENE_IMAGES // 2
+    frame_ids = list(range(1, 26)) + list(range(half + 1, half + 26))
+    return (lambda: localize_sfm.do_covisibility_clustering(frame_ids, rec)), None
+
+
+@case("read_write_model.read_images_binary")
+def case_read_images_binary(rng, tmp, seed):
+    path = tmp / "model"
+    path.mkdir()
+    make_scene(seed)["rec"].write_binary(str(path))
+    return (lambda: read_images_binary(path / "images.bin")), None
+
+
+@case("read_write_model.read_points3D_binary")
+def case_read_points3D_binary(rng, tmp, seed):
+    path = tmp / "model"
+    path.mkdir()
+    make_scene(seed)["rec"].write_binary(str(path))
+    return (lambda: read_points3D_binary(path / "points3D.bin")), None
+
+
+@case("pairs_from_retrieval.pairs_from_score_matrix")
+def case_pairs_from_score_matrix(rng, tmp, seed):
+    num_query, num_db = 1000, 10000
+    scores = torch.from_numpy(rng.random((num_query, num_db), dtype=np.float32))
+    invalid = rng.random((num_query, num_db)) < 0.01
+
+    def setup():
+        return scores.clone(), invalid.copy()
+
+    def fn(scores, invalid):
+        pairs_from_retrieval.pairs_from_score_matrix(scores, invalid, 50, min_score=0.1)
+    return fn, setup
+
+
+@case("match_features.find_unique_new_pairs")
+def case_find_unique_new_pairs(rng, tmp, seed):
+    names = [f"db/{i:05d}.jpg" for i in range(2000)]
+    idx = rng.integers(0, len(names), (100000, 2))
+    pairs = [(names[i], names[j]) for i, j in idx]
+    reverse = rng.random(len(pairs)) < 0.3
+    pairs += [(j, i) for (i, j), r in zip(pairs, reverse) if r]
+    return (lambda: match_features.find_unique_new_pairs(pairs)), None
+
+
+@case("match_features.find_unique_new_pairs[existing]")
+def case_find_unique_new_pairs_existing(rng, tmp, seed):
+    names = [f"db/{i:05d}.jpg" for i in range(500)]
+    idx = rng.integers(0, len(names), (10000, 2))
+    pairs = [(names[i], names[j]) for i, j in idx]
+    path = tmp / "matches.h5"
+    with h5py.File(str(path), "w") as fd:
+        for i, j in pairs[::2]:
+            pair = names_to_pair(i, j)
+            if pair not in fd:
+                fd.create_group(pair).create_dataset("matches0", data=np.zeros(1, np.int32))
+    return (lambda: match_features.find_unique_new_pairs(pairs, path)), None
+
+
+@case("match_dense.assign_keypoints")
+def case_assign_keypoints(rng, tmp, seed):
+    w, h = IMAGE_SIZE
+    cpts = rng.uniform(0, 1, (8000, 2)) * [w, h]
+    kpts = cpts[rng.permutation(len(cpts))] + rng.normal(0, 1, cpts.shape)
+    return (lambda: match_dense.assign_keypoints(kpts, cpts, 2.0)), None
+
+
+@case("match_dense.assign_keypoints[update]")
+def case_assign_keypoints_update(rng, tmp, seed):
+    w, h = IMAGE_SIZE
+    cpts0 = match_dense.to_cpts(rng.uniform(0, 1, (4000, 2)) * [w, h], 8)
+    bins0 = [Counter({cpt: 1.0}) for cpt in cpts0]
+    kpts = rng.uniform(0, 1, (4000, 2)) * [w, h]
+    scores = rng.random(len(kpts))
+
+    def setup():
+        return list(cpts0), [Counter(b) for b in bins0]
+
+    def fn(cpts, bins):
+        match_dense.assign_keypoints(kpts, cpts, 2.0, True, bins, scores, 8)
+    return fn, setup
+
+
+@case("match_dense.aggregate_matches")
+def case_aggregate_matches(rng, tmp, seed):
+    template = tmp / "template.h5"
+    pairs, names = make_dense_matches(rng, template)
+    conf = match_dense.confs["loftr_aachen"]
+    matches, features = tmp / "matches.h5", tmp / "features.h5"
+
+    def setup():
+        shutil.copyfile(template, matches)
+        features.unlink(missing_ok=True)
+        return ()
+
+    def fn():
+        match_dense.aggregate_matches(conf, pairs, matches, features, set(names),
+                                      cpdict=defaultdict(list), bindict=defaultdict(list))
+    return fn, setup
+
+
+@case("utils.estimate_sim3_ransac")
+def case_estimate_sim3_ransac(rng, tmp, seed):
+    # SfM centers vs AR session centers of the localized frames, 30% outliers
+    n = 300
+    X = rng.uniform(-3, 3, (n, 3))
+    angle = rng.normal(size=3)
+    R = pycolmap.Rotation3d(angle / np.linalg.norm(angle) * 0.7).matrix()
+    Y = 2.5 * X @ R.T + [1.0, -2.0, 0.5] + rng.normal(0, 0.02, (n, 3))
+    outliers = rng.random(n) < 0.3
+    Y[outliers] += rng.normal(0, 2.0, (outliers.sum(), 3))
+
+    def fn():
+        # max_trials is always exhausted with outliers, so the work is constant
+        with contextlib.redirect_stdout(io.StringIO()):
+            utils.estimate_sim3_ransac(X, Y, th_init=0.5, th_refine=0.25,
+                                       max_trials=1000, min_inliers=4)
+    return fn, None
+
+
+# ---------------------------------------------------------------- report
+
+def run(names, seed, min_time):
+    results = {}
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmp:
+            rng = np.random.default_rng(seed)
+            torch.manual_seed(seed)
+            tic = time.perf_counter()
+            fn, setup = CASES[name](rng, Path(tmp), seed)
+            print(f"[bench] {name}: setup {time.perf_counter() - tic:.1f}s", flush=True)
+            results[name] = measure(fn, setup, min_time)
+    return results
+
+
+def print_table(results, baseline=None):
+    print(f"\n{'case':<48}{'min':>12}{'median':>12}{'mean':>12}{'stddev':>12}"
+          f"{'iqr':>12}{'rounds':>8}" + (f"{'vs base':>16}" if baseline else ""))
+    for name, r in results.items():
+        line = (f"{name:<48}" + "".join(f"{1e3 * r[k]:>10.3f}ms" for k in
+                                        ("min", "median", "mean", "stddev", "iqr"))
+                + f"{r['rounds']:>8}")
+        if baseline and name in baseline:
+            b = baseline[name]
+            ratio = r["median"] / b["median"]
+            noise = max(r["iqr"] / r["median"], b["iqr"] / b["median"])
+            verdict = "~" if abs(ratio - 1) <= noise else ("faster" if ratio < 1 else "slower")
+            line += f"{ratio:>9.2f}x {verdict:<6}"
+        print(line)
+
+
+def environment(threads, seed):
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "pycolmap": pycolmap.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "threads": threads,
+        "seed": seed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="filter", help="only run cases whose name contains this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1, help="torch intra-op threads")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME_S, help="seconds per case")
+    parser.add_argument("--save", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="JSON file of a previous --save")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args()
+
+    names = [n for n in CASES if args.filter is None or args.filter in n]
+    if args.list:
+        print("\n".join(names))
+        raise SystemExit
+    torch.set_num_threads(args.threads)
+    logger.setLevel("WARNING")
+
+    results = run(names, args.seed, args.min_time)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"environment": environment(args.threads, args.seed), "results": results},
+                      f, indent=2)
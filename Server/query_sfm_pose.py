@@ -1,4 +1,6 @@
 import os
+import re
+import time
 import torch
 import numpy as np
 from pathlib import Path
@@ -8,18 +10,35 @@ from scipy.spatial.transform import Rotation as R
 import h5py
 import torch
 from PIL import Image
+from scipy.spatial import cKDTree
 
 from hloc import extract_features, extract_features_single, match_features
-from hloc.localize_sfm import QueryLocalizer, pose_from_cluster
+from hloc.utils.io import get_keypoints, get_matches
+from hloc.utils.packed import h5_to_packed, open_packed, write_packed
+from hloc.utils.tracing import end_trace, record, stage, start_trace
 
 
-# Global SfM cache (loaded once and reused across queries)
+# Global SfM cache (memory maps opened once per process and reused across queries)
 GLOBAL_SFM_CACHE = { 
     "init": False,
     "models": {},
     "references": None,
+    "global_db": {},
+    "ref_feats": {},
 }
 
+# The reconstruction and the database features are converted once into packed,
+# memory-mapped stores next to the model, so that all localization worker
+# processes share them through the OS page cache instead of each holding a copy.
+# Their names include the modification time (ns) and size of the source so that
+# a rebuilt or extended model is converted again. The superseded versions are
+# removed once the new one is published.
+MODEL_MAP_NAME = "model-{version}.packed"
+REF_FEATS_NAME = "{output}-{version}.packed"
+QUERY_DIR = "queries"   # per-process query features, matches and pairs
+EXTEND_LOCK = ".extending"   # held in the model directory by extend_map.py, with its pid
+EXTEND_SWAP_WAIT = 30.0       # max wait (s) for an extension to swap in sfm/
+
 
 # Feature extraction and matching configuration
 feat_conf = {
@@ -34,27 +53,110 @@ matcher_conf = {
     "loader": {"batch_size": 1, "num_workers": 0, "shuffle": False},
 }
 
+# Coarse pass: cheaper DISK extraction matched against fewer references.
+# The query is only re-extracted with feat_conf when this pass is not confident.
+coarse_feat_conf = {
+    "output": "feats-disk-coarse",
+    "preprocessing": {"grayscale": False, "resize_max": 1024},
+    "model": {"name": "disk", "max_keypoints": 2048},
+    "loader": {"batch_size": 1, "num_workers": 0, "shuffle": False},
+}
+
 TOPK=10 # the number of pre-retrival
+COARSE_TOPK = 3               # references matched in the coarse pass
+COARSE_MIN_INLIERS = 100      # accept the coarse pose above this many PnP inliers
+COARSE_MAX_REPROJ_ERR = 4.0   # ... and below this mean inlier reprojection error (px)
+
+# Pose prior: restrict retrieval to database images near the predicted query pose
+PRIOR_MAX_ANGLE_DEG = 60.0    # max angle between the optical axes of query and database image
+PRIOR_MIN_CANDIDATES = TOPK   # fewer candidates than this and the prior is ignored
+
+# PnP configuration shared by both passes
+loc_conf = {
+    "estimation": {
+        "estimate_focal_length": True, # estimated focal length
+        "ransac": {"max_error": 12.0}},
+    "refinement": {
+        "refine_focal_length": True,
+        "refine_extra_params": True
+    },
+}
+
+# PnP once the session intrinsics are locked: P3P without focal estimation
+# and a smaller RANSAC budget
+fixed_loc_conf = {
+    "estimation": {
+        "estimate_focal_length": False,
+        "ransac": {"max_error": 12.0, "max_num_trials": 1000, "confidence": 0.999}},
+    "refinement": {
+        "refine_focal_length": False,
+        "refine_extra_params": False
+    },
+}
+
+# Guided matching: with locked intrinsics and a pose prior, the coarse pass matches
+# query keypoints to projected 3D points instead of running LightGlue
+GUIDED_MATCHING = False
+GUIDED_RADIUS_PX = 40.0       # search radius around each projected 3D point (px)
+GUIDED_MIN_SIM = 0.8          # min cosine similarity of DISK descriptors
 
 
 # Global descriptor utilities
 def load_disk_global_db(h5_path):
     """
     Load precomputed global DISK descriptors for database images.
+    Cached per process until the file is replaced (e.g. by extend_map.py).
 
     """
+    key = str(Path(h5_path).resolve())
+    mtime = Path(h5_path).stat().st_mtime_ns
+    cached = GLOBAL_SFM_CACHE["global_db"].get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
     with h5py.File(h5_path, "r") as f:
         names = [n.decode() for n in f["names"][()]]   
         feats = f["descriptors"][()]                  
+    GLOBAL_SFM_CACHE["global_db"][key] = (mtime, names, feats)
     return names, feats
 
+
+def disk_global_descriptors(feats_h5_path, names):
+    """
+    Global descriptors of database images, mean-pooled from their DISK
+    descriptors like those of the queries.
+
+    """
+    with h5py.File(feats_h5_path, "r") as f:
+        descs = np.stack([f[n]["descriptors"][()].astype(np.float32).mean(axis=1) for n in names])
+    return descs / np.linalg.norm(descs, axis=1, keepdims=True)
+
+
+def update_disk_global_db(h5_path, names, descs):
+    """
+    Add database images to disk_global.h5, replacing those already present.
+    names are relative to db/. The file is written under a temporary name and
+    moved in place, so that readers never see a partial file.
+
+    """
+    h5_path = Path(h5_path)
+    db = {}
+    if h5_path.exists():
+        with h5py.File(h5_path, "r") as f:
+            db = dict(zip((n.decode() for n in f["names"][()]), f["descriptors"][()]))
+    db.update(zip(names, descs))
+    tmp = h5_path.with_name(f"{h5_path.name}.{os.getpid()}.tmp")
+    with h5py.File(tmp, "w") as f:
+        f.create_dataset("names", data=np.array([n.encode() for n in db]))
+        f.create_dataset("descriptors", data=np.stack(list(db.values())))
+    os.replace(tmp, h5_path)
+
 def compute_query_disk_global(feats_h5_path, query_rel_path):
     """
     Compute a global descriptor for a query image
     using mean pooling over DISK local descriptors.
 
     """
-    with h5py.File(feats_h5_path, "r") as f:
+    with stage("global_descriptor"), h5py.File(feats_h5_path, "r") as f:
         desc = f[query_rel_path]["descriptors"][()]   
         desc = desc.astype(np.float32).T              
         g = desc.mean(axis=0)
@@ -62,124 +164,534 @@ def compute_query_disk_global(feats_h5_path, query_rel_path):
         return g   
 
 
-# SfM model loading (cached)
-def load_sfm_model_once(model_root):
+# Shared model maps
+def publish_dir(path, build_fn):
     """
-    Load a SfM reconstruction only once
-    and cache it in memory for subsequent queries.
+    Build a directory under a temporary name and move it in place, so that
+    readers never see a partial build. If several processes build the same
+    directory concurrently, the first one wins.
 
     """
-    model_root = str(Path(model_root).resolve())
+    path = Path(path)
+    if path.exists():
+        return path
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    build_fn(tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+def prune_versions(directory, name_fmt, current, **fmt):
+    """
+    Remove the published versions of name_fmt in directory older than current.
+    Their files are unlinked, so workers that still map them keep reading them.
+
+    """
+    pattern = re.escape(name_fmt.format(version="{version}", **fmt))
+    pattern = re.compile(pattern.replace(re.escape("{version}"), r"(\d+)-\d+"))
+    newest = int(pattern.fullmatch(Path(current).name).group(1))
+    for path in Path(directory).iterdir():
+        match = pattern.fullmatch(path.name)
+        if match is not None and int(match.group(1)) < newest:
+            print(f"Removing superseded {path.name}")
+            shutil.rmtree(path, ignore_errors=True)
 
-    if model_root in GLOBAL_SFM_CACHE["models"]:
-        return GLOBAL_SFM_CACHE["models"][model_root]["model"], \
-               GLOBAL_SFM_CACHE["models"][model_root]["references"]
 
-    sfm_path = Path(model_root) / "sfm"
+def build_model_map(sfm_path, out_dir):
+    """
+    Export what localization needs from a reconstruction: the 3D points and,
+    for each registered image, its pose and the 3D point of each keypoint.
+
+    """
     model = pycolmap.Reconstruction(sfm_path)
+    images = {model.images[i].name: model.images[i] for i in model.reg_image_ids()}
+
+    def read_fn(name):
+        image = images[name]
+        p3d = [p.point3D_id if p.has_point3D() else -1 for p in image.points2D]
+        yield "point3D_ids", np.array(p3d, dtype=np.int64), {}
+        yield "cam_from_world", image.cam_from_world().matrix(), {}
+
+    entries = [
+        (n, {"point3D_ids": ((len(images[n].points2D),), np.int64),
+             "cam_from_world": ((3, 4), np.float64)})
+        for n in sorted(images)
+    ]
+    # write_packed replaces the whole directory, the points are added after it
+    write_packed(out_dir, entries, read_fn)
+
+    ids = np.array(sorted(model.points3D.keys()), dtype=np.int64)
+    xyz = np.array([model.points3D[int(i)].xyz for i in ids], dtype=np.float64)
+    np.save(out_dir / "points3D_ids.npy", ids)
+    np.save(out_dir / "points3D_xyz.npy", xyz.reshape(-1, 3))
+    print(f"Exported {len(images)} registered DB images and {len(ids)} points to {out_dir}.")
+
+
+def file_version(*paths):
+    """
+    Version of a set of files: their latest modification time (ns) and total size.
+
+    """
+    stats = [Path(p).stat() for p in paths]
+    return f"{max(st.st_mtime_ns for st in stats)}-{sum(st.st_size for st in stats)}"
+
 
-    references = [model.images[i].name for i in model.reg_image_ids()]
+def extension_running(model_root):
+    """
+    Whether extend_map.py is extending the map of model_root. A lock left over
+    by an extension that died is ignored.
+
+    """
+    try:
+        pid = int((Path(model_root) / EXTEND_LOCK).read_text())
+    except (FileNotFoundError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass   # alive, but owned by another user
+    return True
 
-    GLOBAL_SFM_CACHE["models"][model_root] = {
-        "model": model,
-        "references": references
+
+def open_model_map(model_root, cache):
+    """
+    Open the model map of the current version of model_root/sfm into cache,
+    exporting it if needed.
+
+    """
+    sfm_path = model_root / "sfm"
+    version = file_version(*sfm_path.iterdir())
+    if cache.get("version") == version:
+        return cache["map"]
+
+    path = publish_dir(
+        model_root / MODEL_MAP_NAME.format(version=version),
+        lambda tmp: build_model_map(sfm_path, tmp),
+    )
+    model_map = {
+        "store": open_packed(path),
+        "points3D_ids": np.load(path / "points3D_ids.npy", mmap_mode="r"),
+        "points3D_xyz": np.load(path / "points3D_xyz.npy", mmap_mode="r"),
     }
+    # first use, or the model was rebuilt or extended: drop what derives from it
+    cache.clear()
+    cache["version"] = version
+    cache["map"] = model_map
+    prune_versions(model_root, MODEL_MAP_NAME, path)
+    return model_map
+
+
+def load_model_map_once(model_root):
+    """
+    Open the memory-mapped model map of an SfM reconstruction,
+    exporting it on first use and again when the model is rebuilt or extended.
+    While extend_map.py extends the model, the current map is kept, and a
+    process without a map waits for sfm/ to be swapped in if it is missing.
+
+    """
+    model_root = Path(model_root).resolve()
+    cache = GLOBAL_SFM_CACHE["models"].setdefault(str(model_root), {})
+    if "map" in cache and extension_running(model_root):
+        return cache["map"]
+    deadline = time.monotonic() + EXTEND_SWAP_WAIT
+    while True:
+        try:
+            return open_model_map(model_root, cache)
+        except (OSError, ValueError):
+            if not extension_running(model_root) or time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def load_ref_features_once(feats_h5):
+    """
+    Packed, memory-mapped copy of the database features, created on first use
+    and again when the features are replaced.
+
+    """
+    feats_h5 = Path(feats_h5).resolve()
+    version = file_version(feats_h5)
+    name = REF_FEATS_NAME.format(output=feats_h5.stem, version=version)
+    path = publish_dir(feats_h5.parent / name, lambda tmp: h5_to_packed(feats_h5, tmp))
+    if GLOBAL_SFM_CACHE["ref_feats"].get(str(feats_h5)) != version:
+        GLOBAL_SFM_CACHE["ref_feats"][str(feats_h5)] = version
+        prune_versions(feats_h5.parent, REF_FEATS_NAME, path, output=feats_h5.stem)
+    return path
+
 
-    print(f"Loaded {len(references)} registered DB images into RAM.")
+def lookup_points3D(model_map, point3D_ids):
+    """
+    Coordinates of the given 3D point ids.
+
+    """
+    idx = np.searchsorted(model_map["points3D_ids"], point3D_ids)
+    return np.asarray(model_map["points3D_xyz"][idx])
+
+
+def load_db_geometry_once(model_root, model_map, db_names):
+    """
+    Camera centers and optical axes (SfM frame) of the database images,
+    aligned with db_names. Images missing from the model are NaN.
+
+    """
+    model_root = str(Path(model_root).resolve())
+    cache = GLOBAL_SFM_CACHE["models"][model_root]
+    if cache.get("db_names") is db_names:
+        return cache["db_centers"], cache["db_axes"]
+
+    centers = np.full((len(db_names), 3), np.nan)
+    axes = np.full((len(db_names), 3), np.nan)
+    store = model_map["store"]
+    for i, n in enumerate(db_names):
+        if f"db/{n}" not in store:
+            continue
+        T_cw = store.get(f"db/{n}", "cam_from_world")
+        R_cw = T_cw[:, :3]
+        centers[i] = -R_cw.T @ T_cw[:, 3]
+        axes[i] = R_cw[2]  # camera +z in world coordinates
+
+    cache["db_names"], cache["db_centers"], cache["db_axes"] = db_names, centers, axes
+    return centers, axes
 
-    return model, references
 
 # Retrieval
-def retrieve_topk_disk(db_names, db_global_feats, query_global, k):
+def prior_candidates(db_centers, db_axes, prior):
     """
-    Retrieve top-K database images using cosine similarity.
+    Mask of database images whose view overlaps the predicted query view:
+    within prior["radius"] of prior["center"] and looking in a similar direction.
 
+    return:
+        boolean mask over db_names, or None if the prior is missing or rejected
+    """
+    if prior is None:
+        return None
+    C = np.asarray(prior["center"], float)
+    axis = np.asarray(prior["rotation"], float)[:, 2]
+
+    with np.errstate(invalid="ignore"):
+        near = np.linalg.norm(db_centers - C, axis=1) <= prior["radius"]
+        facing = db_axes @ axis >= np.cos(np.deg2rad(PRIOR_MAX_ANGLE_DEG))
+    mask = near & facing
+    if mask.sum() < PRIOR_MIN_CANDIDATES:
+        print(f"[localize] pose prior rejected: {mask.sum()} candidates")
+        return None
+    return mask
+
+
+def retrieve_topk_disk(db_names, db_global_feats, query_global, k, mask=None):
     """
-    sims = db_global_feats @ query_global     
-    idx = np.argsort(-sims)[:k]
+    Retrieve top-K database images using cosine similarity,
+    optionally among the images selected by mask.
+
+    """
+    with stage("retrieval"):
+        idx = np.arange(len(db_names)) if mask is None else np.flatnonzero(mask)
+        sims = db_global_feats[idx] @ query_global     
+        idx = idx[np.argsort(-sims)[:k]]
     topk = [f"db/{db_names[i]}" for i in idx]  
     return topk
 
-# Main localization pipeline
-def query_sfm_pose(images, query, model_file):
+# Localization stages
+def infer_query_camera(image_path):
     """
-    Localize a query image in an SfM model using:
-      - DISK features
-      - Global descriptor retrieval (Top-K)
-      - LightGlue matching
-      - COLMAP PnP + RANSAC
+    Initial camera for a query image, from EXIF when available.
+
     """
-    
-    images = Path(images)
-    query_rel = str(Path(query).as_posix())
+    try:
+        return pycolmap.infer_camera_from_image(str(image_path))
+    except Exception:
+        with Image.open(image_path) as im:
+            w, h = im.size
+        fx = 1.2 * max(w, h)
+        cx, cy = w / 2.0, h / 2.0
+        return pycolmap.Camera(
+            model="SIMPLE_RADIAL", width=w, height=h, params=[fx, cx, cy, 0.0]
+        )
 
-    base_dir = Path(model_file)
 
-    feats_h5 = base_dir / f"{feat_conf['output']}.h5"
-    matches_h5 = base_dir / f"{matcher_conf['output']}.h5"
+def query_camera(image_path, intrinsics=None):
+    """
+    Camera for a query image. Locked session intrinsics
+    ({"model", "width", "height", "params"}) are used as-is when the image size
+    matches, which skips EXIF inference.
 
-    model, references = load_sfm_model_once(base_dir) 
+    return:
+        (camera, fixed) with fixed True if the intrinsics should not be refined
+    """
+    if intrinsics is not None:
+        with Image.open(image_path) as im:  # only reads the header
+            size = im.size
+        if size == (intrinsics["width"], intrinsics["height"]):
+            camera = pycolmap.Camera(
+                model=intrinsics["model"],
+                width=intrinsics["width"],
+                height=intrinsics["height"],
+                params=intrinsics["params"],
+            )
+            return camera, True
+    return infer_query_camera(image_path), False
+
+
+def inlier_reprojection_error(ret, log):
+    """
+    Mean reprojection error (px) of the PnP inliers under the refined pose.
 
-    disk_global_h5 = base_dir / "disk_global.h5" # load gloabal feature file
-    db_names, db_feats = load_disk_global_db(disk_global_h5)
+    """
+    mask = np.asarray(ret["inlier_mask"], dtype=bool)
+    if not mask.any():
+        return float("inf")
+    p2d = np.asarray(log["keypoints_query"], dtype=np.float64)[mask]
+    p3d = np.asarray(log["points3D_xyz"], dtype=np.float64)[mask]
+
+    T_cw = ret["cam_from_world"]
+    p_cam = p3d @ T_cw.rotation.matrix().T + np.array(T_cw.translation)
+    in_front = p_cam[:, 2] > 0
+    if not in_front.any():
+        return float("inf")
+    proj = np.asarray(ret["camera"].img_from_cam(p_cam[in_front]))
+    return float(np.linalg.norm(proj - p2d[in_front], axis=1).mean())
 
 
-    extract_features_single.main(
-        feat_conf, image_dir=images, image_list=[query_rel], export_dir=base_dir
-    ) # extract disk feature for each single image
+def estimate_pose(p2d, p3d, camera, conf):
+    """
+    PnP + RANSAC and refinement on 2D-3D correspondences, see QueryLocalizer.
+    Returns (ret, log) in the format of pose_from_cluster; ret is None on failure.
+
+    """
+    log = {"keypoints_query": p2d, "points3D_xyz": p3d}
+    if len(p2d) == 0:
+        return None, log
+    with stage("pnp"):
+        ret = pycolmap.estimate_and_refine_absolute_pose(
+            p2d,
+            p3d,
+            camera,
+            estimation_options=conf.get("estimation", {}),
+            refinement_options=conf.get("refinement", {}),
+        )
+    if ret is None or "cam_from_world" not in ret:
+        return None, log
+    ret["camera"] = camera
+    return ret, log
 
-    q_feat = compute_query_disk_global(feats_h5, query_rel)
-    topk_refs = retrieve_topk_disk(db_names, db_feats, q_feat, k=TOPK) # retriving top-k database images in sfm for matching
 
-    loc_pairs = base_dir / "pairs-loc.txt"
+def localize_guided(model_map, query_rel, refs, feats_q, feats_ref, camera, prior):
+    """
+    Match the query keypoints to the 3D points observed by the references,
+    projected with the prior pose, and run PnP + RANSAC on the result.
 
-    with open(loc_pairs, "w", encoding="utf-8") as f:
-        for r in topk_refs:
+    """
+    with stage("guided_matching"):
+        kpq = get_keypoints(feats_q, query_rel)
+        kpq += 0.5  # COLMAP coordinates
+        desc_q = match_features.read_features(feats_q, query_rel)["descriptors"]
+        desc_q = desc_q.astype(np.float32).T
+
+        store = model_map["store"]
+        p3d_ids, p3d_desc = [], []
+        for r in refs:
+            if r not in store:
+                continue
+            ids = store.get(r, "point3D_ids")
+            desc = match_features.read_features(feats_ref, r)["descriptors"].T
+            p3d_ids.append(ids[ids != -1])
+            p3d_desc.append(desc[ids != -1])
+        if not p3d_ids:
+            return None, {"keypoints_query": kpq[:0], "points3D_xyz": np.zeros((0, 3))}
+        p3d_ids, first = np.unique(np.concatenate(p3d_ids), return_index=True)
+        p3d_desc = np.concatenate(p3d_desc).astype(np.float32)[first]
+        p3d = lookup_points3D(model_map, p3d_ids)
+
+        # project with the predicted pose
+        R_cw = np.asarray(prior["rotation"], float).T
+        t_cw = -R_cw @ np.asarray(prior["center"], float)
+        p_cam = p3d @ R_cw.T + t_cw
+        in_front = p_cam[:, 2] > 0
+        if not in_front.any():
+            return None, {"keypoints_query": kpq[:0], "points3D_xyz": np.zeros((0, 3))}
+        p3d, p3d_desc = p3d[in_front], p3d_desc[in_front]
+        uv = np.asarray(camera.img_from_cam(p_cam[in_front]))
+
+        # each query keypoint takes the most similar projected point nearby
+        tree = cKDTree(uv)
+        mkp_idxs, mp3d_idxs = [], []
+        for idx, cands in enumerate(tree.query_ball_point(kpq, GUIDED_RADIUS_PX)):
+            if not cands:
+                continue
+            sims = p3d_desc[cands] @ desc_q[idx]
+            best = int(np.argmax(sims))
+            if sims[best] >= GUIDED_MIN_SIM:
+                mkp_idxs.append(idx)
+                mp3d_idxs.append(cands[best])
+
+    return estimate_pose(kpq[mkp_idxs], p3d[mp3d_idxs], camera, fixed_loc_conf)
+
+
+def localize_against(model_map, images, query_rel, refs, feats_q, feats_ref, matches_h5, loc_pairs,
+                     intrinsics=None):
+    """
+    Match the query against the given references and run PnP + RANSAC.
+    Returns (ret, log) as produced by pose_from_cluster; ret is None on failure.
+
+    """
+    with stage("pairs_write"), open(loc_pairs, "w", encoding="utf-8") as f:
+        for r in refs:
             f.write(f"{query_rel} {r}\n")
 
     match_features.main(
         matcher_conf,
         pairs=loc_pairs,
-        features=feats_h5,
+        features=feats_q,
         matches=matches_h5,
+        features_ref=feats_ref,
         overwrite=True,
-    ) # matching query image features with top-k database images
- 
+    ) # matching query image features with the reference images
+
+    # 2D-3D correspondences, as in hloc's pose_from_cluster
+    with stage("correspondences"):
+        kpq = get_keypoints(feats_q, query_rel)
+        kpq += 0.5  # COLMAP coordinates
+        store = model_map["store"]
+        corrs = [np.zeros((0, 2), dtype=np.int64)]
+        for r in refs:
+            if r not in store:
+                continue
+            point3D_ids = store.get(r, "point3D_ids")
+            matches, _ = get_matches(matches_h5, query_rel, r)
+            ids = point3D_ids[matches[:, 1]]
+            corrs.append(np.stack([matches[:, 0], ids], 1)[ids != -1])
+        corrs = np.unique(np.concatenate(corrs), axis=0)  # avoid duplicate observations
+        p3d = lookup_points3D(model_map, corrs[:, 1])
+
+    with stage("camera_inference"):
+        camera, fixed = query_camera(images / query_rel, intrinsics)
+    return estimate_pose(
+        kpq[corrs[:, 0]], p3d, camera, fixed_loc_conf if fixed else loc_conf
+    )
+
+
+# Main localization pipeline
+def query_sfm_pose(images, query, model_file, prior=None, intrinsics=None):
+    """
+    Localize a query image, see localize_query. The duration of each stage
+    is returned in "timings" (None if tracing is disabled).
+
+    """
+    start_trace()
+    tic = time.perf_counter()
     try:
-        camera = pycolmap.infer_camera_from_image(str(images / query_rel))
-    except Exception:
-        with Image.open(images / query_rel) as im:
-            w, h = im.size
-        fx = 1.2 * max(w, h)
-        fy = fx
-        cx, cy = w / 2.0, h / 2.0
-        camera = pycolmap.Camera(
-            model="SIMPLE_RADIAL", width=w, height=h, params=[fx, cx, cy, 0.0]
-        )
+        result = localize_query(images, query, model_file, prior, intrinsics)
+    finally:
+        record("localize", time.perf_counter() - tic)
+        timings = end_trace()
+    result["timings"] = timings
+    return result
 
-    valid_topk = [
-        r for r in topk_refs
-        if model.find_image_with_name(r).image_id != -1
-    ]
-    ref_ids = [model.find_image_with_name(r).image_id for r in valid_topk]
-
-    conf = {
-        "estimation": {
-            "estimate_focal_length": True, # estimated focal length
-            "ransac": {"max_error": 12.0}},
-        "refinement": {
-            "refine_focal_length": True,
-            "refine_extra_params": True
-        },
-    }
-    localizer = QueryLocalizer(model, conf)
 
-    ret, log = pose_from_cluster(
-        localizer, query_rel, camera, ref_ids, feats_h5, matches_h5
-    )
-    if ret is None or "cam_from_world" not in ret:
-        raise ValueError(f"Localization failed for {query_rel}")
-    print(f"[localize] inliers={ret.get('num_inliers', -1)}, reproj_err={ret.get('reproj_error', -1):.2f}px")
+def localize_query(images, query, model_file, prior=None, intrinsics=None):
+    """
+    Localize a query image in an SfM model using:
+      - DISK features
+      - Global descriptor retrieval (Top-K)
+      - LightGlue matching
+      - COLMAP PnP + RANSAC
+
+    The query is first localized with coarse features against COARSE_TOPK
+    references. Only if that pose has too few inliers or a high reprojection
+    error are full-resolution features extracted and matched against TOPK.
+
+    prior: optional predicted query pose in the SfM frame,
+        {"center": (3,), "rotation": (3,3) R_wc, "radius": search radius}.
+        Retrieval is then limited to database images near that pose, with a
+        fallback to full retrieval if too few remain or localization fails.
+    intrinsics: optional locked session camera {"model", "width", "height", "params"}.
+        Focal length and distortion are then fixed and PnP runs P3P with a
+        reduced RANSAC budget. With a prior as well and GUIDED_MATCHING set,
+        the coarse pass uses guided matching instead of LightGlue.
+    """
+    
+    images = Path(images)
+    query_rel = str(Path(query).as_posix())
+
+    base_dir = Path(model_file)
+
+    # Database side: shared memory maps. Query side: files private to this process.
+    ref_feats = load_ref_features_once(base_dir / f"{feat_conf['output']}.h5")
+    query_dir = base_dir / QUERY_DIR
+    query_dir.mkdir(exist_ok=True)
+    pid = os.getpid()
+    feats_h5 = query_dir / f"{feat_conf['output']}-{pid}.h5"
+    coarse_h5 = query_dir / f"{coarse_feat_conf['output']}-{pid}.h5"
+    matches_h5 = query_dir / f"{matcher_conf['output']}-{pid}.h5"
+    loc_pairs = query_dir / f"pairs-loc-{pid}.txt"
+
+    model_map = load_model_map_once(base_dir)
+
+    disk_global_h5 = base_dir / "disk_global.h5" # load gloabal feature file
+    db_names, db_feats = load_disk_global_db(disk_global_h5)
+    db_centers, db_axes = load_db_geometry_once(base_dir, model_map, db_names)
+    mask = prior_candidates(db_centers, db_axes, prior)
+
+    try:
+        # coarse pass
+        extract_features_single.main(
+            coarse_feat_conf, image_dir=images, image_list=[query_rel], feature_path=coarse_h5
+        )
+        q_feat = compute_query_disk_global(coarse_h5, query_rel)
+        topk_refs = retrieve_topk_disk(db_names, db_feats, q_feat, k=TOPK, mask=mask)
+
+        camera, fixed = None, False
+        if GUIDED_MATCHING and intrinsics is not None and prior is not None:
+            camera, fixed = query_camera(images / query_rel, intrinsics)
+        if fixed:
+            ret, log = localize_guided(
+                model_map, query_rel, topk_refs[:COARSE_TOPK], coarse_h5, ref_feats, camera, prior
+            )
+        else:
+            ret, log = localize_against(
+                model_map, images, query_rel, topk_refs[:COARSE_TOPK],
+                coarse_h5, ref_feats, matches_h5, loc_pairs, intrinsics,
+            )
+        pass_name = "coarse"
+        if ret is not None:
+            reproj_err = inlier_reprojection_error(ret, log)
+            print(f"[localize] coarse inliers={ret['num_inliers']}, reproj_err={reproj_err:.2f}px")
+        if ret is None or ret["num_inliers"] < COARSE_MIN_INLIERS or reproj_err > COARSE_MAX_REPROJ_ERR:
+            # fine pass: full-resolution features, retrieval and matching
+            extract_features_single.main(
+                feat_conf, image_dir=images, image_list=[query_rel], feature_path=feats_h5
+            ) # extract disk feature for each single image
+
+            q_feat = compute_query_disk_global(feats_h5, query_rel)
+            topk_refs = retrieve_topk_disk(db_names, db_feats, q_feat, k=TOPK, mask=mask) # retriving top-k database images in sfm for matching
+
+            ret, log = localize_against(
+                model_map, images, query_rel, topk_refs,
+                feats_h5, ref_feats, matches_h5, loc_pairs, intrinsics,
+            )
+            pass_name = "fine"
+            if ret is None and mask is not None:
+                # the prior may be wrong: retry with full retrieval
+                print("[localize] prior-guided localization failed, using full retrieval")
+                topk_refs = retrieve_topk_disk(db_names, db_feats, q_feat, k=TOPK)
+                ret, log = localize_against(
+                    model_map, images, query_rel, topk_refs,
+                    feats_h5, ref_feats, matches_h5, loc_pairs, intrinsics,
+                )
+            if ret is None:
+                raise ValueError(f"Localization failed for {query_rel}")
+            reproj_err = inlier_reprojection_error(ret, log)
+            print(f"[localize] fine inliers={ret['num_inliers']}, reproj_err={reproj_err:.2f}px")
+    finally:
+        for path in (matches_h5, loc_pairs, coarse_h5, feats_h5):
+            if path.exists():
+                path.unlink()
 
     T_cw = ret["cam_from_world"]
     R_cw = T_cw.rotation.matrix()
@@ -188,11 +700,6 @@ def query_sfm_pose(images, query, model_file):
     C_w = -R_cw.T @ t_cw
     quat_wc = R.from_matrix(R_wc).as_quat()
 
-    if matches_h5.exists():
-        matches_h5.unlink()
-    if loc_pairs.exists():
-        loc_pairs.unlink()
-
     f, cx, cy, k = ret["camera"].params # camera parameters = [f, cx, cy, k] 
 
     return {
@@ -202,10 +709,8 @@ def query_sfm_pose(images, query, model_file):
         "f": float(f),
         "cx": float(cx),
         "cy": float(cy),
-        "k": float(k)},
+        "k": float(k),
+        "width": int(ret["camera"].width),
+        "height": int(ret["camera"].height)},
+        "stage": pass_name,
         }
-    
-
-
-
-
@@ -3,13 +3,18 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 os.environ["OMP_NUM_THREADS"] = "1"
 
 import json
+import multiprocessing
 import socket
 import time
+import traceback
 from queue import Queue
-from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import RLock, Thread
 
 import numpy as np
-from flask import Flask, request, jsonify
+import torch
+from flask import Flask, Response, request, jsonify
 from scipy.spatial.transform import Rotation as Rotate
 
 from utils import (
@@ -17,8 +22,14 @@ from utils import (
     fps_select_next_frame,
     best_score_from_rmse,
     validate_sim3,
+    TemporalPoseFilter,
+    ConvergenceController,
+    is_tracking_reset,
+    session_to_sfm_prior,
+    IntrinsicsCache,
 )
 from query_sfm_pose import query_sfm_pose
+from hloc.utils.tracing import record, record_trace, render_prometheus, stage
 
 # ============================================================
 # Configuration
@@ -35,6 +46,12 @@ FILM_SCENE_FRAME_ROOT = r"E:\mixed_reality\mocker_v5\film_scene_frame"
 
 MAX_QUEUE = 50
 MIN_USED = 4
+# Processes running query_sfm_pose in parallel. Each one loads its own DISK and
+# LightGlue models (and CUDA context), so the default is one per GPU, or two on CPU.
+# Override with the LOCALIZATION_WORKERS environment variable.
+LOCALIZATION_WORKERS = int(os.environ.get("LOCALIZATION_WORKERS", 0)) or (
+    torch.cuda.device_count() if torch.cuda.is_available() else 2
+)
 
 # Coordinate system correction matrices
 Rfix_z90 = Rotate.from_euler("z", 90, degrees=True).as_matrix()
@@ -50,6 +67,14 @@ GLOBAL_STATE = {
     "film_focal_length": None,
     "best_score": None,
     "best_rmse": None,
+    "sim3": None,
+}
+
+# AR session frame: the epoch is incremented whenever tracking is reset
+SESSION = {
+    "epoch": 0,
+    "last_C_sess": None,
+    "last_timestamp_ms": None,
 }
 
 FILM_POSE = None
@@ -63,10 +88,63 @@ used_rotations = []
 used_sfm_positions = []  
 used_sfm_rotations = [] 
 
+# Sliding-window consistency filter between SfM and session poses
+pose_filter = TemporalPoseFilter()
+
+# Stops SfM localization once the film pose is stable
+convergence = ConvergenceController()
+
+# Phone intrinsics, fixed for localization once consistent
+intrinsics = IntrinsicsCache()
+
+# Guards GLOBAL_STATE, SESSION, raw_frames, the used_* lists and the
+# pose_filter / convergence / intrinsics helpers, shared by the request
+# threads, worker_loop and algo_loop
+state_lock = RLock()
+
+# Created in __main__: heavy SfM localization runs outside the server process.
+# Each worker keeps the DISK / LightGlue models loaded, while the SfM model and
+# database features are memory-mapped and shared between workers.
+localizer_pool = None
+
 # Upload queue
 frame_queue = Queue(maxsize=MAX_QUEUE)
 
 
+def init_localization_worker(counter):
+    """
+    Spread the localization workers over the visible GPUs.
+
+    """
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if torch.cuda.device_count() > 1:
+        torch.cuda.set_device(index % torch.cuda.device_count())
+
+
+def create_localizer_pool():
+    return ProcessPoolExecutor(
+        max_workers=LOCALIZATION_WORKERS,
+        initializer=init_localization_worker,
+        initargs=(multiprocessing.Value("i", 0),),
+    )
+
+
+def restart_localizer_pool(broken):
+    """
+    Replace the localization pool after one of its workers died (e.g. out of
+    memory). Pending frames of the broken pool fail and are dropped.
+    Must be called with state_lock held.
+
+    """
+    global localizer_pool
+    if localizer_pool is broken:
+        print("[localize] a localization worker died, restarting the pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        localizer_pool = create_localizer_pool()
+
+
 # ============================================================
 # Flask endpoint
 # ============================================================
@@ -79,32 +157,35 @@ def upload():
     img = request.files["image"]
     name = os.path.basename(img.filename)
     path = os.path.join(UPLOAD_FOLDER, name)
-    img.save(path)
+    with stage("upload_save"):
+        img.save(path)
 
     # Parse upload metadata
-    meta = json.loads(request.form["meta_json"])
+    with stage("upload_parse"):
+        meta = json.loads(request.form["meta_json"])
     movie = meta.get("movieName", None)
     scene = meta.get("sceneName", None)
     frame = meta.get("frameId", None)                       
     from_album = meta.get("isFromAlbum", False)
  
     # Load film pose and SfM model once 
-    if FILM_POSE is None:
-        pose_json_path = os.path.join(
-            FILM_SCENE_FRAME_ROOT,
-            movie,
-            scene,
-            f"{frame}.json"
-        ) 
-
-        with open(pose_json_path, "r", encoding="utf-8") as f:
-            FILM_POSE = json.load(f)
-
-        if CURRENT_SFM_MODEL is None and movie and scene:
-            sfm_path = os.path.join(
-                FILM_SCENE_FRAME_ROOT, movie, scene, "sfm"
-            )
-            CURRENT_SFM_MODEL = sfm_path
+    with state_lock:
+        if FILM_POSE is None:
+            pose_json_path = os.path.join(
+                FILM_SCENE_FRAME_ROOT,
+                movie,
+                scene,
+                f"{frame}.json"
+            ) 
+
+            with open(pose_json_path, "r", encoding="utf-8") as f:
+                FILM_POSE = json.load(f)
+
+            if CURRENT_SFM_MODEL is None and movie and scene:
+                sfm_path = os.path.join(
+                    FILM_SCENE_FRAME_ROOT, movie, scene, "sfm"
+                )
+                CURRENT_SFM_MODEL = sfm_path
 
     # Push frame to processing queue
     try:
@@ -112,12 +193,15 @@ def upload():
             "image_path": path,
             "image_name": name,
             "meta": meta,
+            "t_queued": time.perf_counter(),
         })
     except Exception:
         return jsonify({"success": False, "reason": "queue full"}), 429
 
     # Return current best estimate if available
-    pose = GLOBAL_STATE["film_pose_session"]
+    with state_lock:
+        pose = GLOBAL_STATE["film_pose_session"]
+        film_focal_length = GLOBAL_STATE["film_focal_length"]
     if pose is None:
         return jsonify({
             'success': False,
@@ -136,11 +220,21 @@ def upload():
                 "translation": C_session.tolist(),
                 "rotation_xyzw": quat_session.tolist()
             },
-            "film_focal_length": GLOBAL_STATE["film_focal_length"]
+            "film_focal_length": film_focal_length
         }), 200
 
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Per-stage latency histograms (Prometheus text format), including the stages
+    timed in the localization workers. Disabled with HLOC_TRACING=0.
+
+    """
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
 # ============================================================
 # Worker 1: Session pose preprocessing
 # ============================================================
@@ -152,6 +246,7 @@ def worker_loop():
     """
     while True:
         frame = frame_queue.get()
+        record("queue_wait_upload", time.perf_counter() - frame["t_queued"])
         try:
             process_frame_into_raw_pool(frame)
         except Exception as e:
@@ -178,80 +273,174 @@ def process_frame_into_raw_pool(frame):
     # Camera orientation normalization
     R_sess = R_sess @ Rfix_z90 @ Rfix_x180
 
-    raw_frames.append({
-        "image_name": frame["image_name"],
-        "image_path": frame["image_path"],
-        "C_sess": C_sess,
-        "R_sess": R_sess,
-    })
+    # Tracking loss: poses after a jump live in a new session frame
+    timestamp_ms = meta.get("timestamp_ms", None)
+    with state_lock:
+        if is_tracking_reset(SESSION["last_C_sess"], SESSION["last_timestamp_ms"],
+                             C_sess, timestamp_ms):
+            SESSION["epoch"] += 1
+            print(f"[worker] AR tracking reset detected, session epoch {SESSION['epoch']}")
+        SESSION["last_C_sess"] = C_sess
+        SESSION["last_timestamp_ms"] = timestamp_ms
+
+        raw_frames.append({
+            "image_name": frame["image_name"],
+            "image_path": frame["image_path"],
+            "C_sess": C_sess,
+            "R_sess": R_sess,
+            "epoch": SESSION["epoch"],
+            "t_queued": time.perf_counter(),
+        })
 
 
 # ============================================================
 # Worker 2: FPS selection, SfM localization, Sim3 alignment
 # ============================================================
 
+def reset_alignment():
+    """
+    Forget all correspondences after the AR session frame was reset.
+    Must be called with state_lock held.
+
+    """
+    used_positions.clear()
+    used_rotations.clear()
+    used_sfm_positions.clear()
+    used_sfm_rotations.clear()
+    pose_filter.reset()
+    convergence.reset()
+    GLOBAL_STATE["film_pose_session"] = None
+    GLOBAL_STATE["best_score"] = None
+    GLOBAL_STATE["best_rmse"] = None
+    GLOBAL_STATE["sim3"] = None
+
+
+def select_next_frame(epoch, in_flight=()):
+    """
+    Pick the next frame to localize. Must be called with state_lock held.
+    in_flight: session positions of the frames being localized, which FPS
+    treats as already used.
+
+    return:
+        (frame, epoch) with frame None if nothing should be localized now
+    """
+    if not raw_frames:
+        return None, epoch
+
+    # Tracking loss: drop frames and correspondences of the old session frame
+    if raw_frames[-1]["epoch"] != epoch:
+        epoch = raw_frames[-1]["epoch"]
+        for i in reversed(range(len(raw_frames))):
+            if raw_frames[i]["epoch"] != epoch:
+                raw_frames.pop(i)
+        reset_alignment()
+        return None, epoch
+
+    # Converged: only spot-check a frame every few seconds
+    if not convergence.should_localize(time.time()):
+        while len(raw_frames) > MAX_QUEUE:
+            raw_frames.pop(0)
+        return None, epoch
+
+    # Initialize with the first frame
+    selected_positions = used_positions + list(in_flight)
+    if len(selected_positions) == 0:
+        idx = 0
+    else:
+        # FPS selection
+        raw_positions = [f["C_sess"] for f in raw_frames]
+        idx, dist = fps_select_next_frame(selected_positions, raw_positions)
+        if idx is None:
+            return None, epoch
+    frame = raw_frames.pop(idx)
+    record("queue_wait_select", time.perf_counter() - frame["t_queued"])
+    return frame, epoch
+
+
 def algo_loop():
+    epoch = 0
+    pending = {}  # future -> frame being localized
     while True:
         time.sleep(0.1)  
 
-        if not raw_frames:
-            continue
+        # Keep every localization worker busy
+        with state_lock:
+            while len(pending) < LOCALIZATION_WORKERS:
+                f, epoch = select_next_frame(epoch, [p["C_sess"] for p in pending.values()])
+                if f is None:
+                    break
+                pending[submit_localization(f)] = f
 
-        raw_positions = [f["C_sess"] for f in raw_frames]
+        for future in [fu for fu in pending if fu.done()]:
+            f = pending.pop(future)
+            added = add_frame_to_used_with_sfm(f, future)
+            if added is not None:
+                update_alignment(epoch, added)
 
-        # Initialize with the first frame
-        if len(used_positions) == 0:
-            f = raw_frames.pop(0)
-            add_frame_to_used_with_sfm(f)
-            continue
 
-        # FPS selection
-        idx, dist = fps_select_next_frame(used_positions, raw_positions)
-        if idx is None:
-            continue
+def update_alignment(epoch, added):
+    """
+    Re-estimate the Sim3 after a frame was added and update the film pose.
 
-        f = raw_frames.pop(idx) 
-        add_frame_to_used_with_sfm(f)
+    """
+    with state_lock:
+        if convergence.converged and convergence.check_drift(GLOBAL_STATE["sim3"], *added):
+            # Keep only the latest correspondences and accept new estimates again
+            for used in (used_positions, used_rotations, used_sfm_positions, used_sfm_rotations):
+                del used[:-MIN_USED]
+            GLOBAL_STATE["best_score"] = None
+            GLOBAL_STATE["best_rmse"] = None
 
         if len(used_positions) < MIN_USED:
-            continue
+            return
+        session_pts = list(used_positions)
+        sfm_pts = list(used_sfm_positions)
+        best_rmse = GLOBAL_STATE["best_rmse"]
 
-        # Estimate Sim3 transform
+    # Estimate Sim3 transform
+    with stage("sim3"):
         align = calculate_world_transform(
-            used_positions, used_sfm_positions, allow_scale=True
+            session_pts, sfm_pts, allow_scale=True
         )
-        stats = align.get("stats", {})
-        rmse = stats.get("rmse", None)
-        if rmse is None:
-            continue
+    stats = align.get("stats", {})
+    rmse = stats.get("rmse", None)
+    if rmse is None:
+        return
 
-        if not validate_sim3(align, GLOBAL_STATE["best_rmse"]):
-            continue
+    with stage("validate_sim3"):
+        valid = validate_sim3(align, best_rmse)
+    if not valid:
+        return
 
-        GLOBAL_STATE["best_rmse"] = rmse
+    # Transform film pose into session space
+    s = align["scale"]
+    R_sim3 = np.array(align["rotation_matrix"])
+    t = np.array(align["translation"])
 
-        # Transform film pose into session space
-        s = align["scale"]
-        R_sim3 = np.array(align["rotation_matrix"])
-        t = np.array(align["translation"])
+    C_sfm_film = np.array(FILM_POSE["translation"])
+    R_sfm_film = Rotate.from_quat(np.array(FILM_POSE["rotation"])).as_matrix()
 
-        C_sfm_film = np.array(FILM_POSE["translation"])
-        R_sfm_film = Rotate.from_quat(np.array(FILM_POSE["rotation"])).as_matrix()
+    C_sess_film = (1.0 / s) * (R_sim3.T @ (C_sfm_film - t))
 
-        C_sess_film = (1.0 / s) * (R_sim3.T @ (C_sfm_film - t))
+    R_sess_film = R_sim3.T @ R_sfm_film
+    R_sess_film = R_sess_film @ Rfix_x180.T @ Rfix_z90.T
 
-        R_sess_film = R_sim3.T @ R_sfm_film
-        R_sess_film = R_sess_film @ Rfix_x180.T @ Rfix_z90.T
+    C_sess_film = D_FLIP @ C_sess_film
+    R_sess_film = D_FLIP @ R_sess_film @ D_FLIP
 
-        C_sess_film = D_FLIP @ C_sess_film
-        R_sess_film = D_FLIP @ R_sess_film @ D_FLIP
+    quat_sess = Rotate.from_matrix(R_sess_film).as_quat().tolist()
 
-        quat_sess = Rotate.from_matrix(R_sess_film).as_quat().tolist()
+    new_pose = {
+        "translation": C_sess_film.tolist(),
+        "rotation_xyzw": quat_sess,
+    }
 
-        new_pose = {
-            "translation": C_sess_film.tolist(),
-            "rotation_xyzw": quat_sess,
-        }
+    with state_lock:
+        if SESSION["epoch"] != epoch:
+            return  # tracking was reset meanwhile
+        GLOBAL_STATE["best_rmse"] = rmse
+        GLOBAL_STATE["sim3"] = align
+        convergence.update(align, session_pts, sfm_pts, FILM_POSE["translation"])
 
         score = best_score_from_rmse(rmse)
         if GLOBAL_STATE["best_score"] is None or score > GLOBAL_STATE["best_score"]:
@@ -260,31 +449,88 @@ def algo_loop():
             print("Film pose updated, RMSE =", rmse)
 
 
-def add_frame_to_used_with_sfm(frame_dict):
+def submit_localization(frame_dict):
     """
-    Run SfM localization for a selected frame and store it.
-    
-    """
-    C_sess = frame_dict["C_sess"]
-    R_sess = frame_dict["R_sess"]
+    Start the SfM localization of a selected frame in the process pool.
+    Must be called with state_lock held.
 
-    pose_sfm = query_sfm_pose(
+    """
+    # With a valid Sim3, the session pose predicts where to search in the SfM model
+    prior = None
+    if GLOBAL_STATE["sim3"] is not None:
+        prior = session_to_sfm_prior(
+            GLOBAL_STATE["sim3"], frame_dict["C_sess"], frame_dict["R_sess"]
+        )
+    frame_dict["t_submitted"] = time.perf_counter()
+    kwargs = dict(
         images=UPLOAD_FOLDER,
         query=frame_dict["image_name"],
         model_file=CURRENT_SFM_MODEL,
+        prior=prior,
+        intrinsics=intrinsics.locked,
     )
+    try:
+        future = localizer_pool.submit(query_sfm_pose, **kwargs)
+    except BrokenProcessPool:
+        restart_localizer_pool(localizer_pool)
+        future = localizer_pool.submit(query_sfm_pose, **kwargs)
+    frame_dict["pool"] = localizer_pool
+    return future
+
+
+def add_frame_to_used_with_sfm(frame_dict, future):
+    """
+    Store a frame once its SfM localization (see submit_localization) is done.
+
+    return:
+        (C_sess, C_sfm) if the frame was added, None if it was rejected
+    """
+    C_sess = frame_dict["C_sess"]
+    R_sess = frame_dict["R_sess"]
+
+    try:
+        pose_sfm = future.result()
+    except ValueError as e:
+        print("[localize]", e)
+        return None
+    except BrokenProcessPool:
+        with state_lock:
+            restart_localizer_pool(frame_dict["pool"])
+        return None
+    except Exception:
+        # e.g. unreadable model files or a pycolmap error: drop the frame,
+        # the algo_loop thread must keep running
+        print("[localize] localization failed:")
+        traceback.print_exc()
+        return None
+    timings = pose_sfm.get("timings")
+    if timings:
+        # time in the pool that was not spent localizing in the worker
+        roundtrip = time.perf_counter() - frame_dict["t_submitted"]
+        record("queue_wait_pool", max(roundtrip - timings.get("localize", 0.0), 0.0))
+        record_trace(timings)
     q_sfm = np.array(pose_sfm["rotation"])
     C_sfm = np.array(pose_sfm["translation"])
     R_sfm = Rotate.from_quat(q_sfm).as_matrix()
 
-    f_est = pose_sfm["camera_params"]["f"]
-    if GLOBAL_STATE["film_focal_length"] is None:
-            GLOBAL_STATE["film_focal_length"] = float(f_est)
+    with state_lock:
+        if frame_dict["epoch"] != SESSION["epoch"]:
+            return None  # tracking was reset while localizing
+
+        # Reject PnP outliers and fuse with the recent AR relative motion
+        with stage("pose_filter"):
+            fused = pose_filter.update(C_sess, R_sess, C_sfm, R_sfm)
+        if fused is None:
+            return None
+        C_sfm, R_sfm = fused
 
-    used_positions.append(C_sess)
-    used_rotations.append(R_sess)
-    used_sfm_positions.append(C_sfm)
-    used_sfm_rotations.append(R_sfm)
+        GLOBAL_STATE["film_focal_length"] = intrinsics.update(pose_sfm["camera_params"])
+
+        used_positions.append(C_sess)
+        used_rotations.append(R_sess)
+        used_sfm_positions.append(C_sfm)
+        used_sfm_rotations.append(R_sfm)
+    return C_sess, C_sfm
 
 def clear_upload_folder():
     if os.path.isdir(UPLOAD_FOLDER):
@@ -305,7 +551,10 @@ if __name__ == "__main__":
     clear_upload_folder() # clear upload history
     print(f"[server] running at http://{local_ip}:5000")
 
+    localizer_pool = create_localizer_pool()
+
     Thread(target=worker_loop, daemon=True).start()
     Thread(target=algo_loop, daemon=True).start()
 
-    app.run(host="0.0.0.0", port=5000, debug=False, threaded=False)
+    # Requests only save the image and enqueue it, so they are served concurrently
+    app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 import itertools
 import math
+from collections import deque
 
 # diverse & evaluation: global triggers and parameters
 MIN_DIST_M = 0.20          # space location diversity threshold (m): min distance to used frame >=0.2m could be viewed as diverse frame
@@ -9,6 +10,30 @@ MIN_ANGLE_DEG = 10.0       # position diversity threshold (°)： min rotation d
 MIN_USED_PAIRS = 4         # minimum frames to calculate sim3 and return
 EPS = 1e-9
 
+# temporal pose filter: sliding window of accepted (session, SfM) pose pairs
+POSE_WINDOW = 8                # number of recent accepted frames kept in the window
+POSE_MAX_ROT_DEG = 10.0        # max deviation of a frame's session->SfM rotation from the window (°)
+POSE_MAX_SCALE_DEV = 0.3       # max relative deviation of a frame's scale from the window scale
+POSE_MIN_BASELINE_M = 0.05     # min session baseline (m) for a scale ratio to be used
+POSE_MAX_REJECTIONS = 3        # consecutive rejections after which the window is restarted
+
+# convergence: stop SfM localizations once the film pose is stable
+CONV_POS_STD_M = 0.05          # bootstrap std of the film camera center in session (m)
+CONV_ROT_STD_DEG = 1.0         # bootstrap std of the film camera rotation (°)
+CONV_PATIENCE = 2              # consecutive stable Sim3 estimates before stopping
+CONV_MIN_INLIERS = 8           # bootstrap is unreliable with fewer Sim3 inliers
+CONV_NUM_BOOTSTRAP = 100       # bootstrap resamples of the Sim3 correspondences
+DRIFT_CHECK_INTERVAL_S = 5.0   # once converged, spot-check one frame every N seconds
+DRIFT_MAX_M = 0.3              # spot-check residual (m, session) that resumes localization
+TRACKING_MAX_SPEED_MPS = 5.0   # session camera speed above which AR tracking is considered reset
+
+# session intrinsics: the phone camera does not change within a session
+INTR_MIN_SAMPLES = 5           # focal estimates needed before the intrinsics can be locked
+INTR_MAX_REL_STD = 0.02        # lock once std(f) / median(f) of the estimates is below this
+
+# pose prior: predicted SfM pose of a frame from its session pose and the current Sim3
+PRIOR_RADIUS_M = 3.0           # database images within this distance (m, session) are retrieved
+
 
 def validate_sim3(align, prev_best_rmse=None, scale_min=0.2, scale_max=5.0, min_inliers=4):
     """Validate the Sim3 alignment result.
@@ -108,6 +133,285 @@ def is_diverse(new_C, new_R, used_C_list, used_R_list,
     angs  = [rot_angle_deg(new_R, R) for R in used_R_list]
     return (min(dists) >= min_dist) or (min(angs) >= min_ang)
 
+def rotation_mean(Rs):
+    """Chordal L2 mean of a list of rotation matrices."""
+    U, _, Vt = np.linalg.svd(np.sum(Rs, axis=0))
+    S = np.eye(3)
+    S[2, 2] = np.sign(np.linalg.det(U @ Vt))
+    return U @ S @ Vt
+
+
+class TemporalPoseFilter:
+    """
+    Sliding-window filter between SfM localization and Sim3 alignment.
+
+    Every frame gives both a session pose (from AR tracking) and a SfM pose
+    (from PnP). Within a short window the AR relative motion is accurate, so
+    each frame must agree with the recent ones on:
+      - the session->SfM rotation R_sfm @ R_sess^T
+      - the scale |C_sfm_i - C_sfm_j| / |C_sess_i - C_sess_j|
+    Frames that disagree are PnP outliers and are rejected before they reach
+    the Sim3 RANSAC. Accepted frames are fused with the predictions of the
+    window (the other frames' SfM poses moved by the AR relative motion).
+    """
+
+    def __init__(self, window=POSE_WINDOW, max_rot_deg=POSE_MAX_ROT_DEG,
+                 max_scale_dev=POSE_MAX_SCALE_DEV, min_baseline=POSE_MIN_BASELINE_M,
+                 max_rejections=POSE_MAX_REJECTIONS, min_frames=3, fuse=True):
+        self.frames = deque(maxlen=window)
+        self.max_rot_deg = max_rot_deg
+        self.max_scale_dev = max_scale_dev
+        self.min_baseline = min_baseline
+        self.max_rejections = max_rejections
+        self.min_frames = min_frames
+        self.fuse = fuse
+        self.num_rejected = 0
+
+    def reset(self):
+        self.frames.clear()
+        self.num_rejected = 0
+
+    def window_scale(self):
+        """Median scale ratio over all pairs of frames in the window."""
+        ratios = [
+            np.linalg.norm(a["C_sfm"] - b["C_sfm"]) / d
+            for a, b in itertools.combinations(self.frames, 2)
+            for d in [np.linalg.norm(a["C_sess"] - b["C_sess"])]
+            if d > self.min_baseline
+        ]
+        return float(np.median(ratios)) if ratios else None
+
+    def update(self, C_sess, R_sess, C_sfm, R_sfm):
+        """
+        Check a new frame against the window.
+
+        return:
+            (C_sfm, R_sfm) fused SfM pose if the frame is accepted, else None
+        """
+        C_sess = np.asarray(C_sess, float)
+        C_sfm = np.asarray(C_sfm, float)
+        frame = {"C_sess": C_sess, "R_sess": R_sess, "C_sfm": C_sfm, "R_sfm": R_sfm,
+                 "R_world": R_sfm @ R_sess.T}
+
+        if len(self.frames) < self.min_frames:
+            self.frames.append(frame)
+            return C_sfm, R_sfm
+
+        # 1) rotation gate
+        R_world = rotation_mean([f["R_world"] for f in self.frames])
+        ang = rot_angle_deg(frame["R_world"], R_world)
+        reason = None
+        if ang > self.max_rot_deg:
+            reason = f"rotation off by {ang:.1f}°"
+
+        # 2) scale gate
+        s = self.window_scale()
+        if reason is None and s is not None:
+            ratios = [
+                np.linalg.norm(C_sfm - f["C_sfm"]) / d
+                for f in self.frames
+                for d in [np.linalg.norm(C_sess - f["C_sess"])]
+                if d > self.min_baseline
+            ]
+            if ratios:
+                dev = abs(np.median(ratios) - s) / max(s, EPS)
+                if dev > self.max_scale_dev:
+                    reason = f"scale off by {dev:.0%}"
+
+        if reason is not None:
+            self.num_rejected += 1
+            print(f"[pose filter] Reject frame: {reason} ({self.num_rejected} in a row).")
+            if self.num_rejected >= self.max_rejections:
+                # the window itself is likely wrong (or tracking was reset)
+                print("[pose filter] Too many rejections, restarting the window.")
+                self.reset()
+                self.frames.append(frame)
+                return C_sfm, R_sfm
+            return None
+        self.num_rejected = 0
+
+        # 3) fuse with the predictions of the window
+        if self.fuse and s is not None:
+            preds = [f["C_sfm"] + s * (R_world @ (C_sess - f["C_sess"])) for f in self.frames]
+            C_fused = np.mean([C_sfm] + preds, axis=0)
+            R_fused = rotation_mean([R_sfm] + [R_world @ R_sess] * len(self.frames))
+        else:
+            C_fused, R_fused = C_sfm, R_sfm
+
+        self.frames.append(frame)
+        return C_fused, R_fused
+
+
+def bootstrap_film_pose_std(X, Y, C_sfm_film, with_scale=True,
+                            num_samples=CONV_NUM_BOOTSTRAP, rng=None):
+    """
+    Uncertainty of the film camera in session space, by bootstrapping the
+    Sim3 correspondences (session X -> SfM Y, inliers only).
+
+    return:
+        pos_std: RMS distance (session units) of the resampled film centers to their mean
+        rot_std: RMS angle (°) of the resampled Sim3 rotations to their mean
+    """
+    X = np.asarray(X, float); Y = np.asarray(Y, float)
+    C_sfm_film = np.asarray(C_sfm_film, float)
+    N = len(X)
+    rng = rng or np.random.default_rng()
+    centers, rotations = [], []
+    for _ in range(num_samples):
+        idx = rng.integers(0, N, size=N)
+        if len(np.unique(idx)) < 3:
+            continue
+        s, R, t = umeyama_similarity(X[idx], Y[idx], with_scale=with_scale)
+        if s <= EPS:
+            continue
+        centers.append((1.0 / s) * (R.T @ (C_sfm_film - t)))
+        rotations.append(R)
+    if len(centers) < 2:
+        return np.inf, np.inf
+    centers = np.array(centers)
+    pos_std = float(np.sqrt(((centers - centers.mean(0)) ** 2).sum(1).mean()))
+    R_mean = rotation_mean(rotations)
+    rot_std = float(np.sqrt(np.mean([rot_angle_deg(R, R_mean) ** 2 for R in rotations])))
+    return pos_std, rot_std
+
+
+def is_tracking_reset(C_prev, t_prev_ms, C, t_ms, max_speed=TRACKING_MAX_SPEED_MPS):
+    """
+    Detect a reset of the AR session frame (tracking loss / relocalization)
+    from an implausible camera speed between two consecutive uploads.
+    """
+    if C_prev is None or t_prev_ms is None or t_ms is None:
+        return False
+    dt = max((t_ms - t_prev_ms) / 1000.0, 0.1)
+    return float(np.linalg.norm(np.asarray(C) - np.asarray(C_prev))) / dt > max_speed
+
+
+class ConvergenceController:
+    """
+    Decide when SfM localizations are still worth spending on a session.
+
+    After every Sim3 estimate, the uncertainty of the film pose is measured by
+    bootstrapping. Once it stays below the thresholds for `patience` estimates,
+    the session is converged and no more frames are localized, except for one
+    spot check every `check_interval` seconds. A spot check whose residual
+    under the current Sim3 exceeds `drift_max` resumes the localizations.
+    """
+
+    def __init__(self, pos_std=CONV_POS_STD_M, rot_std=CONV_ROT_STD_DEG,
+                 patience=CONV_PATIENCE, min_inliers=CONV_MIN_INLIERS,
+                 check_interval=DRIFT_CHECK_INTERVAL_S, drift_max=DRIFT_MAX_M):
+        self.max_pos_std = pos_std
+        self.min_inliers = min_inliers
+        self.max_rot_std = rot_std
+        self.patience = patience
+        self.check_interval = check_interval
+        self.drift_max = drift_max
+        self.reset()
+
+    def reset(self):
+        self.converged = False
+        self.num_stable = 0
+        self.last_check = None
+
+    def update(self, align, session_pts, sfm_pts, C_sfm_film):
+        """Update with a validated Sim3 (from calculate_world_transform)."""
+        inl = np.asarray(align["inliers"], int)
+        X = np.asarray(session_pts, float)[inl]
+        Y = np.asarray(sfm_pts, float)[inl]
+        pos_std, rot_std = bootstrap_film_pose_std(X, Y, C_sfm_film)
+        stable = (len(inl) >= self.min_inliers
+                  and pos_std < self.max_pos_std and rot_std < self.max_rot_std)
+        self.num_stable = self.num_stable + 1 if stable else 0
+        print(f"[convergence] film pose std: {pos_std:.3f} m, {rot_std:.2f}° "
+              f"(stable {self.num_stable}/{self.patience})")
+        if not self.converged and self.num_stable >= self.patience:
+            print("[convergence] Film pose converged, pausing SfM localization.")
+            self.converged = True
+            self.last_check = None
+        return pos_std, rot_std
+
+    def should_localize(self, now):
+        """Whether the next frame should be localized."""
+        if not self.converged:
+            return True
+        if self.last_check is None or now - self.last_check >= self.check_interval:
+            self.last_check = now
+            return True
+        return False
+
+    def check_drift(self, align, C_sess, C_sfm):
+        """Spot check of a localized frame against the current Sim3."""
+        s = align["scale"]
+        R = np.asarray(align["rotation_matrix"])
+        t = np.asarray(align["translation"])
+        err = float(np.linalg.norm((1.0 / s) * (R.T @ (np.asarray(C_sfm) - t)) - C_sess))
+        if err > self.drift_max:
+            print(f"[convergence] Drift of {err:.2f} m detected, resuming SfM localization.")
+            self.converged = False
+            self.num_stable = 0
+            return True
+        return False
+
+
+class IntrinsicsCache:
+    """
+    Session-level cache of the query camera estimated by SfM localization.
+
+    The per-frame estimates (SIMPLE_RADIAL f, cx, cy, k) are collected until
+    the focal length is consistent, after which the median camera is locked
+    and passed to query_sfm_pose so that intrinsics are no longer estimated.
+    """
+
+    def __init__(self, min_samples=INTR_MIN_SAMPLES, max_rel_std=INTR_MAX_REL_STD):
+        self.min_samples = min_samples
+        self.max_rel_std = max_rel_std
+        self.samples = []
+        self.size = None
+        self.locked = None  # camera for query_sfm_pose once locked
+
+    def update(self, camera_params):
+        """Add one estimate; returns the current focal length estimate."""
+        if self.locked is not None:
+            return self.locked["params"][0]
+        size = (camera_params["width"], camera_params["height"])
+        if size != self.size:
+            # image size (orientation) changed: estimates are not comparable
+            self.size = size
+            self.samples = []
+        self.samples.append([camera_params[k] for k in ("f", "cx", "cy", "k")])
+
+        params = np.median(np.asarray(self.samples, float), axis=0)
+        f = float(params[0])
+        if len(self.samples) >= self.min_samples:
+            rel_std = float(np.std(np.asarray(self.samples)[:, 0])) / max(f, EPS)
+            if rel_std < self.max_rel_std:
+                self.locked = {
+                    "model": "SIMPLE_RADIAL",
+                    "width": size[0],
+                    "height": size[1],
+                    "params": params.tolist(),
+                }
+                print(f"[intrinsics] locked f={f:.1f}px after {len(self.samples)} frames")
+        return f
+
+
+def session_to_sfm_prior(align, C_sess, R_sess, radius=PRIOR_RADIUS_M):
+    """
+    Predict the SfM pose of a session frame with a Sim3 (session -> SfM),
+    to be used as localization prior by query_sfm_pose.
+
+    return: {"center": C_sfm, "rotation": Rwc_sfm, "radius": radius in SfM units}
+    """
+    s = float(align["scale"])
+    R = np.asarray(align["rotation_matrix"], float)
+    t = np.asarray(align["translation"], float)
+    return {
+        "center": s * R @ np.asarray(C_sess, float) + t,
+        "rotation": R @ np.asarray(R_sess, float),
+        "radius": s * radius,
+    }
+
+
 # quaternion -> rotation matrix (auto-recognize xyzw / wxyz of COLMAP SfM and ARKit/ARCore)
 def quat_to_rot(q):
     q = np.asarray(q, dtype=float)